@@ -0,0 +1,68 @@
+"""
+    Gaussian refinement benchmark
+    =============================
+    Measures how many particles per second the Gaussian refinement fits (``refinement: gaussian`` in the
+    configuration), on simulated frames with a growing number of particles. The particles are Gaussian spots at
+    known positions, with Poisson noise, therefore the error of the center of mass and of the fit can be compared.
+
+    Run it as::
+
+        python benchmark_gaussian_fit.py --particles 100 500 1000 5000 --diameter 7
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from pynta.model.experiment.nanoparticle_tracking import fast_locate
+from pynta.model.experiment.nanoparticle_tracking.gaussian_fit import refine_gaussian
+
+
+def simulate(shape, count, size, signal, background):
+    """ :return: an image with ``count`` Gaussian spots and their positions"""
+    positions = np.random.uniform(10, np.array(shape) - 10, (count, 2))
+    image = np.full(shape, float(background))
+    extent = int(4 * size) + 1
+    for y0, x0 in positions:
+        rows = slice(int(y0) - extent, int(y0) + extent + 1)
+        columns = slice(int(x0) - extent, int(x0) + extent + 1)
+        y, x = np.ogrid[rows, columns]
+        image[rows, columns] += signal * np.exp(-((y - y0) ** 2 + (x - x0) ** 2) / (2 * size ** 2))
+    return np.random.poisson(image).astype(np.uint16), positions
+
+
+def error(positions, records):
+    """ :return: RMS distance between the locations and the closest simulated position"""
+    distance, index = cKDTree(positions).query(np.column_stack((records['y'], records['x'])))
+    return np.sqrt(np.mean(distance[distance < 1] ** 2))
+
+
+def main():
+    parser = ArgumentParser(description='Throughput and accuracy of the Gaussian refinement')
+    parser.add_argument('--particles', type=int, nargs='*', default=[100, 500, 1000, 5000])
+    parser.add_argument('--diameter', type=int, default=7)
+    parser.add_argument('--size', type=float, default=1.5, help='Standard deviation of the spots, in pixels')
+    parser.add_argument('--signal', type=float, default=60)
+    parser.add_argument('--background', type=float, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:<10} {:>10} {:>10} {:>12} {:>10} {:>10} {:>8}'.format(
+        'particles', 'located', 'fit', 'spots/s', 'error com', 'error fit', 'ep'))
+    for count in args.particles:
+        side = int(np.sqrt(count * 400))  # About 20x20 pixels per particle
+        image, positions = simulate((side, side), count, args.size, args.signal, args.background)
+        records = fast_locate.locate(image, diameter=args.diameter, minmass=100)
+        refine_gaussian(image, records, args.diameter)
+        t0 = perf_counter()
+        for i in range(args.repeat):
+            refined = refine_gaussian(image, records, args.diameter)
+        fit_time = (perf_counter() - t0) / args.repeat
+        print('{:<10} {:>10} {:>8.1f}ms {:>12.0f} {:>10.3f} {:>10.3f} {:>8.3f}'.format(
+            count, len(records), fit_time * 1000, len(records) / fit_time, error(positions, records),
+            error(positions, refined), np.median(refined['ep'])))
+
+
+if __name__ == '__main__':
+    main()
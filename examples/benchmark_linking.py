@@ -0,0 +1,89 @@
+"""
+    Linking benchmark
+    =================
+    Compares the time per frame of the trackpy linker and of the in-tree linker (``engine: pynta`` in the ``link``
+    section of the configuration, see :mod:`pynta.model.experiment.nanoparticle_tracking.fast_link`), on particles
+    diffusing with a fixed density, for a growing number of particles per frame. It also reports the fraction of the
+    links on which both agree and the subnetworks that the in-tree linker had to split. At high densities or large
+    search ranges trackpy gives up, the in-tree linker splits the subnetworks instead. With ``--strip-width``, the
+    in-tree linker also links the field in strips, in parallel on ``--strip-threads`` threads (see
+    :mod:`pynta.model.experiment.nanoparticle_tracking.partitioned_link`).
+
+    Run it as::
+
+        python benchmark_linking.py --particles 100 1000 10000 --search-range 5 --strip-width 512
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+from trackpy.linking import Linker, SubnetOversizeException
+
+from pynta.model.experiment.nanoparticle_tracking.fast_link import KDTreeLinker
+from pynta.model.experiment.nanoparticle_tracking.partitioned_link import PartitionedLinker
+
+
+def diffuse(frames, particles, density, step):
+    """ :return: list with the coordinates of the particles on each frame"""
+    size = np.sqrt(particles / density)
+    positions = np.random.uniform(0, size, (particles, 2))
+    coords = []
+    for i in range(frames):
+        positions = positions + np.random.normal(0, step, positions.shape)
+        coords.append(positions)
+    return coords
+
+
+def run(linker, coords):
+    """ :return: the ids of the particles on every frame and the time per frame, in seconds"""
+    linker.init_level(coords[0], 0)
+    ids = [np.asarray(linker.particle_ids)]
+    t0 = perf_counter()
+    for t, frame in enumerate(coords[1:], 1):
+        linker.next_level(frame, t)
+        ids.append(np.asarray(linker.particle_ids))
+    return ids, (perf_counter() - t0) / (len(coords) - 1)
+
+
+def agreement(ids, expected):
+    """ :return: fraction of the links between consecutive frames on which both linkers agree"""
+    same = [(a[1:] == a[:-1]) == (b[1:] == b[:-1]) for a, b in zip(np.array(ids).T, np.array(expected).T)]
+    return np.mean(same)
+
+
+def main():
+    parser = ArgumentParser(description='Time per frame of the trackpy and in-tree linkers')
+    parser.add_argument('--particles', type=int, nargs='*', default=[100, 1000, 10000])
+    parser.add_argument('--density', type=float, default=0.002, help='Particles per square pixel')
+    parser.add_argument('--step', type=float, default=1, help='Standard deviation of the displacements, in pixels')
+    parser.add_argument('--search-range', type=float, default=5)
+    parser.add_argument('--memory', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--strip-width', type=float, default=None, help='Also link in strips of this many pixels')
+    parser.add_argument('--strip-threads', type=int, default=2)
+    args = parser.parse_args()
+
+    print('{:>9} {:>12} {:>12} {:>9} {:>7}'.format('particles', 'trackpy ms', 'pynta ms', 'agreement', 'capped'))
+    for particles in args.particles:
+        np.random.seed(0)
+        coords = diffuse(args.frames, particles, args.density, args.step)
+        linker = KDTreeLinker(args.search_range, memory=args.memory)
+        ids, pynta_time = run(linker, coords)
+        if args.strip_width:
+            strips = PartitionedLinker(args.search_range, args.strip_width, args.memory, args.strip_threads)
+            strip_ids, strip_time = run(strips, coords)
+            strips.close()
+            print('{:>9} strips of {:g} px: {:.2f} ms, agreement {:.4f}'.format(
+                particles, args.strip_width, strip_time * 1e3, agreement(strip_ids, ids)))
+        try:
+            expected, trackpy_time = run(Linker(args.search_range, memory=args.memory), coords)
+        except SubnetOversizeException:
+            print('{:>9} {:>12} {:>12.2f} {:>9} {:>7}'.format(particles, 'failed', pynta_time * 1e3, '-',
+                                                             linker.capped), flush=True)
+            continue
+        print('{:>9} {:>12.2f} {:>12.2f} {:>9.4f} {:>7}'.format(
+            particles, trackpy_time * 1e3, pynta_time * 1e3, agreement(ids, expected), linker.capped), flush=True)
+
+
+if __name__ == '__main__':
+    main()
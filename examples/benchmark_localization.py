@@ -0,0 +1,98 @@
+"""
+    Localization benchmark
+    ======================
+    Compares the time it takes to locate the particles on simulated frames with ``trackpy.locate`` and with the
+    in-tree engine (``engine: pynta`` in the configuration), and checks that both find the same particles. The first
+    call of each engine is not timed, trackpy compiles its functions with numba on the first call.
+
+    A second table compares the coarse-to-fine engine (``engine: multires``) with both, on frames with a growing number
+    of particles. Its recall is the fraction of the particles found by trackpy that it finds within one pixel.
+
+    Run it as::
+
+        python benchmark_localization.py --frames 50 --width 1080 --height 720 --diameter 11 --particles 10 100 1000
+"""
+import warnings
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+import trackpy as tp
+from scipy.spatial import cKDTree
+
+from pynta.model.cameras.simulate_brownian import SimBrownian
+from pynta.model.experiment.nanoparticle_tracking import fast_locate, multires
+from pynta.model.experiment.nanoparticle_tracking.schema import to_records
+
+
+def run(method, images, **kwargs):
+    method(images[0], **kwargs)
+    t0 = perf_counter()
+    locations = [method(image, **kwargs) for image in images]
+    return locations, (perf_counter() - t0) / len(images)
+
+
+def recall(expected, located):
+    """ Fraction of the expected locations with a location closer than one pixel."""
+    found = total = 0
+    for locations, records in zip(expected, located):
+        total += len(locations)
+        if len(locations) and len(records):
+            distance, index = cKDTree(np.column_stack((records['y'], records['x']))).query(
+                np.column_stack((locations['y'], locations['x'])))
+            found += np.count_nonzero(distance < 1)
+    return found / total if total else 1
+
+
+def simulate(args, num_particles=None):
+    sim = SimBrownian((args.height, args.width))
+    if num_particles is not None:
+        sim.num_particles = num_particles
+        sim.__init__((args.height, args.width))
+    return [(sim.gen_image() + np.random.poisson(args.background, (args.height, args.width))).astype(np.uint16)
+            for i in range(args.frames)]
+
+
+def main():
+    parser = ArgumentParser(description='Compare the localization engines on simulated frames')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--width', type=int, default=1080)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--diameter', type=int, default=11)
+    parser.add_argument('--minmass', type=float, default=100)
+    parser.add_argument('--background', type=float, default=20, help='Mean of the Poisson noise added to the frames')
+    parser.add_argument('--particles', type=int, nargs='*', default=[10, 100, 1000],
+                        help='Number of simulated particles of each row of the multires table')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')  # trackpy warns about frames without particles
+    images = simulate(args)
+
+    print('{:<32} {:>10} {:>10} {:>8} {:>10}'.format('case', 'trackpy', 'pynta', 'speedup', 'particles'))
+    for name, kwargs in [('bandpass', {}), ('no preprocess', {'preprocess': False, 'max_iterations': 3})]:
+        kwargs = dict(kwargs, diameter=args.diameter, minmass=args.minmass)
+        expected, trackpy_time = run(tp.locate, images, **kwargs)
+        located, pynta_time = run(fast_locate.locate, images, **kwargs)
+        for locations, records in zip(expected, located):
+            np.testing.assert_allclose(records['x'], to_records(locations)['x'])
+        print('{:<32} {:>8.1f}ms {:>8.1f}ms {:>7.2f}x {:>10.0f}'.format(
+            name, trackpy_time * 1000, pynta_time * 1000, trackpy_time / pynta_time,
+            np.mean([len(records) for records in located])))
+
+    print()
+    print('{:<10} {:>10} {:>10} {:>10} {:>8} {:>10} {:>8}'.format(
+        'particles', 'trackpy', 'pynta', 'multires 2', 'recall', 'multires 4', 'recall'))
+    kwargs = {'diameter': args.diameter, 'minmass': args.minmass}
+    for num_particles in args.particles:
+        images = simulate(args, num_particles)
+        expected, trackpy_time = run(tp.locate, images, **kwargs)
+        located, pynta_time = run(fast_locate.locate, images, **kwargs)
+        row = [num_particles, trackpy_time * 1000, pynta_time * 1000]
+        for binning in (2, 4):
+            located, multires_time = run(multires.locate, images, binning=binning, **kwargs)
+            row += [multires_time * 1000, recall(expected, located)]
+        print('{:<10} {:>8.1f}ms {:>8.1f}ms {:>8.1f}ms {:>8.3f} {:>8.1f}ms {:>8.3f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
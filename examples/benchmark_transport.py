@@ -0,0 +1,79 @@
+"""
+    Transport benchmark
+    ===================
+    Compares the throughput of the experiment bus for the different transports: ``tcp`` and ``ipc`` for consumers
+    running on other processes and ``inproc`` for consumers running on a thread of the process that publishes. Frames
+    are published in direct mode, as fast as possible, and a single consumer counts them.
+
+    Run it as::
+
+        python benchmark_transport.py --frames 2000 --width 1024 --height 1024
+"""
+import threading
+from argparse import ArgumentParser
+from multiprocessing import Event, Process, Queue
+from time import perf_counter
+
+import numpy as np
+import zmq
+
+from pynta.model.experiment.publisher import endpoint, Publisher, TRANSPORT_IPC, TRANSPORT_TCP
+from pynta.model.experiment.subscriber import subscribe, wait_ready, BOUNDED
+
+
+def consume(address, frames, ready, results):
+    subscription = subscribe(address, 'benchmark', qos={'policy': BOUNDED, 'hwm': frames}, ready=ready)
+    received = 0
+    t0 = t1 = None
+    while received < frames:
+        message = subscription.recv(timeout=5)
+        if message is None:
+            break
+        t1 = perf_counter()
+        if t0 is None:
+            t0 = t1
+        received += 1
+    results.put((received, t1 - t0))
+    subscription.close()
+
+
+def run(transport, frames, image):
+    publisher = Publisher(mode='direct', send_hwm=2 * frames,  # Nothing is dropped even if the consumer lags
+                          transport=TRANSPORT_TCP if transport == 'inproc' else transport)
+    publisher.start()
+    if transport == 'inproc':
+        ready = threading.Event()
+        results = Queue()
+        consumer = threading.Thread(target=consume, args=[publisher.local_address, frames, ready, results])
+    else:
+        ready = Event()
+        results = Queue()
+        consumer = Process(target=consume, args=[endpoint(publisher.port, transport), frames, ready, results])
+    consumer.start()
+    wait_ready(ready, consumer)
+    for i in range(frames):
+        publisher.publish('benchmark', [0., image, i])
+    received, elapsed = results.get()
+    consumer.join()
+    publisher.stop()
+    publisher.join()
+    return received, elapsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Compare the throughput of the transports of the bus')
+    parser.add_argument('--frames', type=int, default=1000, help='Number of frames to publish')
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=1024)
+    args = parser.parse_args()
+
+    image = np.random.randint(0, 2**16, size=(args.height, args.width), dtype=np.uint16)
+    transports = ['inproc', TRANSPORT_TCP]
+    if zmq.has('ipc'):
+        transports.insert(1, TRANSPORT_IPC)
+    print('{} frames of {}x{} pixels ({:.1f}MB)'.format(args.frames, args.width, args.height, image.nbytes / 2**20))
+    print('{:>8} {:>10} {:>10} {:>10}'.format('', 'received', 'frames/s', 'MB/s'))
+    for transport in transports:
+        received, elapsed = run(transport, args.frames, image)
+        print('{:>8} {:>10} {:>10.0f} {:>10.0f}'.format(
+            transport, received, received / elapsed, received * image.nbytes / elapsed / 2**20))
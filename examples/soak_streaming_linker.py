@@ -0,0 +1,67 @@
+"""
+    Streaming linker soak test
+    ==========================
+    Links a long stream of simulated frames with the streaming linker (see
+    :mod:`pynta.model.experiment.nanoparticle_tracking.streaming_linker`) and prints, every ``--report`` frames, the
+    trajectories being tracked, the ones retired, the memory allocated and the time spent per frame. Particles diffuse
+    and leave the field of view at random, and new ones arrive, therefore the number of particles on a frame is
+    stable while the trajectories retired keep growing. Both the memory and the time per frame should stay flat.
+
+    Run it as::
+
+        python soak_streaming_linker.py --frames 1000000 --particles 50
+"""
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import StreamingLinker
+
+
+def stream(frames, particles, lifetime, step=0.5, size=500):
+    """ Generates the locations of particles diffusing, each of them seen on about ``lifetime`` frames.
+
+    :return: generator of record arrays
+    """
+    positions = np.random.uniform(0, size, (particles, 2))
+    for frame in range(frames):
+        leaving = np.random.random(len(positions)) < 1 / lifetime
+        positions[leaving] = np.random.uniform(0, size, (leaving.sum(), 2))  # New particles, far from the old ones
+        positions += np.random.normal(0, step, positions.shape)
+        records = empty(len(positions))
+        records['x'], records['y'] = positions.T
+        records['mass'] = 1000
+        records['frame'] = frame
+        yield records
+
+
+def main():
+    parser = ArgumentParser(description='Memory and time per frame of the streaming linker over long measurements')
+    parser.add_argument('--frames', type=int, default=1000000)
+    parser.add_argument('--particles', type=int, default=50)
+    parser.add_argument('--lifetime', type=float, default=100, help='Mean frames on which a particle is seen')
+    parser.add_argument('--memory', type=int, default=3)
+    parser.add_argument('--search-range', type=float, default=4)
+    parser.add_argument('--report', type=int, default=10000, help='Frames between reports')
+    args = parser.parse_args()
+
+    linker = StreamingLinker(args.search_range, memory=args.memory)
+    tracemalloc.start()
+    print('{:>9} {:>6} {:>9} {:>11} {:>9}'.format('frame', 'live', 'retired', 'memory MB', 'us/frame'))
+    elapsed = 0
+    for frame, records in enumerate(stream(args.frames, args.particles, args.lifetime)):
+        t0 = perf_counter()
+        linker.link(records, frame)
+        elapsed += perf_counter() - t0
+        if (frame + 1) % args.report == 0:
+            print('{:>9} {:>6} {:>9} {:>11.2f} {:>9.1f}'.format(
+                frame + 1, linker.live, linker.retired, tracemalloc.get_traced_memory()[0] / 1e6,
+                elapsed / args.report * 1e6), flush=True)
+            elapsed = 0
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,11 @@
-import os
-from multiprocessing import freeze_support
-from time import sleep
+"""
+Speed and accuracy of the localization on simulated movies, see :mod:`pynta.tools.benchmark`. For example::
 
-from pynta import BASE_DIR
-from pynta.model.experiment.nanoparticle_tracking.np_tracking import NPTracking
+    python test_tracking_speed.py --densities 10 100 --snr 5 --output results.json
 
+"""
+from pynta.tools.benchmark import main
 
 
 if __name__ == "__main__":
-    freeze_support()
-    config_file = os.path.join(BASE_DIR, 'util', 'example_config.yml')
-    with NPTracking(config_file) as exp:
-        exp.initialize_camera()
-        exp.start_free_run()
-        while exp.camera.sb.current_frame<exp.camera.sb.frames_to_accumulate:
-            sleep(5)
-        exp.stop_free_run()
-        exp.start_tracking()
-        exp.start_free_run()
-        print('Plase wait 30 seconds')
-        sleep(30)
-        exp.stop_tracking()
-        exp.stop_free_run()
-        exp.finalize()
+    main()
@@ -1,2 +1,7 @@
 class PublisherNotStarted(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class FrameOverwritten(Exception):
+    """ Raised when a frame in shared memory was replaced by a newer one before being read."""
+    pass
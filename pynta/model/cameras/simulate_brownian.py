@@ -25,6 +25,8 @@ import numpy as np
 class SimBrownian:
     """
     :param tuple camera_size: number of pixels in the x and y direction
+    :param int num_particles: number of particles per frame, :attr:`num_particles` if not given
+    :param int kernel_size: number of pixels used to calculate the PSF, :attr:`kernel_size` if not given
     :return: generated an image with specified noise and particles displaced accordingly
     """
     #: Number of particles per frame
@@ -55,7 +57,11 @@ class SimBrownian:
     #: (they will be an infinite loop). Set to 0 in order to avoid accumulating frames
     frames_to_accumulate = 0
 
-    def __init__(self, camera_size: tuple = (500, 500)):
+    def __init__(self, camera_size: tuple = (500, 500), num_particles: int = None, kernel_size: int = None):
+        if num_particles is not None:
+            self.num_particles = num_particles
+        if kernel_size is not None:
+            self.kernel_size = kernel_size
         # camera and monitor parameters
         self.camera_size = np.array(camera_size)
         self.localization = np.zeros(shape=(self.num_particles, 2))
@@ -8,15 +8,14 @@
     assess their limitations. The general pattern is that of the PUB/SUB, with one publisher and several subscribers.
 
     The messages should include a *topic* and data. For this, the elements in the queue should be dictionaries with two
-    keywords: **data** and **topic**. ``data['data']`` will be serialized through the use of cPickle, and is handled
-    automatically by pyZQM through the use of ``send_pyobj``. The subscribers should be aware of this and use either
-    unpickle or ``recv_pyobj``.
+    keywords: **data** and **topic**. ``data['data']`` will be serialized with
+    :func:`~pynta.model.experiment.serialization.send_data`, which sends numpy arrays as raw buffers and pickles
+    everything else. The subscribers should be aware of this and use
+    :func:`~pynta.model.experiment.serialization.recv_data`.
 
     In order to stop the publisher process, the string ``'stop'`` should be placed in ``data['data']``. The message
     will be broadcast and can be used to stop other processes, such as subscribers.
 
-    .. TODO:: Check whether the serialization of objects with cPickle may be a bottleneck for performance.
-
 
     :copyright:  Aquiles Carattino <aquiles@uetke.com>
     :license: GPLv3, see LICENSE for more details
@@ -27,7 +26,8 @@ import yaml
 
 from pynta.util import get_logger
 from pynta.model.experiment.publisher import Publisher
-from pynta.model.experiment.subscriber import subscriber
+from pynta.model.experiment.subscriber import get_qos, subscriber, wait_ready
+from pynta.model.experiment.telemetry import Telemetry
 
 
 class BaseExperiment:
@@ -38,13 +38,29 @@ class BaseExperiment:
         self.config = {}  # Dictionary storing the configuration of the experiment
         self.logger = get_logger(name=__name__)
         self._threads = []
-        self.publisher = Publisher()
+        if filename:
+            self.load_configuration(filename)
+
+        bus_config = self.config.get('bus', {})
+        self.publisher = Publisher(mode=bus_config.get('mode'), send_hwm=bus_config.get('send_hwm'),
+                                   transport=bus_config.get('transport'),
+                                   stats_interval=bus_config.get('stats_interval'))
         self.publisher.start()
 
         self._connections = []
         self.subscriber_events = []
-        if filename:
-            self.load_configuration(filename)
+
+    def qos(self, topic, consumer=None):
+        """ Delivery class of a consumer of a topic, as defined in the ``bus`` section of the configuration. See
+        :func:`~pynta.model.experiment.subscriber.get_qos`.
+        """
+        return get_qos(self.config.get('bus', {}).get('qos'), topic, consumer)
+
+    def telemetry(self, name):
+        """ :class:`~pynta.model.experiment.telemetry.Telemetry` for a consumer, which publishes its statistics on
+        ``stats`` every ``stats_interval`` seconds, as defined in the ``bus`` section of the configuration.
+        """
+        return Telemetry(name, self.publisher.queue, self.publisher.stats_interval)
 
     def stop_publisher(self):
         """ Puts the proper data to the queue in order to stop the running publisher process
@@ -66,7 +82,8 @@ class BaseExperiment:
                 connection['event'].set()
 
     def connect(self, method, topic, *args, **kwargs):
-        """ Async method that connects the running publisher to the given method on a specific topic.
+        """ Async method that connects the running publisher to the given method on a specific topic. It returns once
+        the subscriber is receiving.
 
         :param method: method that will be connected on a given topic
         :param str topic: the topic that will be used by the subscriber to discriminate what information to collect.
@@ -74,6 +91,9 @@ class BaseExperiment:
         :param kwargs: extra keyword arguments will be passed to the subscriber, which in turn will pass them to the function
         """
         event = Event()
+        kwargs['ready'] = Event()
+        kwargs.setdefault('address', self.publisher.address)
+        kwargs.setdefault('telemetry', self.telemetry(method.__name__))
         self.logger.debug('Arguments: {}'.format(args))
         arguments = [method, topic, event]
         for arg in args:
@@ -89,6 +109,7 @@ class BaseExperiment:
             'event': event,
         })
         self._connections[-1]['process'].start()
+        wait_ready(kwargs['ready'], self._connections[-1]['process'])
 
     def load_configuration(self, filename):
         """ Loads the configuration file in YAML format.
@@ -147,6 +168,7 @@ class BaseExperiment:
         """ Needs to be overridden by child classes.
         """
         self.publisher.stop()
+        self.publisher.join()
 
     def update_config(self, **kwargs):
         self.logger.info('Updating config')
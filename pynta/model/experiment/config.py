@@ -19,6 +19,11 @@ logger = get_logger(__name__)
 class Config:
     def __init__(self):
         self.zmq_port = 5555
+        self.zmq_input_port = 5556  # Port on which the publisher listens to producers of other processes
+        self.publisher_mode = 'direct'  # Either 'direct' or 'queue', see pynta.model.experiment.publisher
+        self.zmq_transport = 'ipc'  # Used on this computer, either 'ipc' or 'tcp' (the port is always open to tcp)
+        self.zmq_send_hwm = 100  # Messages the publisher buffers for each subscriber before dropping them
+        self.stats_interval = 1  # Seconds between the statistics published on the 'stats' topic, 0 disables them
 
     def __setattr__(self, key, value):
         logger.debug(f'Setting {key} to {value}')
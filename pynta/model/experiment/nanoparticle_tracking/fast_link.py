@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Fast Linking
+============
+In-tree frame to frame linker, for dense samples. ``trackpy`` splits the candidate links in subnetworks, sets of
+particles that could be linked to each other, and solves each of them by recursion in Python, whose cost explodes
+with the size of the subnetwork. At high densities or with large search ranges a single frame can block the linking
+for minutes. :class:`KDTreeLinker` links the same way, minimizing the sum of the squared displacements, with a cost of
+``search_range ** 2`` for every particle left without a link, but:
+
+* The candidates are found at once with a ``scipy.spatial.cKDTree``, as a sparse matrix of distances.
+* The subnetworks are the connected components of that matrix. Subnetworks larger than ``max_subnet_size`` particles
+  (counting both frames) are split by dropping their longest candidates, shrinking the search range within them by
+  ``adaptive_step`` until they fit, as trackpy does with ``adaptive_stop``. The number of subnetworks that had to be
+  split is kept in :attr:`KDTreeLinker.capped` and logged.
+* All the subnetworks of a frame are solved together as a single sparse assignment problem, with
+  ``scipy.sparse.csgraph.min_weight_full_bipartite_matching``, whose cost is polynomial.
+
+It follows the interface of ``trackpy.linking.Linker`` used by
+:class:`~pynta.model.experiment.nanoparticle_tracking.streaming_linker.StreamingLinker`. Select it with ``engine:
+pynta`` in the ``link`` section of the tracking configuration.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components, min_weight_full_bipartite_matching
+from scipy.spatial import cKDTree
+
+from pynta.util import get_logger
+
+#: Value of ``engine`` in the configuration of ``link`` that selects this module
+ENGINE = 'pynta'
+
+MIN_WEIGHT = 1e-9  # Weight of the links that cost nothing, the sparse matrices would drop zeros
+
+
+def candidates(sources, destinations, search_range):
+    """ :return: the indices of the sources and of the destinations closer than ``search_range``, and their distance
+    """
+    if not len(sources) or not len(destinations):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    pairs = cKDTree(sources).sparse_distance_matrix(cKDTree(destinations), search_range, output_type='ndarray')
+    return pairs['i'].astype(int), pairs['j'].astype(int), pairs['v']
+
+
+def split_subnets(source, destination, distance, shape, search_range, max_subnet_size, adaptive_step=0.9):
+    """ Drops the longest candidates of the subnetworks with more than ``max_subnet_size`` particles, until all of
+    them fit.
+
+    :param shape: Number of sources and of destinations
+    :return: the candidates kept, as ``source, destination, distance``, and the number of subnetworks split
+    """
+    capped = 0
+    limit = search_range
+    while len(source):
+        graph = coo_matrix((np.ones(len(source)), (source, destination + shape[0])), shape=(sum(shape), sum(shape)))
+        labels = connected_components(graph, directed=False)[1]
+        oversize = np.bincount(labels)[labels[source]] > max_subnet_size
+        if not oversize.any():
+            break
+        if not capped:
+            capped = len(np.unique(labels[source[oversize]]))
+        limit *= adaptive_step
+        drop = oversize & (distance >= limit) if limit > search_range * 1e-3 else oversize
+        source, destination, distance = source[~drop], destination[~drop], distance[~drop]
+    return source, destination, distance, capped
+
+
+def assign(source, destination, distance, shape, search_range):
+    """ Chooses the links that minimize the sum of the squared distances, plus ``search_range ** 2`` for every source
+    left without a link. The problem is extended with a dummy partner for every particle, to always have a solution
+    in which every particle has a partner.
+
+    :return: indices of the sources and of the destinations linked
+    """
+    if not len(source):
+        return source, destination
+    sources, destinations = shape
+    # Rows: sources, then dummies of the destinations. Columns: destinations, then dummies of the sources
+    rows = np.concatenate((source, np.arange(sources), np.arange(destinations) + sources, destination + sources))
+    columns = np.concatenate((destination, np.arange(sources) + destinations, np.arange(destinations),
+                              source + destinations))
+    weights = np.concatenate((distance ** 2 + MIN_WEIGHT, np.full(sources, search_range ** 2),
+                              np.full(destinations + len(source), MIN_WEIGHT)))
+    size = sources + destinations
+    graph = coo_matrix((weights, (rows, columns)), shape=(size, size)).tocsr()
+    partner = min_weight_full_bipartite_matching(graph)[1]
+    linked = np.flatnonzero(partner[:sources] < destinations)
+    return linked, partner[linked]
+
+
+class KDTreeLinker:
+    """ Links the coordinates of particles frame by frame, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.fast_link`.
+
+    :param float search_range: Maximum displacement of a particle between consecutive frames
+    :param int memory: Frames that a particle can be missing and still be linked
+    :param int max_subnet_size: Maximum number of particles of a subnetwork, larger ones are split
+    :param float adaptive_step: Factor by which the search range is shrunk within the subnetworks too large
+    """
+    def __init__(self, search_range, memory=0, max_subnet_size=50, adaptive_step=0.9):
+        self.search_range = float(search_range)
+        self.memory = memory
+        self.max_subnet_size = max_subnet_size
+        self.adaptive_step = adaptive_step
+        self.particle_ids = np.zeros(0, dtype=int)
+        self.capped = 0  # Subnetworks split because they were too large
+        self.logger = get_logger(name=__name__)
+
+        self._next_id = 0
+        self._positions = np.zeros((0, 2))  # Last position of the particles that can be linked
+        self._ids = np.zeros(0, dtype=int)
+        self._levels = np.zeros(0, dtype=int)  # Level at which they were last found
+
+    @property
+    def tracked(self):
+        """ Number of particles that may be linked on the next level, including the ones kept in memory."""
+        return len(self._ids)
+
+    def init_level(self, coords, t):
+        """ Starts new tracks with the coordinates of the first frame."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        self.particle_ids = np.arange(len(coords))
+        self._next_id = len(coords)
+        self._positions, self._ids, self._levels = coords, self.particle_ids, np.full(len(coords), t)
+
+    def next_level(self, coords, t):
+        """ Links the coordinates of a frame to the particles found on the previous ones."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        available = t - self._levels <= self.memory + 1
+        positions, ids, levels = self._positions[available], self._ids[available], self._levels[available]
+        shape = (len(positions), len(coords))
+        source, destination, distance = candidates(positions, coords, self.search_range)
+        source, destination, distance, capped = split_subnets(source, destination, distance, shape,
+                                                              self.search_range, self.max_subnet_size,
+                                                              self.adaptive_step)
+        if capped:
+            self.capped += capped
+            self.logger.warning('Split {} subnetworks larger than {} particles on level {}, consider a smaller '
+                                'search range'.format(capped, self.max_subnet_size, t))
+        source, destination = assign(source, destination, distance, shape, self.search_range)
+
+        particle_ids = np.full(len(coords), -1)
+        particle_ids[destination] = ids[source]
+        new = particle_ids < 0
+        particle_ids[new] = np.arange(self._next_id, self._next_id + new.sum())
+        self._next_id += new.sum()
+        self.particle_ids = particle_ids
+
+        lost = np.ones(len(positions), dtype=bool)
+        lost[source] = False
+        self._positions = np.concatenate((positions[lost], coords))
+        self._ids = np.concatenate((ids[lost], particle_ids))
+        self._levels = np.concatenate((levels[lost], np.full(len(coords), t)))
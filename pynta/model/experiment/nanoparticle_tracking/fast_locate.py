@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Fast Localization
+=================
+Localization engine written with numpy and scipy only, it can replace ``trackpy.locate`` on 2D images. It follows
+the same steps as trackpy (the Crocker-Grier algorithm), therefore it takes the same arguments and it finds the same
+particles, with the same columns:
+
+* A bandpass filter (a gaussian blur minus a boxcar average) removes the noise and the background. The kernels are
+  built once and cached.
+* The local maxima brighter than a percentile of the image are the candidates. The percentile is computed from the
+  histogram of the (integer) image, instead of sorting its pixels.
+* The center of mass of every candidate is refined at the same time, gathering the pixels of all the neighborhoods
+  in a single array. Candidates too close to a brighter one, or with a mass below ``minmass``, are discarded.
+
+It returns a record array (see :mod:`~pynta.model.experiment.nanoparticle_tracking.schema`) instead of a DataFrame, to
+skip the overhead of pandas. Select it by setting ``engine: pynta`` in the ``locate`` section of the tracking
+configuration, any other value of ``engine`` is handed to trackpy.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+
+#: Value of ``engine`` in the configuration of ``locate`` that selects this module
+ENGINE = 'pynta'
+
+SHIFT_THRESHOLD = 0.6  # Offset (pixels) of the center of mass above which the neighborhood is moved
+
+
+@lru_cache()
+def gaussian_kernel(sigma, truncate=4.0):
+    """ :return: a discrete, normalized gaussian of width ``sigma``, truncated at ``truncate`` sigmas."""
+    half_width = int(truncate * sigma + 0.5)
+    x = np.arange(-half_width, half_width + 1)
+    kernel = np.exp(x ** 2 / (-2 * sigma ** 2))
+    return kernel / np.sum(kernel)
+
+
+@lru_cache()
+def neighborhood(radius):
+    """ Offsets and weights of the pixels of a circular neighborhood, used to refine and characterize every candidate.
+
+    :return: ``dy, dx, r2, cos, sin`` with one element per pixel of the disk: offsets from the corner of the enclosing
+        square, squared distance to the center and cosine and sine of twice its angle.
+    """
+    points = np.arange(-radius, radius + 1)
+    y, x = np.meshgrid(points, points, indexing='ij')
+    inside = y ** 2 + x ** 2 <= radius ** 2
+    theta = np.arctan2(y, x)[inside]
+    return (y[inside] + radius, x[inside] + radius, (y ** 2 + x ** 2)[inside],
+            np.cos(2 * theta), np.sin(2 * theta))
+
+
+@lru_cache()
+def x_squared_sum(radius):
+    """ :return: the sum of the squared distances along one axis of the pixels of the neighborhood."""
+    dy = neighborhood(radius)[0] - radius
+    return float(np.sum(dy ** 2))
+
+
+def bandpass(image, noise_size, smoothing_size, threshold, truncate=4, axes=None):
+    """ Subtracts the background, averaged over ``smoothing_size`` pixels, from the image blurred with a gaussian of
+    width ``noise_size``. Pixels below the threshold are set to 0.
+
+    :param axes: Axes along which the image is filtered, by default all of them. For example, ``(1, 2)`` filters a
+        stack of images
+    """
+    if noise_size >= smoothing_size:
+        raise ValueError('The smoothing length scale must be larger than the noise length scale.')
+    background = image.copy()  # As trackpy, the background of integer images is rounded down
+    result = np.array(image, dtype=float)
+    kernel = gaussian_kernel(noise_size, truncate)
+    for axis in range(image.ndim) if axes is None else axes:
+        if smoothing_size > 1:
+            ndimage.uniform_filter1d(background, smoothing_size, axis, output=background, mode='nearest')
+        if noise_size > 0:
+            ndimage.correlate1d(result, kernel, axis, output=result, mode='constant')
+    result -= background
+    result[result < threshold] = 0
+    return result
+
+
+def to_integer(image, dtype, scale_factor=None):
+    """ Scales a float image to fill the range of an integer type.
+
+    :param float scale_factor: Factor by which the image is scaled, by default the one that takes its maximum to the
+        maximum of the type
+    :return: the scale factor and the integer image. Integer images are returned as they are, with a factor 1.
+    """
+    if np.issubdtype(image.dtype, np.integer):
+        return 1., image
+    if scale_factor is None:
+        maximum = image.max()
+        scale_factor = np.iinfo(dtype).max / maximum if maximum > 0 else 1.
+    return scale_factor, (scale_factor * image.clip(min=0.)).astype(dtype)
+
+
+def running_max(image, before, after, axis):
+    """ Maximum over a window from ``before`` pixels before to ``after`` pixels after each pixel, along one axis. The
+    image is padded with zeros. The maximum over the window is built by doubling the span of the maximum at each step,
+    which takes a handful of vectorized operations whatever the size of the window.
+    """
+    size = before + after + 1
+    length = image.shape[axis]
+
+    def cut(start, stop):
+        index = [slice(None)] * image.ndim
+        index[axis] = slice(start, stop)
+        return tuple(index)
+
+    shape = list(image.shape)
+    shape[axis] += size - 1
+    result = np.zeros(shape, dtype=image.dtype)
+    result[cut(before, before + length)] = image
+    span = 1
+    while 2 * span <= size:  # Slices along the axis keep the arrays contiguous, moving the axis would not
+        result = np.maximum(result[cut(None, -span)], result[cut(span, None)])
+        span *= 2
+    if span < size:
+        result = np.maximum(result[cut(None, span - size)], result[cut(size - span, None)])
+    return result[cut(None, length)]
+
+
+def dilate(mask, radius):
+    """ Binary dilation of a mask with a circular neighborhood. The disk is split in rows, each row is a horizontal
+    running maximum shifted vertically.
+    """
+    mask = mask.view(np.uint8)
+    height = mask.shape[0]
+    result = np.zeros((height + 2 * radius, mask.shape[1]), dtype=np.uint8)
+    rows = {}
+    for dy in range(-radius, radius + 1):
+        half_width = int(np.sqrt(radius ** 2 - dy ** 2))
+        if half_width not in rows:
+            rows[half_width] = running_max(mask, half_width, half_width, axis=1)
+        target = result[radius + dy:radius + dy + height]
+        np.maximum(target, rows[half_width], out=target)
+    return result[radius:radius + height].view(bool)
+
+
+def percentile_threshold(image, percentile):
+    """ Percentile of the pixels of an integer image that are not black, with the same interpolation as
+    ``numpy.percentile``. It is computed from the histogram of the image, which avoids sorting the pixels.
+
+    :return: the threshold, ``nan`` if the image is black
+    """
+    if image.dtype.itemsize > 2 or image.dtype.kind != 'u':  # Too many bins for a histogram
+        not_black = image[image != 0]
+        return np.percentile(not_black, percentile) if len(not_black) else np.nan
+    counts = np.bincount(image.ravel())
+    counts[0] = 0
+    cumulative = np.cumsum(counts)
+    total = cumulative[-1]
+    if total == 0:
+        return np.nan
+    rank = (total - 1) * percentile / 100
+    lower = np.searchsorted(cumulative, int(np.floor(rank)), side='right')
+    upper = np.searchsorted(cumulative, int(np.ceil(rank)), side='right')
+    return lower + (upper - lower) * (rank - np.floor(rank))
+
+
+def find_maxima(image, separation, percentile, margin, threshold=None):
+    """ :param threshold: Only the maxima above it are kept, by default the percentile of the image
+    :return: array with the (y, x) coordinates of the brightest pixels of their neighborhood, excluding the ones
+        in the margin of the image.
+    """
+    if threshold is None:
+        threshold = percentile_threshold(image, percentile)
+    if np.isnan(threshold):
+        return np.empty((0, 2), dtype=int)
+    size = int(2 * separation / np.sqrt(2))
+    # The same as ndimage.grey_dilation(image, (size, size), mode='constant'), but several times faster
+    dilation = running_max(running_max(image, (size - 1) // 2, size // 2, axis=0), (size - 1) // 2, size // 2, axis=1)
+    maxima = (image == dilation) & (image > threshold)
+    height, width = image.shape
+    maxima[:margin] = False
+    maxima[height - margin:] = False
+    maxima[:, :margin] = False
+    maxima[:, width - margin:] = False
+    return np.column_stack(np.nonzero(maxima))
+
+
+def refine(raw_image, image, radius, coords, max_iterations=10, characterize=True, lower=None, upper=None):
+    """ Refines the center of mass of all the candidates at once. Each neighborhood is moved by one pixel while its
+    center of mass is more than :data:`SHIFT_THRESHOLD` pixels away from its center, up to ``max_iterations`` times.
+
+    :param lower: Lowest ``(y, x)`` coordinates to which the neighborhoods can move, for all the candidates or for each
+        of them. By default, the neighborhoods can move anywhere inside the image
+    :param upper: Highest ``(y, x)`` coordinates to which the neighborhoods can move
+    :return: record array with the locations, in the same order as the coordinates
+    """
+    dy, dx, r2, cos, sin = neighborhood(radius)
+    width = image.shape[1]
+    offsets = dy * width + dx
+    pixels = image.ravel()
+
+    coords = np.array(coords, dtype=np.intp)
+    lower = np.broadcast_to(radius if lower is None else lower, coords.shape)
+    upper = np.broadcast_to(np.array(image.shape) - radius - 1 if upper is None else upper, coords.shape)
+    corners = coords - radius  # Corner of the square enclosing the last neighborhood used of each candidate
+    centers = np.empty(coords.shape)
+    mass = np.empty(len(coords))
+    active = np.arange(len(coords))
+    for iteration in range(max(max_iterations, 1)):
+        corners[active] = coords[active] - radius
+        values = pixels[(corners[active, 0] * width + corners[active, 1])[:, np.newaxis] + offsets].astype(float)
+        mass[active] = values.sum(axis=1)
+        off_center = np.column_stack((values @ dy, values @ dx)) / mass[active, np.newaxis] - radius
+        centers[active] = coords[active] + off_center
+        moving = np.any(np.abs(off_center) >= SHIFT_THRESHOLD, axis=1)
+        active = active[moving]
+        if not len(active):
+            break
+        off_center = off_center[moving]
+        step = (off_center > SHIFT_THRESHOLD).astype(int) - (off_center < -SHIFT_THRESHOLD)
+        coords[active] = np.clip(coords[active] + step, lower[active], upper[active])
+
+    records = empty(len(coords))
+    records['y'] = centers[:, 0]
+    records['x'] = centers[:, 1]
+    records['mass'] = mass
+    if characterize:
+        index = (corners[:, 0] * width + corners[:, 1])[:, np.newaxis] + offsets
+        values = pixels[index].astype(float)
+        center = image[corners[:, 0] + radius, corners[:, 1] + radius]
+        records['size'] = np.sqrt(values @ r2 / mass)
+        records['ecc'] = np.hypot(values @ cos, values @ sin) / (mass - center + 1e-6)
+        records['signal'] = values.max(axis=1)
+        records['raw_mass'] = raw_image.ravel()[index].sum(axis=1)
+    return records
+
+
+def where_close(positions, separation, intensity):
+    """ :return: indices of the locations closer than ``separation`` to a brighter one. Of two equally bright
+        locations, the one closer to the top left corner is kept.
+    """
+    scaled = positions / separation
+    pairs = cKDTree(scaled, 30).query_pairs(1 - 1e-7, output_type='ndarray')
+    if not len(pairs):
+        return np.empty(0, dtype=int)
+    first, second = pairs[:, 0], pairs[:, 1]
+    position_order = np.where(scaled[first].sum(axis=1) > scaled[second].sum(axis=1), second, first)
+    to_drop = np.where(intensity[first] > intensity[second], second, first)
+    ties = intensity[first] == intensity[second]
+    to_drop[ties] = position_order[ties]
+    return np.unique(to_drop)
+
+
+def measure_noise(image, raw_image, radius, mask=None):
+    """ :param mask: Boolean array with the pixels that can be used, by default all of them
+    :return: mean and standard deviation of the raw image away from any feature of the processed one.
+    """
+    background = ~dilate(image != 0, radius)
+    if mask is not None:
+        background &= mask
+    background = raw_image[background]
+    if len(background) == 0:
+        return np.nan, np.nan
+    if len(background) == 1:
+        return background.mean(), np.nan
+    return background.mean(), background.std()
+
+
+def locate(raw_image, diameter, minmass=None, maxsize=None, separation=None, noise_size=1, smoothing_size=None,
+           threshold=None, invert=False, percentile=64, topn=None, preprocess=True, max_iterations=10,
+           characterize=True):
+    """ Locates the particles on an image. The arguments have the same meaning as for ``trackpy.locate``, but they
+    only accept a single value, not one per dimension.
+
+    :param raw_image: 2D image
+    :param int diameter: Diameter of the particles, in pixels. It must be odd
+    :return: record array with the locations, with ``frame`` and ``particle`` undefined
+    """
+    raw_image = check_image(raw_image, diameter, invert)
+    image = process(raw_image, diameter, noise_size, smoothing_size, threshold, preprocess)
+    return locate_processed(raw_image, image, diameter, minmass, maxsize, separation, noise_size, smoothing_size,
+                            percentile, topn, max_iterations, characterize)
+
+
+def check_image(raw_image, diameter, invert=False):
+    """ :return: the image as a 2D array, inverted if requested. The steps of :func:`locate` are split in this
+        function, :func:`process` and :func:`locate_processed`, for the tiles of
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling` to share the :func:`levels` of the whole image.
+    """
+    raw_image = np.squeeze(raw_image)
+    if raw_image.ndim != 2:
+        raise ValueError('Only 2D images are supported, use trackpy for images with {} dimensions'.format(
+            raw_image.ndim))
+    if not int(diameter) & 1:
+        raise ValueError('Feature diameter must be an odd integer. Round up.')
+    if invert:
+        is_float_image = not np.issubdtype(raw_image.dtype, np.integer)
+        raw_image = 1. - raw_image if is_float_image else raw_image ^ np.iinfo(raw_image.dtype).max
+    return raw_image
+
+
+def process(raw_image, diameter, noise_size=1, smoothing_size=None, threshold=None, preprocess=True, **kwargs):
+    """ :return: the image filtered by :func:`bandpass`, or the raw image if ``preprocess`` is ``False``. Arguments of
+        :func:`locate` not used here are ignored
+    """
+    if not preprocess:
+        return raw_image
+    smoothing_size = int(diameter) if smoothing_size is None else smoothing_size
+    if threshold is None:
+        threshold = 1 / 255. if not np.issubdtype(raw_image.dtype, np.integer) else 1
+    return bandpass(raw_image, noise_size, smoothing_size, threshold)
+
+
+def integer_type(raw_image):
+    """ :return: the integer type to which the processed image is scaled."""
+    return raw_image.dtype if np.issubdtype(raw_image.dtype, np.integer) else np.uint8
+
+
+def levels(raw_image, image, diameter, percentile=64, characterize=True, mask=None, **kwargs):
+    """ Levels of an image that :func:`locate_processed` computes otherwise on each image it receives.
+
+    :param raw_image: Image as returned by :func:`check_image`
+    :param image: Image as returned by :func:`process`
+    :param mask: Boolean array with the pixels used, by default all of them
+    :return: dictionary with the ``scale_factor``, the ``maxima_threshold`` and the ``noise`` of the image,
+        arguments of :func:`locate_processed`
+    """
+    scale_factor, image = to_integer(image, integer_type(raw_image))
+    maxima_threshold = percentile_threshold(image if mask is None else image[mask], percentile)
+    noise = measure_noise(image, raw_image, int(diameter) // 2, mask) if characterize else None
+    return {'scale_factor': scale_factor, 'maxima_threshold': maxima_threshold, 'noise': noise}
+
+
+def locate_processed(raw_image, image, diameter, minmass=None, maxsize=None, separation=None, noise_size=1,
+                     smoothing_size=None, percentile=64, topn=None, max_iterations=10, characterize=True,
+                     scale_factor=None, maxima_threshold=None, noise=None, **kwargs):
+    """ Locates the particles on an image already processed. The arguments are those of :func:`locate` and the
+    :func:`levels`, which are computed on the image if not given. Other arguments of :func:`locate` are ignored.
+
+    :return: record array with the locations, with ``frame`` and ``particle`` undefined
+    """
+    diameter = int(diameter)
+    radius = diameter // 2
+    separation = diameter + 1 if separation is None else separation
+    smoothing_size = diameter if smoothing_size is None else smoothing_size
+    minmass = 0 if minmass is None else minmass
+    scale_factor, image = to_integer(image, integer_type(raw_image), scale_factor)
+
+    margin = int(max(radius, separation // 2 - 1, smoothing_size // 2))
+    coords = find_maxima(image, separation, percentile, margin, maxima_threshold)
+    if not len(coords):
+        return empty()
+    records = refine(raw_image, image, radius, coords, max_iterations, characterize)
+    return filter_locations(records, image, raw_image, radius, separation, scale_factor, minmass, maxsize, topn,
+                            noise_size, characterize, noise)
+
+
+def filter_locations(records, image, raw_image, radius, separation, scale_factor, minmass=0, maxsize=None, topn=None,
+                     noise_size=1, characterize=True, noise=None):
+    """ Drops the locations too close to a brighter one and the ones that do not pass the filters of mass and size,
+    and estimates the error of the positions. The arguments are those of :func:`locate`.
+
+    :param records: Locations as returned by :func:`refine`
+    :param image: Processed image, scaled to integers
+    :param raw_image: Image used to measure the noise
+    :param float scale_factor: Factor by which the processed image was scaled
+    :param tuple noise: Mean and standard deviation of the background, by default measured on the images
+    :return: record array with the locations that passed the filters
+    """
+    if separation > 0:
+        records = np.delete(records, where_close(np.column_stack((records['y'], records['x'])), separation,
+                                                 records['mass']))
+    records['mass'] /= scale_factor
+    records['signal'] /= scale_factor
+    condition = records['mass'] > minmass
+    if maxsize is not None:
+        condition &= records['size'] < maxsize
+    records = records[condition]
+    if topn is not None and len(records) > topn:
+        records = records[np.argsort(records['mass'])[-topn:]]
+
+    if characterize and len(records):
+        black_level, noise = measure_noise(image, raw_image, radius) if noise is None else noise
+        mass = records['raw_mass'] - len(neighborhood(radius)[0]) * black_level
+        records['ep'] = noise / mass * noise_size * np.sqrt(x_squared_sum(radius))
+    return records
+
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Frame Cache
+===========
+The GUI shows the particles located on the frame it displays. While tracking, the locations are computed by the
+localization pool and published on ``locations`` some frames after the frame was acquired, therefore the GUI keeps
+the last frames acquired and the last locations received, both in a :class:`FrameCache` keyed by the number of the
+frame, and displays the newest frame found in both. Frames snapped while not tracking are localized only once, and
+their locations kept in the same kind of cache. The GUI process therefore does no localization while tracking.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import threading
+from collections import OrderedDict
+
+
+class FrameCache:
+    """ Keeps the data of the last ``size`` frames, by frame number. It can be filled and read from different threads.
+
+    :param int size: Maximum number of frames kept, the oldest are discarded first
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, frame_id, data):
+        with self._lock:
+            self._data[frame_id] = data
+            self._data.move_to_end(frame_id)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def get(self, frame_id, default=None):
+        with self._lock:
+            return self._data.get(frame_id, default)
+
+    def frame_ids(self):
+        """ :return: list with the numbers of the frames kept, from the oldest to the newest."""
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, frame_id):
+        with self._lock:
+            return frame_id in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+def newest_common(first, second):
+    """ :return: the newest frame number kept in both caches, or ``None`` if there is none."""
+    for frame_id in reversed(first.frame_ids()):
+        if frame_id in second:
+            return frame_id
+    return None
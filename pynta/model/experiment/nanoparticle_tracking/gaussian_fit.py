@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Gaussian Refinement
+===================
+The center of mass computed by ``trackpy.locate`` (and by the in-tree engines) is biased towards the center of the
+pixel where the refinement starts, specially for dim and small particles, which are the usual case in NTA. Fitting a
+2D Gaussian to each particle removes that bias, but fitting them one at a time is too slow for live tracking.
+
+This module fits all the particles of a frame at once. A window of ``diameter`` pixels is cut around each location,
+all the windows are stacked in an array of shape ``(n, k, k)`` and the Levenberg-Marquardt iterations are computed on
+the whole stack, with a damping factor for every particle. The model is a symmetric Gaussian on a constant
+background::
+
+    background + signal * exp(-((y - y0) ** 2 + (x - x0) ** 2) / (2 * size ** 2))
+
+fitted to the raw image. Fits that do not converge, or that converge far from the starting location, keep the center
+of mass. For the rest, the following columns of the locations (see
+:mod:`~pynta.model.experiment.nanoparticle_tracking.schema`) are replaced:
+
+* ``x`` and ``y``: the center of the Gaussian.
+* ``size``: its width (standard deviation), as in ``trackpy.refine_leastsq``. Note that the center of mass gives the
+  radius of gyration instead, which for a Gaussian is ``sqrt(2)`` times larger.
+* ``signal``: its amplitude above the background.
+* ``ep``: the uncertainty of the position, from the covariance of the fit.
+
+``mass`` and ``raw_mass`` are not changed, therefore ``minmass`` keeps its meaning. Select it with ``refinement:
+gaussian`` in the ``locate`` section of the tracking configuration.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.multires import cut_windows
+
+#: Value of ``refinement`` in the configuration of ``locate`` that selects this module
+REFINEMENT = 'gaussian'
+
+PARAMETERS = 5  # signal, y0, x0, size, background
+
+
+def gaussian(parameters, y, x):
+    """ Evaluates the model and its Jacobian.
+
+    :param parameters: Array of shape ``(n, 5)`` with ``signal, y0, x0, size, background`` of each particle
+    :param y: Coordinates of the pixels along the first axis, ``(k, 1)``
+    :param x: Coordinates of the pixels along the second axis, ``(1, k)``
+    :return: the model, ``(n, k, k)``, and the Jacobian, ``(n, k, k, 5)``
+    """
+    signal, y0, x0, size, background = (column[:, np.newaxis, np.newaxis] for column in parameters.T)
+    dy = y - y0
+    dx = x - x0
+    r2 = dy ** 2 + dx ** 2
+    spot = np.exp(-r2 / (2 * size ** 2))
+    scaled = signal * spot / size ** 2
+    jacobian = np.stack((spot, scaled * dy, scaled * dx, scaled * r2 / size, np.ones_like(spot)), axis=-1)
+    return background + signal * spot, jacobian
+
+
+def fit_gaussians(rois, initial, max_iterations=20, tolerance=1e-4):
+    """ Fits a symmetric 2D Gaussian on a constant background to each of a stack of images, with the
+    Levenberg-Marquardt algorithm.
+
+    :param rois: Images to fit, ``(n, k, k)``
+    :param initial: Starting parameters, ``(n, 5)``, as in :func:`gaussian`, with the coordinates in pixels of the
+        images
+    :param int max_iterations: Maximum number of iterations
+    :param float tolerance: The fit of an image stops once no parameter changes more than this, relative to its value
+    :return: the parameters ``(n, 5)``, their covariance ``(n, 5, 5)`` and a boolean array, ``True`` for the fits that
+        converged
+    """
+    rois = np.asarray(rois, dtype=float)
+    count, k = rois.shape[:2]
+    y = np.arange(k, dtype=float)[:, np.newaxis]
+    x = np.arange(k, dtype=float)[np.newaxis, :]
+    parameters = np.array(initial, dtype=float).reshape(count, PARAMETERS)
+    damping = np.full(count, 1e-3)
+    converged = np.zeros(count, dtype=bool)
+    model, jacobian = gaussian(parameters, y, x)
+    residuals = (rois - model).reshape(count, -1)
+    cost = np.einsum('ij,ij->i', residuals, residuals)
+    jacobian = jacobian.reshape(count, -1, PARAMETERS)
+    identity = np.eye(PARAMETERS)
+    for iteration in range(max_iterations):
+        active = ~converged
+        if not active.any():
+            break
+        j = jacobian[active]
+        hessian = np.swapaxes(j, 1, 2) @ j
+        gradient = (np.swapaxes(j, 1, 2) @ residuals[active, :, np.newaxis])[..., 0]
+        scaled = hessian + damping[active, np.newaxis, np.newaxis] * hessian * identity
+        try:
+            step = np.linalg.solve(scaled, gradient[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:  # For example, a signal of zero makes the position irrelevant
+            step = np.einsum('nij,nj->ni', np.linalg.pinv(scaled), gradient)
+        trial = parameters[active] + step
+        trial_model, trial_jacobian = gaussian(trial, y, x)
+        trial_residuals = (rois[active] - trial_model).reshape(len(trial), -1)
+        trial_cost = np.einsum('ij,ij->i', trial_residuals, trial_residuals)
+        better = np.isfinite(trial_cost) & (trial_cost <= cost[active])
+
+        indices = np.flatnonzero(active)
+        accepted = indices[better]
+        parameters[accepted] = trial[better]
+        residuals[accepted] = trial_residuals[better]
+        cost[accepted] = trial_cost[better]
+        jacobian[accepted] = trial_jacobian.reshape(len(trial), -1, PARAMETERS)[better]
+        damping[accepted] /= 10
+        damping[indices[~better]] *= 10
+        small = np.all(np.abs(step) <= tolerance * np.maximum(np.abs(trial), 1), axis=1)
+        converged[indices[small & better]] = True
+
+    hessian = np.swapaxes(jacobian, 1, 2) @ jacobian
+    variance = cost / max(k * k - PARAMETERS, 1)
+    with np.errstate(invalid='ignore'):
+        covariance = np.linalg.pinv(hessian, hermitian=True) * variance[:, np.newaxis, np.newaxis]
+    return parameters, covariance, converged & np.all(np.isfinite(parameters), axis=1)
+
+
+def refine_gaussian(raw_image, records, diameter, invert=False, max_iterations=20):
+    """ Refines the locations of the particles on an image by fitting a Gaussian to each of them, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.gaussian_fit`.
+
+    :param raw_image: The image, not filtered
+    :param records: Record array with the locations found on the image
+    :param int diameter: Diameter of the particles, also the size of the fitted windows
+    :param bool invert: Whether the particles are darker than the background
+    :param int max_iterations: Maximum number of iterations of the fit
+    :return: a copy of the record array with the refined locations
+    """
+    records = records.copy()
+    if not len(records):
+        return records
+    radius = int(diameter) // 2
+    centers = np.column_stack((np.rint(records['y']), np.rint(records['x']))).astype(int)
+    rois = cut_windows(np.squeeze(raw_image), centers, radius).astype(float)
+    if invert:
+        rois = -rois  # The background of the fit absorbs the offset
+
+    edges = np.concatenate((rois[:, 0], rois[:, -1], rois[:, 1:-1, 0], rois[:, 1:-1, -1]), axis=1)
+    background = np.median(edges, axis=1)
+    size = records['size'] / np.sqrt(2)  # Radius of gyration of a Gaussian
+    size = np.where(np.isfinite(size) & (size > 0.5), size, max(radius / 2, 1))
+    initial = np.column_stack((rois.max(axis=(1, 2)) - background, records['y'] - centers[:, 0] + radius,
+                               records['x'] - centers[:, 1] + radius, size, background))
+    parameters, covariance, valid = fit_gaussians(rois, initial, max_iterations)
+
+    signal, y, x, size, background = parameters.T
+    valid &= (signal > 0) & (np.abs(size) >= 0.3) & (np.abs(size) <= radius)
+    valid &= (np.abs(y - radius) <= radius) & (np.abs(x - radius) <= radius)
+    error = np.sqrt((covariance[:, 1, 1] + covariance[:, 2, 2]) / 2)
+    valid &= np.isfinite(error)
+    records['y'][valid] = y[valid] + centers[valid, 0] - radius
+    records['x'][valid] = x[valid] + centers[valid, 1] - radius
+    records['size'][valid] = np.abs(size[valid])
+    records['signal'][valid] = signal[valid]
+    records['ep'][valid] = error[valid]
+    return records
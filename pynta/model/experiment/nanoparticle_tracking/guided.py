@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Guided Localization
+===================
+Once the particles are linked, their positions on the next frame are known to within a few pixels, yet every frame is
+localized over the whole image. For sparse samples most of that time is spent on empty background. In guided mode,
+the workers of the localization pool follow the positions published by the linker on ``particle_links``:
+
+* Each frame is localized only in windows of ``window`` pixels around the last position of every particle linked.
+  Windows that touch each other are merged in a single region, localized and stitched as the tiles of
+  :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`.
+* Every ``full_frame`` frames, the whole frame is localized, to pick up particles that entered the field of view.
+* The whole frame is also localized while there are no positions, or if they were linked more than ``max_lag``
+  frames before the current one (for example, if the linker is not running or it is lagging behind).
+
+The prediction is the last position of each particle. Localization runs a few frames ahead of the linking, therefore
+``window`` has to cover the displacement of the particles during those frames, not only between two frames.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+from scipy import ndimage
+
+from pynta.model.experiment.nanoparticle_tracking.tiling import extend
+from pynta.model.experiment.subscriber import subscribe, LATEST
+
+
+def window_bounds(shape, positions, window, margin):
+    """ Regions of an image around a list of positions. The image is divided in cells of ``window`` pixels, the cells
+    within ``window`` pixels of a position are selected and groups of adjacent cells are merged in a region.
+
+    :param tuple shape: Shape of the image
+    :param positions: Array with the ``(y, x)`` coordinates of the positions
+    :param int window: Distance around each position that is included in the regions, in pixels
+    :param int margin: Pixels added to every side of the regions
+    :return: list with the ``(window, area)`` of each region, as in
+        :func:`~pynta.model.experiment.nanoparticle_tracking.tiling.tile_bounds`
+    """
+    cell = max(int(window), 1)
+    grid = np.zeros((-(-shape[0] // cell), -(-shape[1] // cell)), dtype=bool)
+    positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+    for dy in (-cell, 0, cell):  # A window spans at most three cells along each axis
+        rows = np.clip((positions[:, 0] + dy) // cell, 0, grid.shape[0] - 1).astype(int)
+        for dx in (-cell, 0, cell):
+            columns = np.clip((positions[:, 1] + dx) // cell, 0, grid.shape[1] - 1).astype(int)
+            grid[rows, columns] = True
+    labels, count = ndimage.label(grid, structure=np.ones((3, 3)))
+    bounds = []
+    for rows, columns in ndimage.find_objects(labels):
+        area = (rows.start * cell, min(rows.stop * cell, shape[0]),
+                columns.start * cell, min(columns.stop * cell, shape[1]))
+        bounds.append((extend(area, margin, shape), area))
+    return bounds
+
+
+class Guide:
+    """ Keeps the last positions published by the linker and decides which regions of each frame to localize.
+
+    :param address: Address of the publisher, ``None`` to feed the positions with :meth:`linked`
+    :param int window: Distance around the last position of each particle in which it is searched, in pixels
+    :param int full_frame: The whole frame is localized when its number is a multiple of this one
+    :param int max_lag: Maximum number of frames between the positions and the frame being localized
+    """
+    def __init__(self, address=None, window=15, full_frame=10, max_lag=10):
+        self.window = window
+        self.full_frame = full_frame
+        self.max_lag = max_lag
+        self.positions = None
+        self.frame = None
+        self.subscription = None
+        if address is not None:
+            self.subscription = subscribe(address, 'particle_links', qos={'policy': LATEST},
+                                          name='localization.guide')
+
+    def linked(self, records, frame_id):
+        """ Stores the positions of the particles linked on a frame."""
+        self.positions = np.column_stack((records['y'], records['x']))
+        self.frame = frame_id
+
+    def update(self):
+        """ Takes the last positions published on ``particle_links``, if any."""
+        if self.subscription is None:
+            return
+        message = self.subscription.recv(timeout=0)
+        if message is not None and not isinstance(message[1], str):
+            timestamp, records, frame_id = message[1]
+            self.linked(records, frame_id)
+
+    def bounds(self, shape, frame_id, margin):
+        """ :return: the regions of the frame to localize, as in :func:`window_bounds`, or ``None`` to localize the
+            whole frame.
+        """
+        self.update()
+        if self.positions is None or frame_id is None or not 0 <= frame_id - self.frame <= self.max_lag:
+            return None
+        if self.full_frame and frame_id % self.full_frame == 0:
+            return None
+        return window_bounds(shape, self.positions, self.window, margin)
+
+    def close(self):
+        if self.subscription is not None:
+            self.subscription.close()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Load Shedding
+=============
+If the localization can not keep up with the camera, frames pile up in the buffers of the bus and the delay between
+the live view and the tracks grows without bound. A :class:`LoadShedder` measures how far behind the localization is
+and, past a threshold, starts skipping frames. It measures:
+
+* ``lag``: the time between acquiring a frame (its timestamp) and publishing its locations, in seconds.
+* ``backlog``: the frames handed out to be located that are not finished yet.
+
+and switches among the following policies, from the lightest to the heaviest:
+
+* ``all``: every frame is located.
+* ``every_k``: only one of every ``k`` frames is located.
+* ``latest``: every frame waiting in the buffers is discarded, except for the newest one. Frames are handed out
+  only while less than ``in_flight`` are being located (usually one per worker), otherwise they would wait in the
+  buffers of the pool and be old when located.
+
+The policy moves one step towards ``latest`` when the lag or the backlog exceed ``max_lag`` or ``max_backlog``, and
+one step back once both are below half of them. Policies change at most once every ``hold`` seconds, so that the
+measurements reflect the current policy before deciding again.
+
+The frames skipped are published on ``skipped_frames``, as ``[timestamp, frame_ids]``, and counted in the
+``skipped`` field of the telemetry, which also reports the current policy, lag and backlog. The locations keep the
+number of their frame, therefore the gaps are explicit: the linker widens its search range with the number of frames
+skipped, and the MSD takes the time between frames from their numbers.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+from time import time
+
+import numpy as np
+
+from pynta.model.experiment.shared_frames import SharedFrame
+from pynta.util import get_logger
+
+ALL = 'all'
+EVERY_K = 'every_k'
+LATEST = 'latest'
+POLICIES = (ALL, EVERY_K, LATEST)
+
+SKIPPED_TOPIC = 'skipped_frames'
+DRAIN_SIZE = 1000  # Maximum number of frames discarded at once by the latest policy
+
+
+def frame_info(data):
+    """ :return: the timestamp and the number of a frame published on the bus, either a
+        :class:`~pynta.model.experiment.shared_frames.SharedFrame` or ``[timestamp, image, frame_id]``.
+    """
+    if isinstance(data, SharedFrame):
+        return data.timestamp, data.frame_id
+    return data[0], data[2] if len(data) > 2 else None
+
+
+class LoadShedder:
+    """ Decides which frames to locate depending on how far behind the localization is, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.load_shedding`.
+
+    :param float max_lag: Time between acquiring a frame and publishing its locations above which frames are skipped
+    :param int max_backlog: Frames being located above which frames are skipped
+    :param int k: Frames kept by the ``every_k`` policy, one every ``k``
+    :param policies: Policies to go through, from the lightest to the heaviest
+    :param float hold: Minimum time between changes of policy, in seconds
+    :param int in_flight: Maximum number of frames being located with the ``latest`` policy
+    :param publisher_queue: Queue (or :class:`~pynta.model.experiment.publisher.PublisherSocket`) to publish the
+        frames skipped, ``None`` to not publish them
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` in which the skipped frames are counted
+    """
+    def __init__(self, max_lag=1, max_backlog=20, k=2, policies=POLICIES, hold=2, in_flight=1, publisher_queue=None,
+                 telemetry=None):
+        for policy in policies:
+            if policy not in POLICIES:
+                raise ValueError('Unknown load shedding policy {}, it must be one of {}'.format(policy, POLICIES))
+        self.max_lag = max_lag
+        self.max_backlog = max_backlog
+        self.k = max(int(k), 1)
+        self.policies = list(policies) or [ALL]
+        self.hold = hold
+        self.in_flight = in_flight
+        self.publisher_queue = publisher_queue
+        self.telemetry = telemetry
+        self.logger = get_logger(name=__name__)
+
+        self.level = 0
+        self.lag = 0.
+        self.handed_out = 0
+        self.finished = 0
+        self.skipped = 0
+        self._changed = time()
+        self._count = 0  # Frames seen by the every_k policy
+        self._report_state()
+
+    @property
+    def policy(self):
+        return self.policies[self.level]
+
+    @property
+    def backlog(self):
+        return self.handed_out - self.finished
+
+    def can_start(self):
+        """ :return: whether more frames can be handed out to be located."""
+        return self.policy != LATEST or self.backlog < self.in_flight
+
+    def started(self, count=1):
+        """ Counts frames handed out to be located."""
+        self.handed_out += count
+
+    def done(self, timestamp=None, count=1):
+        """ Counts frames whose locations were published (or given up), acquired at ``timestamp``. It can be called
+        from another thread than the rest of the methods.
+        """
+        self.finished += count
+        if timestamp is not None:
+            self.lag = time() - timestamp
+
+    def update(self):
+        """ Changes the policy if the localization fell behind or caught up.
+
+        :return: the current policy
+        """
+        now = time()
+        if now - self._changed < self.hold:
+            return self.policy
+        level = self.level
+        if self.lag > self.max_lag or self.backlog > self.max_backlog:
+            level = min(level + 1, len(self.policies) - 1)
+        elif self.lag < self.max_lag / 2 and self.backlog <= self.max_backlog / 2:
+            level = max(level - 1, 0)
+        if level != self.level:
+            self.logger.info('Localization lag {:.2f}s, backlog {} frames: switching from {} to {}'.format(
+                self.lag, self.backlog, self.policy, self.policies[level]))
+            self.level = level
+            self._changed = now
+            self._count = 0
+        self._report_state()
+        return self.policy
+
+    def select(self, batch):
+        """ Selects the frames to locate according to the current policy.
+
+        :param list batch: Frames received from the bus, in order
+        :return: list with the frames to locate
+        """
+        policy = self.update()
+        if policy == LATEST:
+            kept = batch[-1:]
+        elif policy == EVERY_K:
+            kept = [data for i, data in enumerate(batch, self._count) if i % self.k == 0]
+            self._count = (self._count + len(batch)) % self.k
+        else:
+            kept = batch
+        if len(kept) < len(batch):
+            kept_ids = {id(data) for data in kept}
+            self.skip([data for data in batch if id(data) not in kept_ids])
+        return kept
+
+    def recv(self, subscription, batch_size=1, batch_time=0, timeout=None):
+        """ Receives frames from a subscription and selects the ones to locate. Strings, such as the signal to stop the
+        saver, are discarded. With the ``latest`` policy, every frame already waiting in the subscription is received
+        and discarded, except for the newest.
+
+        :return: list with the data of the frames to locate
+        """
+        if self.policy == LATEST:
+            batch_size, batch_time = DRAIN_SIZE, 0
+        batch = [data for topic, data in subscription.recv_batch(batch_size, batch_time, timeout=timeout)
+                 if not isinstance(data, str)]
+        return self.select(batch) if batch else batch
+
+    def skip(self, frames):
+        """ Records frames that are not located."""
+        self.skipped += len(frames)
+        if self.telemetry is not None:
+            self.telemetry.skipped(len(frames))
+        if self.publisher_queue is not None:
+            info = [frame_info(data) for data in frames]
+            timestamp = info[-1][0]
+            frame_ids = np.array([frame_id for _, frame_id in info if frame_id is not None], dtype=np.int64)
+            self.publisher_queue.put({'topic': SKIPPED_TOPIC, 'data': [timestamp, frame_ids]})
+
+    def _report_state(self):
+        if self.telemetry is not None:
+            self.telemetry.state.update(policy=self.policy, lag=self.lag, backlog=self.backlog)
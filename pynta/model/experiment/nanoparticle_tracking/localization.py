@@ -10,10 +10,10 @@ the processes running. Moreover, there is a combination of threads and processes
 It has to be noted that Windows has a peculiar way of dealing with new processes that prevents us from using methods,
 but instead we are forced to use functions. This is very limiting but couldn't find a way around yet.
 
-The core idea is that the localization uses the data broadcasted by :class:`~nanoparticle_tracking.model.experiment.publisher.Publisher`
-in order to collect new frames, or save localizations to disk. It uses the
-:class:`~nanoparticle_tracking.model.experiment.subscriber.Subscriber` in order to listen for the new data, and in turn publishes it
-with the Publisher.
+The core idea is that the localization uses the data broadcasted by
+:class:`~nanoparticle_tracking.model.experiment.publisher.Publisher` in order to collect new frames, or save
+localizations to disk. It uses the :class:`~nanoparticle_tracking.model.experiment.subscriber.Subscriber` in order to
+listen for the new data, and in turn publishes it with the Publisher.
 
 :copyright:  Aquiles Carattino <aquiles@uetke.com>
 :license: GPLv3, see LICENSE for more details
@@ -24,38 +24,63 @@ from datetime import datetime
 import h5py
 import numpy as np
 import trackpy as tp
-from multiprocessing import Process, Event
-from time import sleep, time
-from pandas import DataFrame
-from scipy.stats import stats
-from trackpy.linking import Linker
+import threading
+from multiprocessing import Process, Event, Queue
+from queue import Empty
+from time import sleep
 
 from pynta import general_stop_event
 from pynta.model.experiment.nanoparticle_tracking.decorators import make_async_thread
 from pynta.model.experiment.nanoparticle_tracking.exceptions import DiameterNotDefined, LinkException
-from pynta.model.experiment.subscriber import subscribe
+from pynta.model.experiment.nanoparticle_tracking.frame_cache import FrameCache
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import distribute_frames, locate, locate_frames
+from pynta.model.experiment.nanoparticle_tracking.schema import LOCATIONS_DTYPE, SCHEMA_VERSION
+from pynta.model.experiment.nanoparticle_tracking.msd import IncrementalMSD, MAX_LAGTIME
+from pynta.model.experiment.nanoparticle_tracking.track_store import TrackStore
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import StreamingLinker, TRAJECTORIES_TOPIC
+from pynta.model.experiment.publisher import STOP_CHECK_INTERVAL
+from pynta.model.experiment.subscriber import get_qos, subscribe, wait_ready, START_TIMEOUT, STOP_TIMEOUT
+from pynta.model.experiment.telemetry import Telemetry
 from pynta.util import get_logger
 
 
+CACHED_LOCATIONS = 64  # Frames whose locations are kept for the GUI, see LocateParticles.recent_locations
+
+
 class LocateParticles:
     """ Convenience class to keep track of processes and threads related to the localization of particles.
     The idea was to make it more robust when stopping processes and to give a common interface to the experiment in
      case radical changes are implemented. For example, changing tracking or linking algorithms, etc.
+
+     :param publisher: The publisher of the experiment
+     :param dict config: The ``tracking`` section of the configuration
+     :param dict qos: The ``qos`` entry of the ``bus`` section of the configuration
+     :param float stats_interval: Seconds between the statistics that each process publishes on ``stats``
      """
-    def __init__(self, publisher, config):
+    def __init__(self, publisher, config, qos=None, stats_interval=None):
         self._accumulate_links_event = Event()
+        self._accumulate_links_ready = threading.Event()
+        self._cache_locations_event = threading.Event()
+        self._cache_locations_ready = threading.Event()
         self.publisher = publisher
         self._tracking_process = None
+        self._tracking_workers = []
         self._tracking_event = Event()
         self._linking_process = None
         self._linking_event = Event()
         self._saving_process = None
         self._saving_event = Event()
         self.config = config
+        self.qos = qos
+        self.stats_interval = stats_interval
 
-        self.locations = DataFrame()
+        self.tracks = TrackStore()  # Links received on particle_links, see the links and locations properties
         self.particle_ids = None
+        #: Locations of the last frames published on ``locations``, by frame number
+        self.recent_locations = FrameCache(CACHED_LOCATIONS)
 
+        #: Mean squared displacement of every particle, updated with the links, see calculate_histogram
+        self.msd = IncrementalMSD(config.get('process', {}).get('max_lagtime', MAX_LAGTIME))
         self.calculating_histograms = False
         self.histogram_values = []
 
@@ -64,9 +89,18 @@ class LocateParticles:
         self.logger = get_logger(name=__name__)
         self.logger.info('Initialized locate particles')
 
+    def telemetry(self, name):
+        """ :return: a :class:`~pynta.model.experiment.telemetry.Telemetry` that publishes through the publisher."""
+        return Telemetry(name, self.publisher.queue, self.stats_interval)
+
     def start_tracking(self, topic):
-        """ Starts a process that listens for frames on a specific topic. It uses the function
-        :func:`~calculate_locations`. The process is stored in ``self._trackings_process`` and is automatically started.
+        """ Starts a pool of processes that locate the particles on the frames published on a specific topic, see
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.localization_pool`. The number of workers is set by
+        ``workers`` in the ``tracking`` section of the configuration, and the frames are handed out in micro-batches of
+        at most ``batch_size`` frames collected within ``batch_time`` seconds. If ``shedding`` is enabled, frames are
+        skipped when the pool falls behind the camera. The process that hands out the frames is stored in
+        ``self._tracking_process`` and the workers in ``self._tracking_workers``. The locations published are kept in
+        :attr:`recent_locations`. It returns once the pool is receiving frames.
 
         :param str topic: Topic in which to listen for new frames.
 
@@ -74,12 +108,62 @@ class LocateParticles:
         """
 
         self.logger.debug('Started tracking')
+        if 'diameter' not in self.config['locate']:
+            raise DiameterNotDefined('A diameter is mandatory for locating particles')
         self._tracking_event.clear()
+        ready = Event()
+        addresses = Queue()
+        shedding = dict(self.config.get('shedding') or {})
+        shedding = dict(shedding, in_flight=self.config.get('workers', 1)) if shedding.pop('enabled', False) else None
         self._tracking_process = Process(
-            target=calculate_locations,
-            args=[self.publisher.port, topic, self._tracking_event, self.publisher._queue],
-            kwargs=copy(self.config['locate']))
+            target=distribute_frames,
+            args=[self.publisher.address, topic, self._tracking_event, self.publisher.queue, addresses,
+                  self.publisher.transport],
+            kwargs={'qos': get_qos(self.qos, topic, 'localization'), 'ready': ready,
+                    'telemetry': self.telemetry('localization'), 'batch_size': self.config.get('batch_size', 1),
+                    'batch_time': self.config.get('batch_time', 0), 'shedding': shedding})
         self._tracking_process.start()
+        try:
+            frames_address, results_address = addresses.get(timeout=START_TIMEOUT)
+        except Empty:
+            self.logger.error('The localization did not start after {}s'.format(START_TIMEOUT))
+            return
+        guide = dict(self.config.get('guide') or {})
+        guide = dict(guide, address=self.publisher.address) if guide.pop('enabled', False) else None
+        workers_ready = []
+        self._tracking_workers = []
+        for i in range(self.config.get('workers', 1)):
+            workers_ready.append(Event())
+            self._tracking_workers.append(Process(
+                target=locate_frames,
+                args=[frames_address, results_address, self._tracking_event],
+                kwargs=dict(copy(self.config['locate']), ready=workers_ready[-1],
+                            telemetry=self.telemetry('localization.{}'.format(i)), tiles=self.config.get('tiles'),
+                            tile_threads=self.config.get('tile_threads', 1), guide=guide)))
+            self._tracking_workers[-1].start()
+        self._cache_locations_ready.clear()
+        self.cache_locations()
+        wait_ready(self._cache_locations_ready, self._threads[-1][1])
+        wait_ready(ready, self._tracking_process)
+        for worker, worker_ready in zip(self._tracking_workers, workers_ready):
+            wait_ready(worker_ready, worker)
+
+    @make_async_thread
+    def cache_locations(self):
+        """ Keeps the locations published on ``locations`` in :attr:`recent_locations`, until the tracking stops. The
+        GUI uses them to show the particles on the frames it displays instead of locating them again.
+        """
+        self._cache_locations_event.clear()
+        self.recent_locations.clear()
+        subscription = subscribe(self.publisher.local_address, 'locations',
+                                 qos=get_qos(self.qos, 'locations', 'gui'), name='cache_locations',
+                                 ready=self._cache_locations_ready, telemetry=self.telemetry('cache_locations'))
+        while not self._cache_locations_event.is_set():
+            if general_stop_event.is_set():
+                break
+            for topic, (timestamp, records, frame_id) in subscription.recv_batch(timeout=STOP_CHECK_INTERVAL):
+                self.recent_locations.put(frame_id, records)
+        subscription.close()
 
     def stop_tracking(self):
         """ Stops the tracking process by setting a particular event.
@@ -87,6 +171,7 @@ class LocateParticles:
         .. TODO:: This is a hard stop, i.e., tracking will stop immediately. Perhaps it would be wise to clear the queue.
         """
         self._tracking_event.set()
+        self._cache_locations_event.set()
 
     def start_saving(self, file_path, meta):
         """ Starts a process for saving localizations to an HDF5 file. It uses the function :func:`~save_locations`.
@@ -97,10 +182,14 @@ class LocateParticles:
         .. TODO:: Implement a lock to prevent a second process starting
         """
         self._saving_event.clear()
+        ready = Event()
         self._saving_process = Process(
             target=save_locations,
-            args=[file_path, meta, self.publisher.port, self._saving_event])
+            args=[file_path, meta, self.publisher.address, self._saving_event],
+            kwargs={'qos': get_qos(self.qos, 'locations', 'saver'), 'ready': ready,
+                    'telemetry': self.telemetry('locations_saver')})
         self._saving_process.start()
+        wait_ready(ready, self._saving_process)
 
     def stop_saving(self):
         """ Stops the saving process.
@@ -112,20 +201,28 @@ class LocateParticles:
     def start_linking(self):
         """ Starts a process to link the localizations of particles. It publishes the track information as a table,
         with the frame and particle number appended to the rightmost columns respectively. This particular task may be
-        very time consuming.
+        very time consuming. Complete trajectories with at least ``min_length`` locations, from the ``filter`` section
+        of the configuration, are published on ``trajectories``, see
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.streaming_linker`.
 
         .. warning:: Linking tracks can block a process if there are too many particles with a very large search radius.
             If linking is too slow consider saving the localizations and link them afterwards.
         """
         self.logger.debug('Started the linking process')
         self._linking_event.clear()
+        ready = Event()
         self._linking_process = Process(
             target=link_locations,
-            args=[self.publisher.port, 'locations', self._linking_event, self.publisher._queue],
-            kwargs=copy(self.config['link'])
+            args=[self.publisher.address, 'locations', self._linking_event, self.publisher.queue,
+                  get_qos(self.qos, 'locations', 'linker'), ready],
+            kwargs=dict(copy(self.config['link']), min_length=self.config.get('filter', {}).get('min_length', 1),
+                        telemetry=self.telemetry('linker'))
         )
         self._linking_process.start()
+        self._accumulate_links_ready.clear()
         self.accumulate_links()
+        wait_ready(self._accumulate_links_ready, self._threads[-1][1])
+        wait_ready(ready, self._linking_process)
 
     @make_async_thread
     def accumulate_links(self):
@@ -137,17 +234,34 @@ class LocateParticles:
             program
         """
         self._accumulate_links_event.clear()
-        socket = subscribe(self.publisher.port, 'particle_links')
+        subscription = subscribe(self.publisher.local_address, 'particle_links',
+                                 qos=get_qos(self.qos, 'particle_links', 'accumulator'), name='accumulate_links',
+                                 ready=self._accumulate_links_ready, telemetry=self.telemetry('accumulate_links'))
         while not self._accumulate_links_event.is_set():
             if general_stop_event.is_set():
                 break
 
-            topic = socket.recv_string()
-            data = socket.recv_pyobj()
-            if self.locations.shape[0] == 0:
-                self.locations = data[0]
-            else:
-                self.locations = self.locations.append(data[0])
+            batch = subscription.recv_batch(timeout=STOP_CHECK_INTERVAL)
+            if not batch:
+                continue
+            links = np.concatenate([data[1] for topic, data in batch])
+            self.tracks.append(links)
+            process = self.config['process']
+            self.msd.update(links, process['min_mass'], process['max_size'], process['max_ecc'])
+        subscription.close()
+
+    @property
+    def links(self):
+        """ Record array with all the links accumulated so far, built when requested. The links of a single particle
+        are read faster with ``self.tracks.track(particle)``, see
+        :class:`~pynta.model.experiment.nanoparticle_tracking.track_store.TrackStore`.
+        """
+        return self.tracks.records()
+
+    @property
+    def locations(self):
+        """ The accumulated links as a DataFrame, built when requested. """
+        return self.tracks.to_dataframe()
 
     def stop_accumulate_links(self):
         self._accumulate_links_event.set()
@@ -155,36 +269,16 @@ class LocateParticles:
     @make_async_thread
     def calculate_histogram(self):
         """ Starts a new thread to calculate the histogram of fit-parameters based on the mean-squared displacement of
-        individual particles. It publishes the data on topic `histogram`.
+        individual particles. It publishes the data on topic `histogram`, as a list with the slope and intercept of
+        ``log(msd)`` against ``log(t)`` of every particle, with the MSD in square microns and the time in seconds.
 
-        .. warning:: This method is incredibly expensive. Since it runs on a thread it can block other pieces of code,
-        especially the GUI, which runs on the same process.
-
-        .. TODO:: The histogram loops over all the particles. It would be better to skeep particles for which there is
-            no new data
-
-        .. TODO:: Make this method able to run on a separate process. So far is not possible because it relies on data
-            stored on the class itself (`self.locations`).
+        The mean-squared displacements are accumulated in :attr:`msd` as the links arrive, and only the particles with
+        new displacements are fitted again, therefore it takes milliseconds regardless of the length of the
+        measurement, see :mod:`~pynta.model.experiment.nanoparticle_tracking.msd`.
         """
         self.calculating_histograms = True
-        locations = self.locations.copy()
-        t1 = tp.filter_stubs(locations, self.config['process']['min_traj_length'])
-        t2 = t1[((t1['mass'] > self.config['process']['min_mass']) & (t1['size'] < self.config['process']['max_size']) &
-                 (t1['ecc'] < self.config['process']['max_ecc']))]
-        im = tp.imsd(t2, self.config['process']['um_pixel'], self.config['process']['fps'])
-        self.histogram_values = []
-        for pcle in im:
-            if general_stop_event.is_set():
-                break
-
-            data = im[pcle]
-            t = data.index[~np.isnan(data.values)]
-            val = data.values[~np.isnan(data.values)]
-            try:
-                slope, intercept, r, p, stderr = stats.linregress(np.log(t), np.log(val))
-                self.histogram_values.append([slope, intercept])
-            except:
-                pass
+        process = self.config['process']
+        self.histogram_values = self.msd.fits(process['um_pixel'], process['fps'], process['min_traj_length']).tolist()
         self.calculating_histograms = False
         self.publisher.publish('histogram', self.histogram_values)
 
@@ -192,7 +286,7 @@ class LocateParticles:
         """ Returns the relevant tracks as filtered by length, eccentricity, size and mass. This step needs careful
         consideration and should definitely be used in post-processing or once the parameters have been validated.
         """
-        locations = self.locations.copy()
+        locations = self.locations
         t1 = tp.filter_stubs(locations, self.config['process']['min_traj_length'])
         t2 = t1[((t1['mass'] > self.config['process']['min_mass']) & (t1['size'] < self.config['process']['max_size']) &
                  (t1['ecc'] < self.config['process']['max_ecc']))]
@@ -202,14 +296,20 @@ class LocateParticles:
         self._linking_event.set()
 
     def finalize(self):
-        """ Stops all the processes and threads. It should be invoked when finishing a measurement or when stopping an
-        acquisition.
+        """ Stops all the processes and threads and waits for them to finish. It should be invoked when finishing a
+        measurement or when stopping an acquisition.
         """
         self.stop_saving()
         self.stop_tracking()
         self.stop_linking()
         self.stop_accumulate_links()
+        for process in [self._saving_process, self._tracking_process, self._linking_process] + self._tracking_workers:
+            if process is not None:
+                process.join(STOP_TIMEOUT)
+                if process.is_alive():
+                    self.logger.warning('Process {} did not finish in {}s'.format(process.name, STOP_TIMEOUT))
         for thread in self._threads:
+            thread[1].join(STOP_TIMEOUT)
             if thread[1].is_alive():
                 self.logger.warning('Finalizing a running thread: {}'.format(thread[0]))
 
@@ -218,46 +318,28 @@ class LocateParticles:
         self.stop_saving()
 
 
-def calculate_locations(port, topic, event, publisher_queue, **kwargs):
-    socket = subscribe(port, topic)
-    if 'diameter' not in kwargs:
-        raise DiameterNotDefined('A diameter is mandatory for locating particles')
-
-    while not event.is_set():
-        socket.recv_string()
-        data = socket.recv_pyobj()  # flags=0, copy=True, track=False)
-        image = data[1]  # image[0] is the timestamp of the frame
-        # t0 = time()
-        locations = tp.locate(image, **kwargs)
-        # loc_time = time()-t0
-        publisher_queue.put({'topic': 'locations', 'data': locations})
-        # publisher_queue.put({'topic': 'locations_time', 'data': [loc_time, len(locations)]})
-
-
-def save_locations(file_path, meta, port, event, topic='locations'):
-    socket = subscribe(port, topic)
+def save_locations(file_path, meta, address, event, topic='locations', qos=None, ready=None, telemetry=None):
+    subscription = subscribe(address, topic, qos=qos, name='locations_saver', ready=ready, telemetry=telemetry)
     with h5py.File(file_path, 'a') as f:
         now = str(datetime.now())
         g = f.create_group(now)
         g.create_dataset('metadata', data=meta.encode('ascii', 'ignore'))
+        dset = g.create_dataset('locations', (0,), maxshape=(None,), dtype=LOCATIONS_DTYPE, chunks=True)
+        dset.attrs['schema_version'] = SCHEMA_VERSION
         f.flush()
-        i = 0
         last_x = 0
         while not event.is_set():
-            topic = socket.recv_string()
-            data = socket.recv_pyobj()
-            data = data.values
-            data = data
-            x, y = data.shape[0], data.shape[1]  # The first values is the number of rows, h5py uses the opposite notation
-            if i == 0:
-                dset = g.create_dataset('locations', (x, y+1), maxshape=(None, y+1))
-            else:
-                dset.resize((x+last_x, y+1))
-            dset[last_x:last_x+x, 0] = i
-            dset[last_x:last_x+x, 1:] = data
+            # The locations of several frames are written at once, see the batch_size of the delivery class
+            batch = subscription.recv_batch(timeout=STOP_CHECK_INTERVAL)
+            if not batch:
+                continue
+            data = np.concatenate([data[1] for topic, data in batch])
+            x = data.shape[0]
+            dset.resize((last_x+x, ))
+            dset[last_x:last_x+x] = data
             last_x += x
-            i += 1
             f.flush()
+    subscription.close()
 
 
 def calculate_locations_image(image, publisher_queue, locations_queue, **kwargs):
@@ -267,42 +349,56 @@ def calculate_locations_image(image, publisher_queue, locations_queue, **kwargs)
     if not 'diameter' in kwargs:
         raise DiameterNotDefined('A diameter is mandatory for locating particles')
 
-    diameter = kwargs['diameter']
-    del kwargs['diameter']
-    image = image[1]  # image[0] is the timestamp of the frame
+    image_data, image = image, image[1]  # image[0] is the timestamp of the frame and image[2] its number
     logger = get_logger(name=__name__)
     logger.debug('Calculating positions on image')
 
-    logger.debug('Calculating positions with trackpy')
-    locations = tp.locate(image, diameter, **kwargs)
-    logger.debug('Got {} locations'.format(len(locations)))
-    publisher_queue.put({'topic': 'trackpy_locations', 'data': locations})
-    locations_queue.put(locations)
+    records = locate([image], **kwargs)[0]
+    records['frame'] = image_data[2]
+    logger.debug('Got {} locations'.format(len(records)))
+    message = [image_data[0], records, image_data[2]]
+    publisher_queue.put({'topic': 'trackpy_locations', 'data': message})
+    locations_queue.put(message)
 
 
-def link_locations(port, topic, event, publisher_queue, **kwargs):
+def link_locations(address, topic, event, publisher_queue, qos=None, ready=None, telemetry=None, **kwargs):
+    """ Links the locations published on a topic with a
+    :class:`~pynta.model.experiment.nanoparticle_tracking.streaming_linker.StreamingLinker`. The links of every frame
+    are published on ``particle_links`` and the complete trajectories on ``trajectories``. When stopped, the
+    trajectories still open are published as well.
 
+    :param kwargs: Arguments of the linker, ``search_range`` is mandatory
+    """
     if 'search_range' not in kwargs:
         raise LinkException('Search Range must be specified')
 
-    socket = subscribe(port, topic)
-    t = 0  # First frame
-    linker = Linker(**kwargs)
+    subscription = subscribe(address, topic, qos=qos, name='linker', ready=ready, telemetry=telemetry)
+    linker = StreamingLinker(**kwargs)
+    timestamp = frame_id = None
     while not event.is_set():
-        topic = socket.recv_string()
-        locations = socket.recv_pyobj()
-        coords = np.vstack((locations['x'], locations['y'])).T
-        if t == 0:
-            linker.init_level(coords, t)
-        else:
-            linker.next_level(coords, t)
-        t += 1
-        locations['particle'] = linker.particle_ids
-        locations['frame'] = t
-        publisher_queue.put({'topic': 'particle_links', 'data': [locations, linker.particle_ids]})
+        message = subscription.recv(timeout=STOP_CHECK_INTERVAL)
+        if message is None:
+            continue
+        topic, (timestamp, locations, frame_id) = message
+        locations, trajectories = linker.link(locations, frame_id)
+        publisher_queue.put({'topic': 'particle_links', 'data': [timestamp, locations, frame_id]})
+        if len(trajectories):
+            publisher_queue.put({'topic': TRAJECTORIES_TOPIC, 'data': [timestamp, trajectories, frame_id]})
+        if telemetry is not None:
+            telemetry.state.update(live_tracks=linker.live, retired_tracks=linker.retired,
+                                   capped_subnets=linker.capped)
+    trajectories = linker.finish()
+    if len(trajectories):
+        publisher_queue.put({'topic': TRAJECTORIES_TOPIC, 'data': [timestamp, trajectories, frame_id]})
+    linker.close()
+    subscription.close()
 
 
 def add_linking_queue(data, queue):
+    """ Puts the locations in the queue used by :func:`link_queue`. With the ``batch_size`` of
+    :func:`~pynta.model.experiment.subscriber.subscriber`, the data is a list of messages and it is put in the queue at
+    once.
+    """
     logger = get_logger(__name__)
     logger.debug('Adding data frame to linking queue')
     queue.put(data)
@@ -310,34 +406,27 @@ def add_linking_queue(data, queue):
 
 def link_queue(locations_queue, publisher_queue, links_queue, **kwargs):
     """ Links the locations of particles from a location queue.
-    It is a reimplementation of the link_iter of trackpy.
+    It is a reimplementation of the link_iter of trackpy. The queue can hold the messages with the locations of single
+    frames, ``[timestamp, records, frame_id]``, or lists of them, as put by :func:`add_linking_queue` in batch mode.
     """
     logger = get_logger(name=__name__)
     logger.info('Starting to create trajectory links from queue')
-    t = 0  # First frame
-    search_range = kwargs['search_range']
-    del kwargs['search_range']
-    linker = Linker(search_range, **kwargs)
+    linker = StreamingLinker(**kwargs)
     while True:
         if not locations_queue.empty() or locations_queue.qsize() > 0:
-            locations = locations_queue.get()
-            if isinstance(locations, str):
+            batch = locations_queue.get()
+            if isinstance(batch, str):
                 logger.debug('Got string on coordinates')
                 break
-
-            coords = np.vstack((locations['x'], locations['y'])).T
-            if t == 0:
-                logger.debug('First set of coordinates')
-                linker.init_level(coords, t)
-            else:
-                logger.debug('Processing frame {}'.format(t))
-                linker.next_level(coords, t)
-            logger.debug("Frame {0}: {1} trajectories present.".format(t, len(linker.particle_ids)))
-            t += 1
-            locations['particle'] = linker.particle_ids
-            locations['frame'] = t
-            publisher_queue.put({'topic': 'particle_links', 'data': [locations, linker.particle_ids]})
-            links_queue.put(locations)
+            for timestamp, locations, frame_id in batch if isinstance(batch[0], list) else [batch]:
+                logger.debug('Processing frame {}'.format(linker.levels))
+                locations, trajectories = linker.link(locations, frame_id)
+                logger.debug("Frame {0}: {1} trajectories present.".format(linker.levels - 1, linker.live))
+                publisher_queue.put({'topic': 'particle_links', 'data': [timestamp, locations, frame_id]})
+                if len(trajectories):
+                    publisher_queue.put({'topic': TRAJECTORIES_TOPIC, 'data': [timestamp, trajectories, frame_id]})
+                links_queue.put(locations)
+    linker.close()
     logger.info('Stopping link queue trajectories')
 
 
@@ -347,30 +436,14 @@ def add_links_to_queue(data, queue):
 
 def calculate_histogram_sizes(tracks_queue, config, out_queue):
     params = config['tracking']['process']
-    df = DataFrame()
+    msd = IncrementalMSD(params.get('max_lagtime', MAX_LAGTIME))
+    received = 0
     sleep(5)
     while True:
         while not tracks_queue.empty() or tracks_queue.qsize() > 0:
-            data = tracks_queue.get()
-            df = df.append(data)
-
-        if len(df) % 100 == 0:
-            # t1 = tp.filter_stubs(df, params['min_traj_length'])
-            # print(t1.head())
-            # t2 = t1[((t1['mass'] > params['min_mass']) & (t1['size'] < params['max_size']) &
-            #          (t1['ecc'] < params['max_ecc']))]
-            # print(t2.head())
-            # t2 = t1
-            # d = tp.compute_drift(t1)
-            # tm = tp.subtract_drift(t2.copy(), d)
-            im = tp.imsd(df, config['tracking']['process']['um_pixel'], config['camera']['fps'])
-            values = []
-            for pcle in im:
-                data = im[pcle]
-                slope, intercept, r, p, stderr = stats.linregress(np.log(data.index), np.log(data.values))
-                values.append([slope, intercept])
-
-            out_queue.put(values)
-
-        # if len(df) > 100:
-        #     break
+            links = tracks_queue.get()
+            msd.update(links)
+            received += len(links)
+
+        if received % 100 == 0:
+            out_queue.put(msd.fits(params['um_pixel'], config['camera']['fps']).tolist())
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Localization Pool
+=================
+Locating particles with trackpy takes longer than acquiring a frame, therefore a single process falls behind the
+camera. The localization is split among a pool of processes:
+
+* :func:`distribute_frames` subscribes to the frames and hands each of them to the first worker available, through a
+  PUSH socket. Workers take a single frame at a time, therefore a busy worker does not accumulate frames while others
+  are idle. Frames are numbered in the order in which they are handed out.
+* :func:`locate_frames` runs on each worker, it locates the particles and sends the record arrays back (see
+  :mod:`~pynta.model.experiment.nanoparticle_tracking.schema`). The particles are located with trackpy or with one
+  of the in-tree engines, see :data:`ENGINES`.
+* :func:`reorder_locations` runs on a thread of the same process as :func:`distribute_frames`. It collects the
+  results, which arrive in the order in which the workers finish, and publishes them on ``locations`` strictly in the
+  order of the frames. The linking can therefore rely on a monotonic sequence of frames.
+
+If the result of a frame never arrives, for example because a worker crashed, the reorder stage waits at most
+``REORDER_TIMEOUT`` seconds before skipping it. If the pool can not keep up with the camera, it can skip frames on
+purpose instead of falling behind, see :mod:`~pynta.model.experiment.nanoparticle_tracking.load_shedding`.
+
+Frames can be handed out in micro-batches: up to ``batch_size`` frames arriving within ``batch_time`` seconds are
+sent together and located with a single call to ``trackpy.batch``. This saves the overhead of handling each frame
+separately (messages, DataFrames, checks of the arguments), at the cost of the time spent waiting for the batch to
+fill up. With ``batch_size`` equal to 1, the default, every frame is located as soon as it arrives.
+
+Large frames can also be split in ``tiles``, located on ``tile_threads`` threads of each worker (see
+:mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`). Tiles reduce the time spent on each frame, while the
+pool and the batches increase the number of frames located per second. For sparse samples, the workers can locate
+the particles only around the positions already linked, see
+:mod:`~pynta.model.experiment.nanoparticle_tracking.guided`.
+With ``refinement: gaussian``, the positions found by any engine are refined fitting a Gaussian to every particle, see
+:mod:`~pynta.model.experiment.nanoparticle_tracking.gaussian_fit`.
+
+Jobs are lists starting with the number of their first frame, followed by the frames: either
+:class:`~pynta.model.experiment.shared_frames.SharedFrame` or ``timestamp, image, frame_id`` flattened in the same
+list, so that the images are not pickled. Results are ``number, timestamp, records, frame_id, timestamp, ...``, with
+``None`` as records for frames that were lost before locating them.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter, time
+
+import numpy as np
+
+import trackpy as tp
+import zmq
+
+from pynta.exceptions.exceptions import FrameOverwritten
+from pynta.model.experiment.nanoparticle_tracking import fast_locate, multires
+from pynta.model.experiment.nanoparticle_tracking.exceptions import DiameterNotDefined
+from pynta.model.experiment.nanoparticle_tracking.gaussian_fit import REFINEMENT, refine_gaussian
+from pynta.model.experiment.nanoparticle_tracking.guided import Guide
+from pynta.model.experiment.nanoparticle_tracking.load_shedding import ALL, LATEST, LoadShedder
+from pynta.model.experiment.nanoparticle_tracking.schema import empty, to_records
+from pynta.model.experiment.nanoparticle_tracking.tiling import locate_regions, locate_tiled
+from pynta.model.experiment.publisher import bind_random, STOP_CHECK_INTERVAL, TRANSPORT_TCP
+from pynta.model.experiment.serialization import recv_data, send_data
+from pynta.model.experiment.shared_frames import FrameReader, SharedFrame
+from pynta.model.experiment.subscriber import subscribe
+from pynta.util import get_logger
+
+#: In-tree localization engines, by the value of ``engine`` that selects them. Other values are handed to trackpy
+ENGINES = {
+    fast_locate.ENGINE: fast_locate.locate,
+    multires.ENGINE: multires.locate,
+}
+
+REORDER_TIMEOUT = 5  # Maximum time (s) to wait for the locations of a frame before skipping it
+SHEDDING_WAIT = 0.005  # Time (s) to wait for newer frames while the latest policy holds back the frames
+
+
+def distribute_frames(address, topic, event, publisher_queue, addresses, transport=TRANSPORT_TCP, qos=None,
+                      ready=None, telemetry=None, batch_size=1, batch_time=0, shedding=None):
+    """ Hands the frames published on a topic to the workers of the pool and publishes their results in order.
+
+    :param address: Address of the publisher
+    :param str topic: Topic on which frames are published
+    :param event: Event to stop the pool, it is shared with the workers
+    :param publisher_queue: Queue (or :class:`~pynta.model.experiment.publisher.PublisherSocket`) to publish locations
+    :param addresses: Queue on which the addresses for the workers are put, see :func:`locate_frames`
+    :param str transport: Transport of the sockets of the pool, ``'ipc'`` or ``'tcp'``
+    :param dict qos: Delivery class of the subscription to the frames
+    :param ready: Event set once the frames are being received
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` of the subscription to the frames
+    :param int batch_size: Maximum number of frames handed out together
+    :param float batch_time: Maximum time to wait for a batch to fill up, in seconds
+    :param dict shedding: Arguments of
+        :class:`~pynta.model.experiment.nanoparticle_tracking.load_shedding.LoadShedder`, to skip frames when the pool
+        falls behind. By default every frame is located
+    """
+    shedder = LoadShedder(publisher_queue=publisher_queue, telemetry=telemetry, **(shedding or {'policies': [ALL]}))
+    context = zmq.Context.instance()
+    frames = context.socket(zmq.PUSH)
+    frames.setsockopt(zmq.SNDHWM, 1)  # Frames wait here, and not on a busy worker
+    results = context.socket(zmq.PULL)
+    addresses.put((bind_random(frames, transport), bind_random(results, transport)))
+    collector = threading.Thread(target=reorder_locations, args=[results, event, publisher_queue],
+                                 kwargs={'shedder': shedder})
+    collector.start()
+
+    subscription = subscribe(address, topic, qos=qos, name='localization', ready=ready, telemetry=telemetry)
+    reader = FrameReader()
+    job = 0
+    while not event.is_set():
+        batch = shedder.recv(subscription, batch_size, batch_time, timeout=STOP_CHECK_INTERVAL)
+        if not batch:
+            continue
+        while not event.is_set():
+            if not shedder.can_start():
+                wait = SHEDDING_WAIT
+            elif frames.poll(STOP_CHECK_INTERVAL * 1000, zmq.POLLOUT):
+                message = [job]
+                for data in batch:
+                    if isinstance(data, SharedFrame):
+                        message.append(data)
+                    else:
+                        message.extend(reader.read(data))
+                send_data(frames, topic, message)
+                job += len(batch)
+                shedder.started(len(batch))
+                break
+            else:
+                wait = 0
+            if shedder.policy == LATEST:  # While no worker is free, the frames waiting are replaced by newer ones
+                newer = shedder.recv(subscription, timeout=wait)
+                if newer:
+                    shedder.skip(batch)
+                    batch = newer
+    subscription.close()
+    collector.join()
+    frames.close(linger=0)
+
+
+def locate_frames(frames_address, results_address, event, ready=None, telemetry=None, tiles=None, tile_threads=1,
+                  guide=None, **kwargs):
+    """ Worker of the localization pool. It locates the particles on the frames handed out by
+    :func:`distribute_frames` until the event is set. Frames can be split in tiles, localized on ``tile_threads``
+    threads of the worker, and the localization can be guided by the positions of the particles already linked.
+
+    :param str frames_address: Address from which frames are received
+    :param str results_address: Address to which the locations are sent
+    :param event: Event to stop the worker
+    :param ready: Event set once the worker is connected
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` of the worker
+    :param tiles: Number of tiles in which each frame is split, see
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`
+    :param int tile_threads: Threads localizing the tiles of a frame in parallel
+    :param dict guide: Arguments of :class:`~pynta.model.experiment.nanoparticle_tracking.guided.Guide`, to localize
+        the frames only around the particles already linked. By default, frames are localized whole
+    :param kwargs: Arguments passed to :func:`locate`, ``diameter`` is mandatory
+    """
+    if 'diameter' not in kwargs:
+        raise DiameterNotDefined('A diameter is mandatory for locating particles')
+
+    logger = get_logger(name=__name__)
+    tp.quiet()  # Otherwise trackpy.batch logs every frame of the batches
+    context = zmq.Context.instance()
+    frames = context.socket(zmq.PULL)
+    frames.setsockopt(zmq.RCVHWM, 1)
+    frames.connect(frames_address)
+    results = context.socket(zmq.PUSH)
+    results.connect(results_address)
+    reader = FrameReader()
+    executor = ThreadPoolExecutor(tile_threads) if tiles is not None and tile_threads > 1 else None
+    if guide is not None:
+        guide = Guide(**guide)
+    if ready is not None:
+        ready.set()
+    while not event.is_set():
+        if telemetry is not None:
+            telemetry.tick()
+        if not frames.poll(STOP_CHECK_INTERVAL * 1000):
+            continue
+        topic, job = recv_data(frames)
+        t0 = perf_counter()
+        items = job[1:]
+        if not isinstance(items[0], SharedFrame):
+            items = [items[i:i + 3] for i in range(0, len(items), 3)]
+        message = [job[0]]
+        images = []
+        for item in items:
+            try:
+                # Frames in shared memory are copied, a frame overwritten during the localization may break trackpy
+                timestamp, image, frame_id = reader.read(item, copy=True)
+            except FrameOverwritten:
+                logger.warning('Localization is lagging behind, lost {} frames'.format(reader.overwritten))
+                if telemetry is not None:
+                    telemetry.dropped()
+                message.extend([None, None, None])  # The reorder stage must not wait for it
+                continue
+            message.extend([timestamp, None, frame_id])
+            images.append((len(message) - 2, image))
+        if guide is None:
+            located = locate([image for position, image in images], tiles=tiles, executor=executor, **kwargs)
+        else:
+            located = [locate_guided(image, message[position + 1], guide, tiles, executor, **kwargs)
+                       for position, image in images]
+        for (position, image), records in zip(images, located):
+            if message[position + 1] is not None:
+                records['frame'] = message[position + 1]
+            message[position] = records
+        send_data(results, 'locations', message)
+        if telemetry is not None:
+            for position, image in images:
+                telemetry.received(image.nbytes)
+            telemetry.processed(perf_counter() - t0)
+    if executor is not None:
+        executor.shutdown()
+    if guide is not None:
+        guide.close()
+    reader.close()
+    frames.close(linger=0)
+    results.close()
+
+
+def locate(images, engine=None, tiles=None, executor=None, refinement=None, **kwargs):
+    """ Locates the particles on a list of images, on this process. With the in-tree engines (see :data:`ENGINES`),
+    each image is handled by :func:`~pynta.model.experiment.nanoparticle_tracking.fast_locate.locate` (``pynta``) or
+    :func:`~pynta.model.experiment.nanoparticle_tracking.multires.locate` (``multires``). Otherwise a single image is
+    handled by ``trackpy.locate`` and several by ``trackpy.batch``, with the engine of trackpy (``auto``, ``python`` or
+    ``numba``).
+
+    :param list images: The images
+    :param str engine: Engine used to locate the particles, by default the one chosen by trackpy
+    :param tiles: Number of tiles in which each image is split, see
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`. By default images are not split
+    :param executor: :class:`concurrent.futures.Executor` on which the tiles are localized
+    :param str refinement: ``gaussian`` to refine the positions fitting a Gaussian to each particle, by default the
+        center of mass is kept
+    :param kwargs: Arguments of ``trackpy.locate``
+    :return: List with the record arrays of each image, without the frame number
+    """
+    if not images:
+        return []
+    if tiles is not None and np.prod(tiles) > 1:
+        located = [locate_tiled(image, locator(engine), tiles, executor, **kwargs)
+                   for image in images]
+    elif engine in ENGINES or len(images) == 1:
+        located = [locate_image(image, engine, **kwargs) for image in images]
+    else:
+        locations = tp.batch(images, processes=1, engine=engine or 'auto', **kwargs)
+        if locations.empty:  # Blank frames, trackpy does not give the columns either
+            return [empty() for image in images]
+        records = to_records(locations)
+        index = locations['frame'].values  # The position of each image in the list
+        bounds = np.searchsorted(index, np.arange(len(images) + 1))
+        located = [records[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+    return [refine_locations(image, records, refinement, **kwargs) for image, records in zip(images, located)]
+
+
+def refine_locations(image, records, refinement=None, diameter=None, invert=False, **kwargs):
+    """ Refines the locations found on an image with the method given by ``refinement``, see :func:`locate`.
+
+    :return: record array of locations
+    """
+    if refinement is None:
+        return records
+    if refinement != REFINEMENT:
+        raise ValueError('Unknown refinement {}, use {} or leave it empty'.format(refinement, REFINEMENT))
+    return refine_gaussian(image, records, diameter, invert)
+
+
+def locator(engine=None):
+    """ :return: function that locates the particles on a single image with an engine, see :func:`locate`. The in-tree
+        engines are returned as they are, for the tiles to share the levels of the image (see
+        :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`)
+    """
+    return ENGINES.get(engine) or partial(locate_image, engine=engine)
+
+
+def locate_image(image, engine=None, **kwargs):
+    """ Locates the particles on a single image, see :func:`locate`.
+
+    :return: record array of locations, without the frame number
+    """
+    if engine in ENGINES:
+        return ENGINES[engine](image, **kwargs)
+    return to_records(tp.locate(image, engine=engine or 'auto', **kwargs))
+
+
+def locate_guided(image, frame_id, guide, tiles=None, executor=None, engine=None, refinement=None, **kwargs):
+    """ Locates the particles on an image only in the regions chosen by a guide, or on the whole image if the guide has
+    no regions for it.
+
+    :param image: The image
+    :param int frame_id: Number of the frame
+    :param guide: :class:`~pynta.model.experiment.nanoparticle_tracking.guided.Guide`
+    :return: record array of locations, without the frame number
+    """
+    bounds = guide.bounds(image.shape, frame_id, int(kwargs['diameter']))
+    if bounds is None:
+        return locate([image], engine, tiles, executor, refinement, **kwargs)[0]
+    records = locate_regions(image, locator(engine), bounds, executor, **kwargs)
+    return refine_locations(image, records, refinement, **kwargs)
+
+
+def reorder_locations(results, event, publisher_queue, timeout=REORDER_TIMEOUT, shedder=None):
+    """ Publishes the locations sent by the workers in the order of the frames. The socket is closed when finished.
+
+    :param zmq.Socket results: PULL socket to which the workers send the locations
+    :param event: Event to stop
+    :param publisher_queue: Queue (or :class:`~pynta.model.experiment.publisher.PublisherSocket`) to publish locations
+    :param float timeout: Maximum time to wait for a missing frame, in seconds
+    :param shedder: :class:`~pynta.model.experiment.nanoparticle_tracking.load_shedding.LoadShedder` informed of the
+        frames finished
+    """
+    logger = get_logger(name=__name__)
+    pending = {}
+    next_job = 0
+    waiting_since = None
+    while not event.is_set():
+        if results.poll(STOP_CHECK_INTERVAL * 1000):
+            topic, result = recv_data(results)
+            for i in range(1, len(result), 3):
+                pending[result[0] + i // 3] = result[i:i + 3]
+        if pending and next_job not in pending:
+            if waiting_since is None:
+                waiting_since = time()
+            elif time() - waiting_since > timeout:
+                logger.warning('Locations of frames {} to {} never arrived'.format(next_job, min(pending) - 1))
+                if shedder is not None:
+                    shedder.done(count=min(pending) - next_job)
+                next_job = min(pending)
+        while next_job in pending:
+            message = pending.pop(next_job)
+            if message[1] is not None:  # The frame was lost before locating the particles
+                publisher_queue.put({'topic': 'locations', 'data': message})
+            if shedder is not None:
+                shedder.done(message[0])
+            next_job += 1
+            waiting_since = None
+    results.close(linger=0)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental MSD
+===============
+The histogram of the GUI fits the mean squared displacement (MSD) of every particle with a power law, ``MSD = A *
+t ** slope``. Computing it with ``trackpy.imsd`` goes through all the links of the measurement on every update, which
+takes longer the longer the measurement runs. :class:`IncrementalMSD` gives the same result, updated as the links
+arrive:
+
+* For every particle being tracked it keeps the positions of its last ``max_lagtime`` locations, and the sum of the
+  squared displacements and the number of pairs of locations for every lag, in frames, up to ``max_lagtime``. A new
+  location only adds its displacements to the previous ones, therefore the cost of a frame is proportional to the
+  number of particles on it and does not grow with the length of the measurement.
+* Only the fits of the particles that received new displacements are recomputed, all of them together.
+* A particle not found for more than ``max_lagtime`` frames can not add displacements anymore: its fit is kept and the
+  rest of its data released.
+
+As in :meth:`~pynta.model.experiment.nanoparticle_tracking.localization.LocateParticles.calculate_histogram`, the
+displacements only use the locations with ``mass > min_mass``, ``size < max_size`` and ``ecc < max_ecc``, while the
+length of the trajectories, compared to ``min_traj_length``, counts all of them. The filters apply to the links
+received after they change. The fits are done in pixels and frames and converted to microns and seconds when
+requested, therefore ``um_pixel`` and ``fps`` can change at any moment.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import threading
+
+import numpy as np
+
+MAX_LAGTIME = 100  # Same default as trackpy.imsd
+NO_FRAME = np.iinfo(int).min // 2  # Frame of the positions not filled yet, too far to form a lag
+
+
+def select(links, min_mass=None, max_size=None, max_ecc=None):
+    """ :return: boolean array with the links that pass the filters, ``None`` disables a filter"""
+    keep = np.ones(len(links), dtype=bool)
+    if min_mass is not None:
+        keep &= links['mass'] > min_mass
+    if max_size is not None:
+        keep &= links['size'] < max_size
+    if max_ecc is not None:
+        keep &= links['ecc'] < max_ecc
+    return keep
+
+
+def fit_power_law(sums, counts):
+    """ Fits ``log(msd)`` against ``log(lag)`` by least squares, for the lags with displacements of each particle.
+
+    :param sums: Array with the sum of the squared displacements of each particle (rows) for each lag (columns), the
+        first column is lag 0 and it is ignored
+    :param counts: Array with the number of displacements added to each sum
+    :return: arrays with the slope and the intercept of each particle, ``nan`` if it has less than two lags
+    """
+    used = (counts[:, 1:] > 0) & (sums[:, 1:] > 0)
+    x = np.log(np.arange(1, sums.shape[1]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(used, np.log(sums[:, 1:] / counts[:, 1:]), 0)
+        n = used.sum(axis=1)
+        sx = used @ x
+        sy = y.sum(axis=1)
+        sxx = used @ (x ** 2)
+        sxy = y @ x
+        slope = (n * sxy - sx * sy) / (n * sxx - sx ** 2)
+        intercept = (sy - slope * sx) / n
+    slope[n < 2] = np.nan
+    intercept[n < 2] = np.nan
+    return slope, intercept
+
+
+class IncrementalMSD:
+    """ Mean squared displacement of each particle, updated with every batch of links, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.msd`.
+
+    :param int max_lagtime: Longest lag, in frames
+    :param int capacity: Particles for which memory is allocated at first, it grows when needed
+    """
+    ARRAYS = ('_particle', '_length', '_last', '_sums', '_counts', '_frames', '_positions', '_head', '_dirty', '_fit')
+
+    def __init__(self, max_lagtime=MAX_LAGTIME, capacity=256):
+        self.max_lagtime = int(max_lagtime)
+        self._lock = threading.Lock()
+        self._slots = {}  # Slot of the arrays used by each particle being tracked
+        self._retired = []  # Arrays with the slope, intercept and length of the particles retired
+        self._allocate(capacity)
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def _allocate(self, capacity):
+        lags = self.max_lagtime
+        self._particle = np.full(capacity, -1)  # Particle using each slot, -1 if free
+        self._length = np.zeros(capacity, dtype=int)  # Locations of each particle, with or without displacements
+        self._last = np.zeros(capacity, dtype=int)  # Last frame in which each particle was found
+        self._sums = np.zeros((capacity, lags + 1))
+        self._counts = np.zeros((capacity, lags + 1), dtype=int)
+        self._frames = np.full((capacity, lags), NO_FRAME)  # Frames of the last positions, in a ring buffer
+        self._positions = np.zeros((capacity, lags, 2))
+        self._head = np.zeros(capacity, dtype=int)  # Next position of the ring buffer
+        self._dirty = np.zeros(capacity, dtype=bool)  # Fit out of date
+        self._fit = np.full((capacity, 2), np.nan)  # Slope and intercept, in pixels and frames
+
+    def _grow(self):
+        size = len(self._particle)
+        old = {name: getattr(self, name) for name in self.ARRAYS}
+        self._allocate(2 * size)
+        for name, values in old.items():
+            getattr(self, name)[:size] = values
+        self._free = list(range(2 * size - 1, size - 1, -1))
+
+    def _slots_of(self, particles):
+        slots = np.empty(len(particles), dtype=int)
+        for i, particle in enumerate(particles.tolist()):
+            slot = self._slots.get(particle)
+            if slot is None:
+                if not self._free:
+                    self._grow()
+                slot = self._slots[particle] = self._free.pop()
+                self._particle[slot] = particle
+            slots[i] = slot
+        return slots
+
+    @property
+    def tracked(self):
+        """ Number of particles that can still add displacements."""
+        return len(self._slots)
+
+    @property
+    def retired(self):
+        """ Number of particles whose fit can not change anymore."""
+        return sum(len(fits) for fits in self._retired)
+
+    def update(self, links, min_mass=None, max_size=None, max_ecc=None):
+        """ Adds the displacements of a batch of links. The links of each particle arrive in the order of their frames.
+
+        :param links: Record array with the links, only those with a particle number are used
+        :param min_mass: Only the locations with a larger mass are used for the displacements, see :func:`select`
+        :param max_size: Only the locations with a smaller size are used
+        :param max_ecc: Only the locations with a smaller eccentricity are used
+        """
+        links = links[links['particle'] >= 0]
+        if not len(links):
+            return
+        keep = select(links, min_mass, max_size, max_ecc)
+        with self._lock:
+            frames = links['frame']
+            for frame in np.unique(frames):
+                on_frame = frames == frame
+                self._add(links[on_frame], keep[on_frame], int(frame))
+            self._retire(int(frames.max()))
+
+    def _add(self, links, keep, frame):
+        slots = self._slots_of(links['particle'])
+        self._length[slots] += 1
+        self._last[slots] = frame
+        slots = slots[keep]
+        positions = np.column_stack((links['x'][keep], links['y'][keep]))
+        lags = frame - self._frames[slots]
+        lags[(lags < 1) | (lags > self.max_lagtime)] = 0  # Lag 0 collects the positions that do not form a lag
+        displacements = self._positions[slots] - positions[:, None]
+        squared = np.einsum('ijk,ijk->ij', displacements, displacements)
+        # A particle is found once per frame and each of its last positions is on a different one: no repeated lags
+        rows = slots[:, None]
+        self._sums[rows, lags] += squared
+        self._counts[rows, lags] += 1
+        self._dirty[slots[lags.any(axis=1)]] = True
+        head = self._head[slots]
+        self._frames[slots, head] = frame
+        self._positions[slots, head] = positions
+        self._head[slots] = (head + 1) % self.max_lagtime
+
+    def _refit(self, slots):
+        """ Fits the slots whose displacements changed since their last fit."""
+        slots = slots[self._dirty[slots]]
+        if len(slots):
+            self._fit[slots] = np.column_stack(fit_power_law(self._sums[slots], self._counts[slots]))
+            self._dirty[slots] = False
+
+    def _retire(self, frame):
+        """ Keeps only the fit of the particles not found since ``max_lagtime`` frames before the given one."""
+        slots = np.flatnonzero((self._particle >= 0) & (self._last < frame - self.max_lagtime))
+        if not len(slots):
+            return
+        self._refit(slots)
+        self._retired.append(np.column_stack((self._fit[slots], self._length[slots])))
+        for particle in self._particle[slots].tolist():
+            del self._slots[particle]
+        self._free += slots.tolist()
+        self._particle[slots] = -1
+        self._length[slots] = 0
+        self._sums[slots] = 0
+        self._counts[slots] = 0
+        self._frames[slots] = NO_FRAME
+        self._head[slots] = 0
+        self._fit[slots] = np.nan
+
+    def msd(self, particle, um_pixel=1, fps=1):
+        """ Mean squared displacement of a particle being tracked, as a column of ``trackpy.imsd``.
+
+        :return: arrays with the lag times with displacements, in seconds, and the MSD, in square microns
+        """
+        with self._lock:
+            slot = self._slots[particle]
+            sums, counts = self._sums[slot, 1:], self._counts[slot, 1:]
+            lags = np.flatnonzero(counts) + 1
+            return lags / fps, sums[lags - 1] / counts[lags - 1] * um_pixel ** 2
+
+    def fits(self, um_pixel=1, fps=1, min_length=1):
+        """ Refits the particles that received new displacements and returns the fits of all of them.
+
+        :param float um_pixel: Microns per pixel
+        :param float fps: Frames per second
+        :param int min_length: Particles with fewer locations are left out, as ``trackpy.filter_stubs`` would
+        :return: array with the slope and intercept of ``log(msd)`` against ``log(t)`` of each particle, with the MSD
+            in square microns and the time in seconds. Particles with less than two lags are left out
+        """
+        with self._lock:
+            slots = np.flatnonzero(self._particle >= 0)
+            self._refit(slots)
+            fits = np.concatenate([np.column_stack((self._fit[slots], self._length[slots]))] + self._retired)
+            if len(self._retired) > 1:
+                self._retired = [np.concatenate(self._retired)]
+        fits = fits[(fits[:, 2] >= min_length) & ~np.isnan(fits[:, 0]), :2]
+        # log(msd * um_pixel ** 2) = slope * log(t * fps) + intercept
+        fits[:, 1] += 2 * np.log(um_pixel) + fits[:, 0] * np.log(fps)
+        return fits
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Coarse-to-fine Localization
+===========================
+Localization engine for frames with few particles on many pixels. The cost of
+:mod:`~pynta.model.experiment.nanoparticle_tracking.fast_locate` (and of trackpy) is dominated by the filters applied
+to every pixel of the frame. This engine applies them to a binned copy of the frame only:
+
+* The frame is binned by summing blocks of ``binning`` x ``binning`` pixels, and the candidates are the local maxima
+  of the binned frame, found as in :mod:`~pynta.model.experiment.nanoparticle_tracking.fast_locate` with the diameter
+  and the separation scaled down. Summing preserves the mass of the particles, therefore candidates much dimmer than
+  ``minmass`` are discarded already on the binned frame. The center of mass of the rest, on the binned frame, is
+  where their refinement starts.
+* Around every candidate, a window of the full resolution frame is cut, with enough margin to compute the bandpass
+  filter as on the whole frame. All the windows are filtered at once, stacked in a single array.
+* The center of mass is refined on the windows, starting from their brightest central pixel, and the locations are
+  filtered as with the ``pynta`` engine.
+
+Therefore, the cost grows with the number of particles and only a single pass (the binning) is done over all the
+pixels. The positions and the characterization are those of the ``pynta`` engine, but particles closer than about two
+binned pixels may be seen as a single candidate. Select it with ``engine: multires`` and ``binning: 2`` (or ``4``) in
+the ``locate`` section of the tracking configuration.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.fast_locate import (bandpass, filter_locations, find_maxima,
+                                                                      refine, to_integer)
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+
+#: Value of ``engine`` in the configuration of ``locate`` that selects this module
+ENGINE = 'multires'
+
+COARSE_MASS_FRACTION = 0.5  # Candidates with a mass on the binned frame below this fraction of minmass are discarded
+
+
+def bin_image(image, binning):
+    """ Sums blocks of ``binning`` x ``binning`` pixels. Pixels that do not fill a whole block are discarded.
+
+    :return: float image with the sums
+    """
+    height, width = (size // binning * binning for size in image.shape)
+    blocks = image[:height, :width].reshape(height // binning, binning, width // binning, binning)
+    return blocks.sum(axis=(1, 3), dtype=float)
+
+
+def cut_windows(image, centers, half_size):
+    """ Cuts square windows of ``2 * half_size + 1`` pixels around each center. Pixels beyond the borders of the image
+    repeat the closest pixel inside.
+
+    :return: array of shape ``(len(centers), size, size)``
+    """
+    offsets = np.arange(-half_size, half_size + 1)
+    rows = np.clip(centers[:, 0, np.newaxis] + offsets, 0, image.shape[0] - 1)
+    columns = np.clip(centers[:, 1, np.newaxis] + offsets, 0, image.shape[1] - 1)
+    return image[rows[:, :, np.newaxis], columns[:, np.newaxis, :]]
+
+
+def locate(raw_image, diameter, binning=2, minmass=None, maxsize=None, separation=None, noise_size=1,
+           smoothing_size=None, threshold=None, invert=False, percentile=64, topn=None, preprocess=True,
+           max_iterations=10, characterize=True):
+    """ Locates the particles on an image, finding them first on a binned copy. The arguments are those of
+    :func:`~pynta.model.experiment.nanoparticle_tracking.fast_locate.locate`.
+
+    :param int binning: Pixels of the frame along each side of a pixel of the binned copy
+    :return: record array with the locations, with ``frame`` and ``particle`` undefined
+    """
+    raw_image = np.squeeze(raw_image)
+    if raw_image.ndim != 2:
+        raise ValueError('Only 2D images are supported, use trackpy for images with {} dimensions'.format(
+            raw_image.ndim))
+    diameter = int(diameter)
+    if not diameter & 1:
+        raise ValueError('Feature diameter must be an odd integer. Round up.')
+    radius = diameter // 2
+    separation = diameter + 1 if separation is None else separation
+    smoothing_size = diameter if smoothing_size is None else smoothing_size
+    minmass = 0 if minmass is None else minmass
+    is_float_image = not np.issubdtype(raw_image.dtype, np.integer)
+    if threshold is None:
+        threshold = 1 / 255. if is_float_image else 1
+    if invert:
+        raw_image = 1. - raw_image if is_float_image else raw_image ^ np.iinfo(raw_image.dtype).max
+
+    # Candidates on the binned copy
+    binned = bin_image(raw_image, binning)
+    # The background is averaged over a box larger than the binned particles, otherwise they are subtracted too
+    coarse_smoothing = max(int(round(smoothing_size / binning)) | 1, 3) + 2
+    coarse = bandpass(binned, 1, coarse_smoothing, threshold * binning ** 2) if preprocess else binned
+    coarse_radius = -(-radius // binning)
+    # Rounded down, not to discard the candidates that are at full resolution just inside the margin
+    coarse_margin = int(max(radius, separation // 2 - 1, smoothing_size // 2)) // binning
+    candidates = find_maxima(to_integer(coarse, np.uint16)[1], max(separation / binning, 1), percentile,
+                             coarse_margin)
+    if not len(candidates):
+        return empty()
+    # Binning preserves the mass, candidates much dimmer than minmass are discarded before cutting windows. The
+    # center of mass on the binned copy is a better starting point than the binned pixel of the maximum. Close to the
+    # borders the neighborhood does not fit around the maximum and misses part of the mass, those are all kept
+    inside = np.clip(candidates, coarse_radius, np.array(binned.shape) - coarse_radius - 1)
+    coarse_records = refine(binned, coarse, coarse_radius, inside, max_iterations=1, characterize=False)
+    clipped = np.any(inside != candidates, axis=1)
+    coarse_records = coarse_records[clipped | (coarse_records['mass'] > COARSE_MASS_FRACTION * minmass)]
+    if not len(coarse_records):
+        return empty()
+    centers = np.column_stack((coarse_records['y'], coarse_records['x']))
+    centers = np.rint((centers + 0.5) * binning - 0.5).astype(int)
+
+    # Windows of the full resolution frame, with a margin for the filters and one for the refinement
+    search = binning
+    half_size = radius + search
+    filter_margin = smoothing_size // 2 + int(4 * noise_size + 0.5) if preprocess else 0
+    raw_windows = cut_windows(raw_image, centers, half_size + filter_margin)
+    windows = bandpass(raw_windows, noise_size, smoothing_size, threshold, axes=(1, 2)) if preprocess else raw_windows
+    crop = slice(filter_margin, filter_margin + 2 * half_size + 1)
+    windows, raw_windows = windows[:, crop, crop], raw_windows[:, crop, crop]
+    scale_factor, windows = to_integer(windows, np.uint8 if is_float_image else raw_image.dtype)
+
+    # The windows are refined stacked on top of each other, as a single image
+    size = 2 * half_size + 1
+    count = len(centers)
+    center = windows[:, half_size - search:half_size + search + 1, half_size - search:half_size + search + 1]
+    brightest = np.array(np.unravel_index(center.reshape(count, -1).argmax(axis=1), center.shape[1:])).T
+    origins = np.column_stack((np.arange(count) * size, np.zeros(count, dtype=int)))
+    records = refine(raw_windows.reshape(count * size, size), windows.reshape(count * size, size), radius,
+                     origins + brightest + half_size - search, max_iterations, characterize,
+                     lower=origins + radius, upper=origins + size - radius - 1)
+    records['y'] += centers[:, 0] - half_size - origins[:, 0]
+    records['x'] += centers[:, 1] - half_size
+    return filter_locations(records, windows.reshape(count * size, size), raw_windows.reshape(count * size, size),
+                            radius, separation, scale_factor, minmass, maxsize, topn, noise_size, characterize)
+
@@ -15,10 +15,10 @@
     :license: GPLv3, see LICENSE for more details
 """
 import sys
-import copy
 import importlib
 import json
 import os
+import threading
 import time
 from threading import Event
 
@@ -26,20 +26,24 @@ from datetime import datetime
 
 import h5py as h5py
 import numpy as np
-from multiprocessing import Queue, Process
+from multiprocessing import Queue, Process, Event as ProcessEvent
 
 from pynta import general_stop_event
 from pynta.model.experiment.base_experiment import BaseExperiment
+from pynta.model.experiment.shared_frames import FrameRing, SharedFrame
 from pynta.model.experiment.nanoparticle_tracking.decorators import (check_camera,
                                                                      check_not_acquiring,
                                                                      make_async_thread)
 
+from pynta.model.experiment.nanoparticle_tracking.frame_cache import FrameCache, newest_common
 from pynta.model.experiment.nanoparticle_tracking.localization import link_queue, LocateParticles
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+from pynta.model.experiment.nanoparticle_tracking.schema import to_dataframe
 
 from pynta.model.experiment.nanoparticle_tracking.saver import worker_listener
 from pynta.model.experiment.nanoparticle_tracking.exceptions import StreamSavingRunning
+from pynta.model.experiment.subscriber import wait_ready, STOP_TIMEOUT
 from pynta.util import get_logger
-import trackpy as tp
 
 
 class NPTracking(BaseExperiment):
@@ -64,8 +68,14 @@ class NPTracking(BaseExperiment):
         self.max_height = None
         self.background = np.array(())
         self.temp_image = None  # Temporary image, used to quickly have access to 'some' data and display it to the user
-        # self.temp_locations = None
-        self.movie_buffer = None  # Holds few frames of the movie in order to be able to do some analysis, save later, etc.
+        self.temp_frame_id = None  # Number of the temporary image, snaps are numbered as ('snap', n)
+        self.snaps = 0
+        # Last frames acquired while tracking, to display them with the locations published, see tracked_frame
+        self.recent_frames = FrameCache(self.config.get('GUI', {}).get('recent_frames', 16))
+        self.snap_locations = FrameCache(4)  # Locations of the last snaps, located only once
+        # Holds few frames of the movie in order to be able to do some analysis, save later, etc.
+        self.movie_buffer = None
+        self.frame_ring = None  # Shared memory in which frames are stored when bus: shared_memory is enabled
         self.last_index = 0  # Last index used for storing to the movie buffer
         self.stream_saving_running = False
         self.async_threads = []  # List holding all the threads spawn
@@ -87,9 +97,12 @@ class NPTracking(BaseExperiment):
         self._processes = []
         self._stop_free_run = Event()
 
-        self.location = LocateParticles(self.publisher, self.config['tracking'])
+        bus_config = self.config.get('bus', {})
+        self.location = LocateParticles(self.publisher, self.config['tracking'], bus_config.get('qos'),
+                                        bus_config.get('stats_interval'))
         self.fps = 0  # Calculates frames per second based on the number of frames received in a period of time
-        # sys.excepthook = self.sysexcept  # This is very handy in case there are exceptions that force the program to quit.
+        # This is very handy in case there are exceptions that force the program to quit.
+        # sys.excepthook = self.sysexcept
 
     def initialize_camera(self):
         """ Initializes the camera to be used to acquire data. The information on the camera should be provided in the
@@ -181,7 +194,9 @@ class NPTracking(BaseExperiment):
         self.check_background()
         data = self.camera.read_camera()[-1]
         self.publisher.publish('snap', data)
+        self.snaps += 1
         self.temp_image = data
+        self.temp_frame_id = ('snap', self.snaps)
         self.logger.debug('Got an image of {}x{} pixels'.format(self.temp_image.shape[0], self.temp_image.shape[1]))
 
     @make_async_thread
@@ -191,6 +206,10 @@ class NPTracking(BaseExperiment):
         """ Starts continuous acquisition from the camera, but it is not being saved. This method is the workhorse
         of the program. While this method runs on its own thread, it will broadcast the images to be consumed by other
         methods. In this way it is possible to continuously save to hard drive, track particles, etc.
+
+        If ``shared_memory`` is enabled in the ``bus`` section of the config, frames are written to a
+        :class:`~pynta.model.experiment.shared_frames.FrameRing` and only a
+        :class:`~pynta.model.experiment.shared_frames.SharedFrame` pointing to them is broadcast.
         """
 
         self.logger.info('Starting a free run acquisition')
@@ -203,6 +222,8 @@ class NPTracking(BaseExperiment):
         self.logger.debug('First frame of a free_run')
         self.camera.set_acquisition_mode(self.camera.MODE_CONTINUOUS)
         self.camera.trigger_camera()  # Triggers the camera only once
+        bus_config = self.config.get('bus', {})
+        shared_memory = bus_config.get('shared_memory', False)
         while not self._stop_free_run.is_set():
             data = self.camera.read_camera()
             if not data:
@@ -214,24 +235,72 @@ class NPTracking(BaseExperiment):
                 if self.do_background_correction and self.background_method == self.BACKGROUND_SINGLE_SNAP:
                     img -= self.background
 
-                # This will broadcast the data just acquired with the current timestamp
+                # This will broadcast the data just acquired with the current timestamp and the frame number
                 # The timestamp is very unreliable, especially if the camera has a frame grabber.
-                self.publisher.publish('free_run', [time.time(), img])
+                if shared_memory:
+                    if self.frame_ring is None or not self.frame_ring.fits(img):
+                        self.close_frame_ring()
+                        self.frame_ring = FrameRing.create(img.shape, img.dtype, bus_config.get('ring_slots', 32))
+                    slot, generation = self.frame_ring.write(img)
+                    self.publisher.publish('free_run', SharedFrame(time.time(), slot, i, self.frame_ring.name,
+                                                                   generation))
+                else:
+                    self.publisher.publish('free_run', [time.time(), img, i])
+                if self.tracking:
+                    self.recent_frames.put(i, img)
             self.fps = round(i / (time.time() - t0))
             self.temp_image = img
+            self.temp_frame_id = i
         self.free_run_running = False
         self.camera.stopAcq()
 
+    def close_frame_ring(self):
+        """ Releases the shared memory used to broadcast frames, if any. Consumers that are still reading from it will
+        count the remaining frames as overwritten.
+        """
+        if self.frame_ring is not None:
+            self.frame_ring.close()
+            self.frame_ring = None
+
     @property
     def temp_locations(self):
-        return self.localize_particles_image(self.temp_image)
+        """ Locations of the particles on the temporary image, as a DataFrame. The locations published by the tracking
+        are used when available, otherwise the image is localized, only once. While tracking, frames not localized yet
+        have no locations (``None``), use :meth:`tracked_frame` to get a frame with locations.
+        """
+        frame_id = self.temp_frame_id
+        records = self.location.recent_locations.get(frame_id)
+        if records is None:
+            records = self.snap_locations.get(frame_id)
+        if records is None:
+            if self.tracking and self.free_run_running:
+                return None
+            records = locate([self.temp_image], **self.config['tracking']['locate'])[0]
+            self.snap_locations.put(frame_id, records)
+        return to_dataframe(records)
+
+    def tracked_frame(self):
+        """ Newest frame acquired while tracking for which the locations were already published. The GUI displays it
+        instead of the temporary image, so that the particles shown match the frame, without locating them again.
+
+        :return: the image and its locations as a DataFrame, or ``None, None`` if no frame has locations yet
+        """
+        frame_id = newest_common(self.location.recent_locations, self.recent_frames)
+        if frame_id is None:
+            return None, None
+        return self.recent_frames.get(frame_id), to_dataframe(self.location.recent_locations.get(frame_id))
 
     def stop_free_run(self):
         """ Stops the free run by setting the ``_stop_event``. It is basically a convenience method to avoid
-        having users dealing with somewhat lower level threading options.
+        having users dealing with somewhat lower level threading options. It waits until the last frame was published.
         """
         self.logger.info('Setting the stop_event')
         self._stop_free_run.set()
+        for name, thread in self._threads:
+            if name == 'start_free_run' and thread is not threading.current_thread():
+                thread.join(STOP_TIMEOUT)
+                if thread.is_alive():
+                    self.logger.warning('The free run did not stop after {}s'.format(STOP_TIMEOUT))
 
     def save_image(self):
         """ Saves the last acquired image. The file to which it is going to be saved is defined in the config.
@@ -258,7 +327,8 @@ class NPTracking(BaseExperiment):
     def save_stream(self):
         """ Saves the queue to a file continuously. This is an async function, that can be triggered before starting
         the stream. It relies on the multiprocess library. It uses a queue in order to get the data to be saved.
-        In normal operation, it should be used together with ``add_to_stream_queue``.
+        In normal operation, it should be used together with ``add_to_stream_queue``. It returns once the saver is
+        receiving frames.
         """
         if self.save_stream_running:
             self.logger.warning('Tried to start a new instance of save stream')
@@ -273,17 +343,21 @@ class NPTracking(BaseExperiment):
         file_path = os.path.join(file_dir, file_name)
         max_memory = self.config['saving']['max_memory']
 
+        ready = ProcessEvent()
         self.stream_saving_process = Process(target=worker_listener,
                                              args=(file_path, json.dumps(self.config), 'free_run'),
-                                             kwargs={'max_memory': max_memory})
+                                             kwargs={'address': self.publisher.address, 'max_memory': max_memory,
+                                                     'qos': self.qos('free_run', 'saver'), 'ready': ready,
+                                                     'telemetry': self.telemetry('saver')})
         self.stream_saving_process.start()
+        wait_ready(ready, self.stream_saving_process)
         self.logger.debug('Started the stream saving process')
 
     def link_particles(self):
         """ Starts linking the particles while the acquisition is in progress.
         """
         self.logger.info('Starting to link particles')
-        self.link_particles_process = Process(target=link_queue, args=[self.locations_queue, self.publisher._queue,
+        self.link_particles_process = Process(target=link_queue, args=[self.locations_queue, self.publisher.queue,
                                                                        self.tracks_queue],
                                               kwargs=self.config['tracking']['link'])
         self.link_particles_process.start()
@@ -302,12 +376,14 @@ class NPTracking(BaseExperiment):
     def start_tracking(self):
         """ Starts the tracking of the particles
         """
+        self.recent_frames.clear()
         self.tracking = True
         self.location.start_tracking('free_run')
 
     def stop_tracking(self):
         self.tracking = False
         self.location.stop_tracking()
+        self.recent_frames.clear()
 
     def start_saving_location(self):
         self.saving_location = True
@@ -333,16 +409,14 @@ class NPTracking(BaseExperiment):
 
     def localize_particles_image(self, image=None):
         """
-        Localizes particles based on trackpy. It is a convenience function in order to use the configuration parameters
-        instead of manually passing them to trackpy.
+        Localizes particles based on trackpy, or on the engine set in the configuration. It is a convenience function
+        in order to use the configuration parameters instead of manually passing them to trackpy.
 
         """
         if image is None:
             image = self.temp_image
 
-        params = copy.copy(self.config['tracking']['locate'])
-        diameter = params.pop('diameter')
-        return tp.locate(image, diameter, **params)
+        return to_dataframe(locate([image], **self.config['tracking']['locate'])[0])
 
     @property
     def save_stream_running(self):
@@ -428,11 +502,15 @@ class NPTracking(BaseExperiment):
                     self.do_background_correction = False
 
     def finalize(self):
-        general_stop_event.set()
         self.stop_free_run()
-        time.sleep(.5)
-        self.stop_save_stream()
+        if self.save_stream_running:
+            self.stop_save_stream()  # The saver gets the signal after the last frame
+            self.stream_saving_process.join(STOP_TIMEOUT)
+            if self.stream_saving_process.is_alive():
+                self.logger.warning('The saver is still writing to disk')
+        general_stop_event.set()
         self.location.finalize()
+        self.close_frame_ring()
         super().finalize()
 
     def sysexcept(self, exc_type, exc_value, exc_traceback):
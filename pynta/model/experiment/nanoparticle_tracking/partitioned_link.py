@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Partitioned Linking
+===================
+Linking is sequential in time, each frame needs the links of the previous one, but it can be split in space. For wide
+fields of view, :class:`PartitionedLinker` splits the field in vertical strips of ``strip_width`` pixels and links each
+of them with its own :class:`~pynta.model.experiment.nanoparticle_tracking.fast_link.KDTreeLinker`, in parallel on
+``threads`` threads. As with the tiles of the localization (see
+:mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`), threads help because the linker spends its time in
+scipy, which releases the GIL for most of it.
+
+Every strip is extended by a margin of ``search_range`` on each side, therefore a particle that crosses from one strip
+to the next was already seen, and linked, by both of them on the previous frame. The numbers given to the particles by
+each strip are local, they are translated to global ones as follows:
+
+* Every location belongs to the strip that contains it, its owner, and takes the global number of its local particle
+  in that strip.
+* A local particle that has no global number yet, for example because the particle just crossed from a neighbor,
+  takes the global number of the same location in the neighbor that saw it on its margin. Only particles that no strip
+  knew get a new number.
+* The local particles of every strip that saw the location are then assigned that global number, so that the particle
+  keeps it if it crosses later. Where the linkers of two strips disagree, the owner prevails.
+* A global number is given to a single location per frame. A location whose number was already taken by another one,
+  because the linkers of two strips disagree, gets a new number.
+
+Strips are created when particles reach them and discarded once they have no particles to link, therefore the field
+does not need to be known in advance. Select it with ``strip_width`` and ``strip_threads`` in the ``link`` section of
+the tracking configuration, it needs ``engine: pynta``.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.fast_link import KDTreeLinker
+
+
+class PartitionedLinker:
+    """ Links coordinates frame by frame in vertical strips, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.partitioned_link`. It has the same interface as
+    :class:`~pynta.model.experiment.nanoparticle_tracking.fast_link.KDTreeLinker`.
+
+    :param float search_range: Maximum displacement of a particle between consecutive frames, also the margin of the
+        strips
+    :param float strip_width: Width of the strips, in pixels
+    :param int memory: Frames that a particle can be missing and still be linked
+    :param int threads: Threads linking the strips in parallel
+    :param kwargs: Other arguments of :class:`~pynta.model.experiment.nanoparticle_tracking.fast_link.KDTreeLinker`
+    """
+    def __init__(self, search_range, strip_width, memory=0, threads=1, **kwargs):
+        self.search_range = float(search_range)
+        self.strip_width = float(strip_width)
+        self.memory = memory
+        self.threads = threads
+        self.kwargs = kwargs
+        self.particle_ids = np.zeros(0, dtype=int)
+
+        self._executor = None
+        self._capped = 0  # Subnetworks split by the strips already discarded
+        self._reset()
+
+    def _reset(self):
+        self._linkers = {}  # Linker of each strip, by the number of the strip
+        self._global = {}  # Global number of the local particles of each strip
+        self._seen = {}  # Last level at which the local particles of each strip were seen
+        self._next_id = 0
+
+    @property
+    def strips(self):
+        """ Number of strips being linked."""
+        return len(self._linkers)
+
+    @property
+    def capped(self):
+        """ Subnetworks split because they were too large, in all the strips."""
+        return self._capped + sum(linker.capped for linker in self._linkers.values())
+
+    def init_level(self, coords, t):
+        """ Starts new tracks with the coordinates of the first frame."""
+        self._reset()
+        self.next_level(coords, t)
+
+    def next_level(self, coords, t):
+        """ Links the coordinates of a frame to the particles found on the previous ones."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        x = coords[:, 0]
+        margin = self.search_range
+        first = np.floor((x - margin) / self.strip_width).astype(int)
+        last = np.floor((x + margin) / self.strip_width).astype(int)
+        strips = set(self._linkers)
+        if len(coords):
+            strips.update(range(first.min(), last.max() + 1))
+        members = {strip: np.flatnonzero((first <= strip) & (last >= strip)) for strip in sorted(strips)}
+        tasks = [(strip, coords[indices], t) for strip, indices in members.items()]
+        if self.threads > 1 and len(tasks) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads)
+            local_ids = list(self._executor.map(lambda task: self._link_strip(*task), tasks))
+        else:
+            local_ids = [self._link_strip(*task) for task in tasks]
+        local_ids = dict(zip(members, local_ids))
+        self.particle_ids = self._reconcile(np.floor(x / self.strip_width).astype(int), members, local_ids, t)
+        self._discard(members, t)
+
+    def _link_strip(self, strip, coords, t):
+        linker = self._linkers.get(strip)
+        if linker is None:
+            linker = self._linkers[strip] = KDTreeLinker(self.search_range, self.memory, **self.kwargs)
+            self._global[strip], self._seen[strip] = {}, {}
+            linker.init_level(coords, t)
+        else:
+            linker.search_range = self.search_range
+            linker.next_level(coords, t)
+        return linker.particle_ids
+
+    def _reconcile(self, owners, members, local_ids, t):
+        """ :return: the global numbers of the particles, from the local numbers given by each strip. A global number
+            is given to a single location per frame, the owners first.
+        """
+        particle_ids = np.full(len(owners), -1)
+        taken = set()  # Global numbers already given on this frame
+        for strip, indices in members.items():  # Locations that the owner already knows
+            owned = owners[indices] == strip
+            self._take(particle_ids, indices[owned], local_ids[strip][owned], self._global[strip], taken)
+        for strip, indices in members.items():  # Locations that a neighbor already knows
+            unknown = particle_ids[indices] < 0
+            if unknown.any():
+                self._take(particle_ids, indices[unknown], local_ids[strip][unknown], self._global[strip], taken)
+        new = particle_ids < 0
+        particle_ids[new] = np.arange(self._next_id, self._next_id + new.sum())
+        self._next_id += int(new.sum())
+        for strip, indices in members.items():
+            local = local_ids[strip].tolist()
+            self._global[strip].update(zip(local, particle_ids[indices].tolist()))
+            self._seen[strip].update(dict.fromkeys(local, t))
+        return particle_ids
+
+    @staticmethod
+    def _take(particle_ids, indices, local_ids, numbers, taken):
+        """ Gives to the locations the global numbers of their local particles, unless already taken on this frame."""
+        for index, local in zip(indices.tolist(), local_ids.tolist()):
+            number = numbers.get(local, -1)
+            if number >= 0 and number not in taken:
+                particle_ids[index] = number
+                taken.add(number)
+
+    def _discard(self, members, t):
+        """ Forgets the local particles that can not be linked anymore, and the strips without particles."""
+        oldest = t - self.memory - 1
+        for strip in list(self._linkers):
+            seen = self._seen[strip]
+            if len(seen) > 2 * len(members[strip]) + 16:
+                for local in [local for local, level in seen.items() if level <= oldest]:
+                    del seen[local]
+                    del self._global[strip][local]
+            if not self._linkers[strip].tracked:
+                self._capped += self._linkers.pop(strip).capped
+                del self._global[strip], self._seen[strip]
+
+    def close(self):
+        """ Stops the threads linking the strips."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -27,31 +27,34 @@
 
     .. sectionauthor:: Aquiles Carattino <aquiles@uetke.com>
 """
-import zmq
 import h5py
 import numpy as np
 from datetime import datetime
 
+from pynta.exceptions.exceptions import FrameOverwritten
+from pynta.model.experiment.shared_frames import FrameReader
+from pynta.model.experiment.publisher import STOP_CHECK_INTERVAL
+from pynta.model.experiment.subscriber import subscribe
 from pynta.util.log import get_logger
 
 
-def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
+def worker_listener(file_path, meta, topic, address=5555, max_memory=500, qos=None, ready=None, telemetry=None):
     """ Function that listens on the specified port for new data and then saves it to disk. It is the same as
     :func:`worker_saver` but implementing a ZMQ socket instead of grabbing data from a queue.
 
     :param str file_path: the path to the file to use.
     :param str meta: Metadata. It is kept as a string in order to provide flexibility for other programs.
-    :param int port: Port on which to listen for publisher data
+    :param address: Address of the publisher, or the port if it runs on this computer
     :param int max_memory: Maximum memory (in MB) to allocate
+    :param dict qos: Delivery class of the subscription, see :func:`~pynta.model.experiment.subscriber.get_qos`
+    :param ready: Event set once the saver is receiving frames
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` to report the statistics of the saver
     """
     logger = get_logger(name=__name__)
-    logger.info('Starting worker saver for topic {} on port {}'.format(topic, port))
-    context = zmq.Context()
-    socket = context.socket(zmq.SUB)
-    socket.connect("tcp://localhost:{}".format(port))
-    topic_filter = topic.encode('ascii')
-    socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
+    logger.info('Starting worker saver for topic {} on {}'.format(topic, address))
+    subscription = subscribe(address, topic, qos=qos, name='saver', ready=ready, telemetry=telemetry)
     allocate_memory = max_memory  # megabytes of memory to allocate on the hard drive.
+    reader = FrameReader()
 
     with h5py.File(file_path, "a") as f:
         now = str(datetime.now())
@@ -64,13 +67,21 @@ def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
         first = True
 
         while True:
-            topic = socket.recv_string()
-            data = socket.recv_pyobj()
-            logger.debug('Got data of type {} on the saver topic {}.'.format(type(data), topic))
-            if isinstance(data, str):
+            received = subscription.recv(timeout=STOP_CHECK_INTERVAL)
+            if received is None:
+                continue
+            topic, message = received
+            logger.debug('Got data of type {} on the saver topic {}.'.format(type(message), topic))
+            if isinstance(message, str):
                 logger.info('Got the signal to stop the saving')
                 break
-            data = data[1]
+            try:
+                data = reader.read(message)[1]
+            except FrameOverwritten:
+                logger.error('The saver is lagging behind, lost {} frames'.format(reader.overwritten))
+                if telemetry is not None:
+                    telemetry.dropped()
+                continue
             if first:  # First time it runs, creates the dataset
                 x = data.shape[0]
                 y = data.shape[1]
@@ -83,7 +94,6 @@ def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
                                         compression='gzip', compression_opts=1,
                                         dtype=data.dtype)  # The images are going to be stacked along the z-axis.
                 d[:, :, i] = data
-                i += 1
                 first = False
             else:
                 if i == allocate:
@@ -94,7 +104,10 @@ def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
                     i = 0
                     j += allocate
                 d[:, :, i] = data
+            if reader.is_current(message):
                 i += 1
+            else:
+                logger.error('Frame overwritten while saving it, lost {} frames'.format(reader.overwritten))
 
         if j > 0 or i > 0:
             logger.info('Saving last bits of data before stopping.')
@@ -107,6 +120,8 @@ def worker_listener(file_path, meta, topic, port=5555, max_memory=500):
         logger.info('Flushing file to disk...')
         f.flush()
         logger.info('Finished writing to disk')
+        reader.close()
+        subscription.close()
 
 def add_to_save_queue(data, queue_saver):
     """ This method is a buffer between the publisher and the ``save_stream`` method. The idea is that in order
@@ -122,7 +137,7 @@ def worker_saver(file_path, meta, q, max_memory=500):
 
     :param str file_path: the path to the file to use.
     :param str meta: Metadata. It is kept as a string in order to provide flexibility for other programs.
-    :param Queue q: Queue that will store all the images to be saved to disk.
+    :param Queue q: Queue that will store all the images to be saved to disk, one by one or as lists of images.
     :param int max_memory: Maximum memory (in MB) to allocate
     """
     logger = get_logger(name=__name__)
@@ -142,36 +157,37 @@ def worker_saver(file_path, meta, q, max_memory=500):
 
         while keep_saving:
             while not q.empty() or q.qsize() > 0:
-                img = q.get()
-                if isinstance(img, str):
-                    keep_saving = False
-                    logger.info('Got the signal to stop the saving')
-                    continue
-
-                if first:  # First time it runs, creates the dataset
-                    x = img.shape[0]
-                    y = img.shape[1]
-                    logger.debug('Image size: {}x{}'.format(x, y))
-                    allocate = int(allocate_memory / img.nbytes * 1024 * 1024)
-                    logger.debug('Allocating {}MB to stream to disk'.format(allocate_memory))
-                    logger.debug('Allocate {} frames'.format(allocate))
-                    d = np.zeros((x, y, allocate), dtype=img.dtype)
-                    dset = g.create_dataset('timelapse', (x, y, allocate), maxshape=(x, y, None),
-                                            compression='gzip', compression_opts=1,
-                                            dtype=img.dtype)  # The images are going to be stacked along the z-axis.
-                    d[:, :, i] = img
-                    i += 1
-                    first = False
-                else:
-                    if i == allocate:
-                        logger.debug('Allocating more memory')
-                        dset[:, :, j:j + allocate] = d
-                        dset.resize((x, y, j + 2 * allocate))
+                item = q.get()
+                for img in item if isinstance(item, list) else [item]:  # Batches are lists of images
+                    if isinstance(img, str):
+                        keep_saving = False
+                        logger.info('Got the signal to stop the saving')
+                        continue
+
+                    if first:  # First time it runs, creates the dataset
+                        x = img.shape[0]
+                        y = img.shape[1]
+                        logger.debug('Image size: {}x{}'.format(x, y))
+                        allocate = int(allocate_memory / img.nbytes * 1024 * 1024)
+                        logger.debug('Allocating {}MB to stream to disk'.format(allocate_memory))
+                        logger.debug('Allocate {} frames'.format(allocate))
                         d = np.zeros((x, y, allocate), dtype=img.dtype)
-                        i = 0
-                        j += allocate
-                    d[:, :, i] = img
-                    i += 1
+                        # The images are going to be stacked along the z-axis.
+                        dset = g.create_dataset('timelapse', (x, y, allocate), maxshape=(x, y, None),
+                                                compression='gzip', compression_opts=1, dtype=img.dtype)
+                        d[:, :, i] = img
+                        i += 1
+                        first = False
+                    else:
+                        if i == allocate:
+                            logger.debug('Allocating more memory')
+                            dset[:, :, j:j + allocate] = d
+                            dset.resize((x, y, j + 2 * allocate))
+                            d = np.zeros((x, y, allocate), dtype=img.dtype)
+                            i = 0
+                            j += allocate
+                        d[:, :, i] = img
+                        i += 1
 
         if j > 0 or i > 0:
             logger.info('Saving last bits of data before stopping.')
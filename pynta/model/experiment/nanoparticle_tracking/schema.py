@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Schema of Locations
+===================
+Locations and links are exchanged between processes as numpy record arrays with a fixed set of columns, instead of
+pickled DataFrames. A record array has a single buffer, therefore it travels through the bus without being pickled
+(see :mod:`~pynta.model.experiment.serialization`) and it can be written as-is to an HDF5 file.
+
+Messages on ``locations`` and ``particle_links`` are ``[timestamp, records, frame_id]``, the same layout used for
+frames on ``free_run``. Locations have ``particle`` set to :data:`NO_PARTICLE` until they are linked.
+
+The columns are versioned: if they ever change, a new entry is added to :data:`SCHEMAS` and :data:`SCHEMA_VERSION` is
+increased, so that files saved with an older version can still be told apart. DataFrames are built with
+:func:`to_dataframe` only where they are needed, for example to plot or to filter the tracks with trackpy.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+from pandas import DataFrame
+
+#: Version of the columns used by :data:`LOCATIONS_DTYPE`
+SCHEMA_VERSION = 1
+
+#: Columns of every version of the schema
+SCHEMAS = {
+    1: np.dtype([
+        ('x', '<f8'),
+        ('y', '<f8'),
+        ('mass', '<f8'),
+        ('size', '<f8'),
+        ('ecc', '<f8'),
+        ('signal', '<f8'),
+        ('raw_mass', '<f8'),
+        ('ep', '<f8'),
+        ('frame', '<i8'),
+        ('particle', '<i8'),
+    ]),
+}
+
+LOCATIONS_DTYPE = SCHEMAS[SCHEMA_VERSION]
+
+#: Value of ``particle`` for locations that were not linked yet
+NO_PARTICLE = -1
+
+
+def empty(size=0):
+    """ :return: a record array of locations with all the values undefined."""
+    records = np.empty(size, dtype=LOCATIONS_DTYPE)
+    for name in LOCATIONS_DTYPE.names:
+        records[name] = NO_PARTICLE if LOCATIONS_DTYPE[name].kind == 'i' else np.nan
+    return records
+
+
+def to_records(locations, frame=None):
+    """ Converts the locations found by trackpy to a record array. Columns missing in the DataFrame are left undefined
+    and columns not in the schema are discarded.
+
+    :param DataFrame locations: As returned by ``trackpy.locate``
+    :param int frame: Frame number, it overrides the ``frame`` column of the DataFrame, if any
+    """
+    records = empty(len(locations))
+    for name in LOCATIONS_DTYPE.names:
+        if name in locations:
+            records[name] = locations[name].values
+    if frame is not None:
+        records['frame'] = frame
+    return records
+
+
+def to_dataframe(records):
+    """ Converts a record array to a DataFrame with one column per field, as if it was generated by trackpy. """
+    return DataFrame({name: records[name] for name in records.dtype.names})
+
+
+def schema_version(records):
+    """ Returns the version of the schema used by a record array, for example one read from an HDF5 file.
+
+    :raises ValueError: if the columns do not correspond to any version of the schema
+    """
+    for version, dtype in SCHEMAS.items():
+        if records.dtype == dtype:
+            return version
+    raise ValueError('The columns {} do not correspond to any version of the schema'.format(records.dtype.names))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming Linker
+================
+Links the locations published on ``locations`` frame by frame, as ``trackpy.link`` would do with the whole
+measurement, and keeps the trajectories of the particles that are still being tracked. A particle that is not found
+for more than ``memory`` frames can not be linked anymore, therefore its trajectory is complete: it is retired from
+the linker and published on :data:`TRAJECTORIES_TOPIC`, as ``[timestamp, records, frame_id]``, with the locations of
+every trajectory retired on that frame, sorted by particle and frame. Trajectories shorter than ``min_length``
+locations are discarded when retired.
+
+Therefore, the memory and the time spent on every frame are proportional to the number of particles being tracked,
+and do not grow with the length of the measurement. The links of every frame are still published on
+``particle_links``, for the consumers that need them as soon as possible.
+
+The frames are linked by ``trackpy.linking.Linker`` or, with ``engine: pynta`` in the ``link`` section of the
+tracking configuration, by the in-tree :class:`~pynta.model.experiment.nanoparticle_tracking.fast_link.KDTreeLinker`,
+much faster for dense samples, see :data:`LINKERS`. Wide fields of view can be linked in vertical strips, in parallel,
+with ``strip_width``, see :mod:`~pynta.model.experiment.nanoparticle_tracking.partitioned_link`.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import numpy as np
+from trackpy.linking import Linker
+
+from pynta.model.experiment.nanoparticle_tracking import fast_link
+from pynta.model.experiment.nanoparticle_tracking.partitioned_link import PartitionedLinker
+from pynta.model.experiment.nanoparticle_tracking.schema import empty, LOCATIONS_DTYPE
+
+#: Topic on which the complete trajectories are published
+TRAJECTORIES_TOPIC = 'trajectories'
+
+#: In-tree linkers, by the value of ``engine`` that selects them. Other values use trackpy
+LINKERS = {
+    fast_link.ENGINE: fast_link.KDTreeLinker,
+}
+
+
+def frame_gap(previous, frame_id):
+    """ :return: the number of frames between two frames linked one after the other, 1 if they are consecutive or if
+        their numbers are not known.
+    """
+    if previous is None or frame_id is None:
+        return 1
+    return max(frame_id - previous, 1)
+
+
+def link_level(linker, coords, t, search_range, gap=1):
+    """ Links the coordinates found on a frame to the previous ones. Brownian displacements grow with the square root
+    of the time, therefore the search range is widened when frames were skipped or lost since the previous frame
+    linked, see :mod:`~pynta.model.experiment.nanoparticle_tracking.load_shedding`. The memory keeps counting frames
+    linked.
+
+    :param linker: ``trackpy.linking.Linker`` or one of :data:`LINKERS`
+    :param coords: Array with the coordinates of the particles
+    :param int t: Number of frames linked so far, 0 for the first one
+    :param float search_range: Search range of the linker between consecutive frames
+    :param int gap: Number of frames since the previous one linked
+    """
+    if t == 0:
+        linker.init_level(coords, t)
+    else:
+        linker.search_range = search_range * np.sqrt(gap)
+        linker.next_level(coords, t)
+
+
+class StreamingLinker:
+    """ Links locations frame by frame and retires the trajectories that can not grow anymore, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.streaming_linker`.
+
+    :param float search_range: Maximum displacement of a particle between consecutive frames, in pixels
+    :param int memory: Frames that a particle can be missing and still be linked
+    :param int min_length: Trajectories with fewer locations are discarded when retired
+    :param str engine: Linker used, see :data:`LINKERS`, by default ``trackpy.linking.Linker``
+    :param float strip_width: Width of the strips in which the field is linked, in pixels, by default it is linked
+        whole. Only with the ``pynta`` engine
+    :param int strip_threads: Threads linking the strips in parallel
+    :param kwargs: Other arguments of the linker
+    """
+    def __init__(self, search_range, memory=0, min_length=1, engine=None, strip_width=None, strip_threads=1, **kwargs):
+        if strip_width:
+            if engine != fast_link.ENGINE:
+                raise ValueError('Linking in strips needs the {} engine, not {}'.format(fast_link.ENGINE, engine))
+            self.linker = PartitionedLinker(search_range, strip_width, memory, strip_threads, **kwargs)
+        else:
+            self.linker = LINKERS.get(engine, Linker)(search_range, memory=memory, **kwargs)
+        self.search_range = self.linker.search_range
+        self.memory = memory
+        self.min_length = min_length
+
+        self.levels = 0  # Frames linked so far
+        self.previous = None  # Number of the last frame linked
+        self.retired = 0  # Trajectories retired, including the ones discarded
+        self._tracks = {}  # Locations of each live particle, as tuples
+        self._last_seen = {}  # Last level at which each live particle was found
+
+    @property
+    def live(self):
+        """ Number of trajectories that can still be linked."""
+        return len(self._tracks)
+
+    @property
+    def capped(self):
+        """ Number of subnetworks split because they were too large, only with the in-tree linker."""
+        return getattr(self.linker, 'capped', 0)
+
+    def link(self, locations, frame_id=None):
+        """ Links the locations of a frame to the trajectories.
+
+        :param locations: Record array with the locations found on the frame
+        :param int frame_id: Number of the frame, to widen the search range if frames were skipped
+        :return: a copy of the locations with the ``particle`` set, and a record array with the trajectories retired
+        """
+        locations = locations.copy()  # The received records share the read-only memory of the message
+        coords = np.column_stack((locations['x'], locations['y']))
+        link_level(self.linker, coords, self.levels, self.search_range, frame_gap(self.previous, frame_id))
+        locations['particle'] = self.linker.particle_ids
+        for particle, row in zip(locations['particle'].tolist(), locations.tolist()):
+            self._tracks.setdefault(particle, []).append(row)
+            self._last_seen[particle] = self.levels
+        self.levels += 1
+        self.previous = frame_id
+        oldest = self.levels - 1 - self.memory  # Particles not found since before this level are not in memory
+        return locations, self._retire([particle for particle, level in self._last_seen.items() if level < oldest])
+
+    def finish(self):
+        """ Retires every trajectory, for example at the end of a measurement.
+
+        :return: record array with the locations of the trajectories
+        """
+        return self._retire(list(self._tracks))
+
+    def close(self):
+        """ Releases the threads of the linker, if any."""
+        if hasattr(self.linker, 'close'):
+            self.linker.close()
+
+    def _retire(self, particles):
+        rows = []
+        for particle in sorted(particles):
+            track = self._tracks.pop(particle)
+            del self._last_seen[particle]
+            if len(track) >= self.min_length:
+                rows += track
+        self.retired += len(particles)
+        return np.array(rows, dtype=LOCATIONS_DTYPE) if rows else empty()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled Localization
+==================
+Frames of large sensors (for example 2048x2048 pixels of an sCMOS camera) take long to localize even when the frames
+are distributed among a pool of processes: the pool increases the throughput, but each frame still waits for a single
+worker. Splitting the frame in tiles that are localized in parallel reduces the time spent on each frame, which is
+what the linking needs.
+
+Each tile is extended by a margin of one particle diameter plus the separation between particles on every side,
+therefore a particle close to the border of a tile is seen whole by its neighbor too. The locations found in the
+margins are stitched as follows:
+
+* A tile keeps the particles inside its own area, extended by half the separation between particles. The rest belong
+  to a neighbor.
+* A particle kept by two tiles is found twice, at almost the same position. Of locations closer than the separation,
+  only the one with the largest mass is kept, and of equally bright ones, the closest to the top left corner. That is
+  the same criterion ``trackpy.locate`` applies to the whole frame, therefore the result does not depend on the order
+  in which the tiles finish.
+
+With the ``pynta`` engine, the tiles are filtered first and the filtered areas put together, to compute the scale of
+the filtered image, the threshold of the local maxima and the noise of the background on the whole image, as
+``locate`` would (see :func:`~pynta.model.experiment.nanoparticle_tracking.fast_locate.levels`). The tiles share them,
+therefore they find the same particles as the whole image, with the same columns. Other engines compute them on each
+tile, and the particles close to the minimum mass may differ.
+
+The tiles are localized with any executor of :mod:`concurrent.futures`. A ``ThreadPoolExecutor`` helps as long as the
+localization spends its time in numpy and scipy operations that release the GIL, which is the case for most of the
+in-tree engine (see :mod:`~pynta.model.experiment.nanoparticle_tracking.fast_locate`).
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+from functools import partial
+
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking import fast_locate
+from pynta.model.experiment.nanoparticle_tracking.fast_locate import where_close
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+
+
+def extend(area, margin, shape):
+    """ :return: the area ``(y0, y1, x0, x1)`` extended by a margin on every side, without going beyond the image."""
+    y0, y1, x0, x1 = area
+    return max(y0 - margin, 0), min(y1 + margin, shape[0]), max(x0 - margin, 0), min(x1 + margin, shape[1])
+
+
+def tile_bounds(shape, tiles, margin):
+    """ Splits an image in tiles of about the same size.
+
+    :param tuple shape: Shape of the image
+    :param tiles: Number of tiles along each axis, ``(rows, columns)``, or the same number for both
+    :param int margin: Pixels added to every side of the tiles, without going beyond the image
+    :return: list with the ``(window, area)`` of each tile, as ``(y0, y1, x0, x1)``. The window includes the margin.
+    """
+    if np.isscalar(tiles):
+        tiles = (tiles, tiles)
+    edges = [np.linspace(0, size, count + 1).round().astype(int) for size, count in zip(shape, tiles)]
+    bounds = []
+    for y0, y1 in zip(edges[0][:-1], edges[0][1:]):
+        for x0, x1 in zip(edges[1][:-1], edges[1][1:]):
+            bounds.append((extend((y0, y1, x0, x1), margin, shape), (y0, y1, x0, x1)))
+    return bounds
+
+
+def locate_tiled(image, locate, tiles, executor=None, **kwargs):
+    """ Locates the particles of an image in tiles, and stitches the locations of all the tiles.
+
+    :param image: 2D image
+    :param locate: Function that takes an image and the keyword arguments and returns a record array of locations
+    :param tiles: Number of tiles along each axis, see :func:`tile_bounds`
+    :param executor: :class:`concurrent.futures.Executor` on which the tiles are localized, if ``None`` they are
+        localized one after the other. A process pool needs a ``locate`` function that can be pickled
+    :param kwargs: Arguments of ``locate``, ``diameter`` is mandatory
+    :return: record array of locations, in the coordinates of the image
+    """
+    separation = kwargs.get('separation')
+    margin = int(kwargs['diameter']) + int(kwargs['diameter'] + 1 if separation is None else separation)
+    return locate_regions(image, locate, tile_bounds(image.shape, tiles, margin), executor, **kwargs)
+
+
+def run(executor, function, *iterables):
+    """ :return: list with the results of the function on the executor, or on this thread if it is ``None``."""
+    if executor is None:
+        return list(map(function, *iterables))
+    return list(executor.map(function, *iterables))
+
+
+def locate_regions(image, locate, bounds, executor=None, **kwargs):
+    """ Locates the particles in regions of an image and stitches their locations, as described in
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`. The regions do not need to cover the whole image.
+
+    :param locate: Function that locates the particles of a window, see :func:`locate_tiled`. The regions located with
+        :func:`~pynta.model.experiment.nanoparticle_tracking.fast_locate.locate` share the levels of the whole image
+    :param bounds: List with the ``(window, area)`` of each region, see :func:`tile_bounds`
+    :return: record array of the locations in the areas, in the coordinates of the image
+    """
+    separation = kwargs.get('separation')
+    separation = kwargs['diameter'] + 1 if separation is None else separation
+    topn = kwargs.pop('topn', None)  # Only meaningful for the whole image
+    if locate is fast_locate.locate:
+        results = locate_shared(image, bounds, executor, **kwargs)
+    else:
+        results = run(executor, partial(locate, **kwargs), [image[y0:y1, x0:x1] for (y0, y1, x0, x1), area in bounds])
+
+    half = separation / 2
+    stitched = [empty()]
+    for (window, (y0, y1, x0, x1)), records in zip(bounds, results):
+        records = records.copy()
+        records['y'] += window[0]
+        records['x'] += window[2]
+        keep = (records['y'] >= y0 - half) & (records['y'] < y1 + half)
+        keep &= (records['x'] >= x0 - half) & (records['x'] < x1 + half)
+        stitched.append(records[keep])
+    records = np.concatenate(stitched)
+    if separation > 0 and len(records):
+        records = np.delete(records, where_close(np.column_stack((records['y'], records['x'])), separation,
+                                                 records['mass']))
+    if topn is not None and len(records) > topn:
+        records = records[np.argsort(records['mass'])[-topn:]]
+    return records
+
+
+def locate_shared(image, bounds, executor=None, **kwargs):
+    """ Locates the particles in regions of an image with the ``pynta`` engine, with the levels of the areas put
+    together, see :mod:`~pynta.model.experiment.nanoparticle_tracking.tiling`.
+
+    :return: list with the record arrays of each region, in the coordinates of its window
+    """
+    raw_image = fast_locate.check_image(image, kwargs['diameter'], kwargs.get('invert', False))
+    windows = [(slice(y0, y1), slice(x0, x1)) for (y0, y1, x0, x1), area in bounds]
+    processed = run(executor, partial(fast_locate.process, **kwargs), [raw_image[window] for window in windows])
+    image = np.zeros(raw_image.shape, dtype=processed[0].dtype if processed else float)
+    covered = np.zeros(raw_image.shape, dtype=bool)
+    for ((y0, y1, x0, x1), area), filtered in zip(bounds, processed):
+        inside = (slice(area[0] - y0, area[1] - y0), slice(area[2] - x0, area[3] - x0))
+        image[area[0]:area[1], area[2]:area[3]] = filtered[inside]
+        covered[area[0]:area[1], area[2]:area[3]] = True
+    # The margins take the values of the areas they overlap, filtered away from the borders of the windows
+    processed = [np.where(covered[window], image[window], filtered) for window, filtered in zip(windows, processed)]
+    levels = fast_locate.levels(raw_image, image, mask=covered, **kwargs)
+    return run(executor, partial(fast_locate.locate_processed, **kwargs, **levels),
+               [raw_image[window] for window in windows], processed)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Track Store
+===========
+Links arrive as small record arrays, one per frame, for the whole measurement. Concatenating them every time a new
+one arrives, or appending them to a DataFrame, copies everything received so far and the cost of a measurement grows
+with the square of its length. A :class:`TrackStore` keeps them instead:
+
+* By columns, one numpy array per field of the records, by default those of
+  :data:`~pynta.model.experiment.nanoparticle_tracking.schema.LOCATIONS_DTYPE`, in chunks of ``chunk_size`` rows
+  allocated when the previous chunk is full. Appending copies only the new rows, and
+  the rows stored are never moved.
+* With an index of the rows of every particle, therefore the trajectory of a particle is read without going through
+  the rest of the rows. The index of a particle is kept as the list of the rows added by each append, and merged in a
+  single array when the particle is read.
+
+The whole store is converted to a record array (:meth:`TrackStore.records`) or a DataFrame
+(:meth:`TrackStore.to_dataframe`) only when requested, for example to filter the trajectories with trackpy. A store can
+be filled and read from different threads.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import threading
+
+import numpy as np
+from pandas import DataFrame
+
+from pynta.model.experiment.nanoparticle_tracking.schema import LOCATIONS_DTYPE
+
+CHUNK_SIZE = 65536  # Rows of each chunk, about 5 MB with the columns of the schema
+
+
+class TrackStore:
+    """ Accumulates locations by columns, with an index of the rows of each particle, see
+    :mod:`~pynta.model.experiment.nanoparticle_tracking.track_store`.
+
+    :param dtype: Columns of the records, by default those of the schema of the locations
+    :param int chunk_size: Rows allocated at once
+    """
+    def __init__(self, dtype=LOCATIONS_DTYPE, chunk_size=CHUNK_SIZE):
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._chunks = []  # Dictionaries with an array of chunk_size elements for each column
+        self._size = 0
+        self._index = {}  # Rows of each particle, as a list of arrays
+
+    def __len__(self):
+        return self._size
+
+    def append(self, records):
+        """ Adds the rows of a record array, with the columns of the store."""
+        with self._lock:
+            start = self._size
+            added = 0
+            while added < len(records):
+                chunk, position = divmod(self._size, self.chunk_size)
+                if chunk == len(self._chunks):
+                    self._chunks.append({name: np.empty(self.chunk_size, self.dtype[name])
+                                         for name in self.dtype.names})
+                count = min(len(records) - added, self.chunk_size - position)
+                for name, column in self._chunks[chunk].items():
+                    column[position:position + count] = records[name][added:added + count]
+                added += count
+                self._size += count
+            if 'particle' in self.dtype.names and len(records):
+                particles = np.asarray(records['particle'])
+                order = np.argsort(particles, kind='stable')
+                bounds = np.flatnonzero(np.diff(particles[order])) + 1
+                for rows in np.split(order, bounds):
+                    self._index.setdefault(int(particles[rows[0]]), []).append(rows + start)
+
+    def particles(self):
+        """ :return: array with the numbers of the particles stored."""
+        with self._lock:
+            return np.array(sorted(self._index), dtype=int)
+
+    def rows(self, particle):
+        """ :return: array with the rows of a particle, in the order in which they were added."""
+        with self._lock:
+            rows = self._index.get(particle)
+            if rows is None:
+                return np.zeros(0, dtype=int)
+            if len(rows) > 1:
+                rows[:] = [np.concatenate(rows)]
+            return rows[0]
+
+    def take(self, rows):
+        """ :return: record array with the given rows."""
+        rows = np.asarray(rows, dtype=int)
+        records = np.empty(len(rows), dtype=self.dtype)
+        chunks, positions = np.divmod(rows, self.chunk_size)
+        with self._lock:
+            for chunk in np.unique(chunks):
+                selected = chunks == chunk
+                for name, column in self._chunks[chunk].items():
+                    records[name][selected] = column[positions[selected]]
+        return records
+
+    def track(self, particle):
+        """ :return: record array with the locations of a particle."""
+        return self.take(self.rows(particle))
+
+    def columns(self):
+        """ :return: dictionary with an array of all the rows stored for each column."""
+        with self._lock:
+            size = self._size
+            chunks = list(self._chunks)
+        columns = {}
+        for name in self.dtype.names:
+            parts = [chunk[name] for chunk in chunks]
+            column = np.concatenate(parts) if parts else np.zeros(0, self.dtype[name])
+            columns[name] = column[:size]
+        return columns
+
+    def records(self):
+        """ :return: record array with all the rows stored."""
+        columns = self.columns()
+        records = np.empty(len(columns[self.dtype.names[0]]), dtype=self.dtype)
+        for name, column in columns.items():
+            records[name] = column
+        return records
+
+    def to_dataframe(self):
+        """ :return: DataFrame with all the rows stored, one column per field, as if it was generated by trackpy."""
+        return DataFrame(self.columns())
+
+    def clear(self):
+        """ Removes all the rows stored, for example before a new measurement."""
+        with self._lock:
+            self._chunks = []
+            self._size = 0
+            self._index = {}
@@ -3,52 +3,180 @@
 Publisher
 =========
 
-Publishers are responsible for broadcasting the message over the ZMQ PUB/SUB architecture. The publisher runs
-continuously on a separated process and grabs elements from a queue, which in turn are sent through a socket to any
-other processes listening. 
+Publishers are responsible for broadcasting the message over the ZMQ PUB/SUB architecture. There are two modes of
+operation:
 
-.. TODO:: In the current implementation, data is serialized for being added to a Queue, then deserialized by the
-    publisher and serialized again to be sent. These three steps could be simplify into one if, for example, one assumes
-    that objects where pickled. There is also a possibility of assuming numpy arrays and using a zero-copy strategy.
+* ``'direct'``: every producer sends its messages straight away through its own socket to a forwarder that runs on a
+  thread of the process that owns the :class:`Publisher`. The forwarder binds the port on which subscribers listen and
+  passes the messages along without deserializing them, with the proxy of ZMQ, which does not hold the GIL. Producers
+  running on other processes (for example the localization) get a :class:`PublisherSocket`, which offers the same
+  ``put`` method as a Queue.
+* ``'queue'``: the publisher runs continuously on a separated process and grabs elements from a queue, which in turn
+  are sent through a socket to any other processes listening. In this mode data is serialized for being added to the
+  Queue, deserialized by the publisher and serialized again to be sent.
+
+Messages are sent with :func:`~pynta.model.experiment.serialization.send_data`, which sends numpy arrays as raw
+buffers without copying them and only pickles other kinds of data. Every message carries a sequence number, which
+subscribers use to count the messages they lost (see :class:`~pynta.model.experiment.subscriber.Subscription`).
+
+Subscribers know that they are connected when they receive a welcome message: they subscribe to a unique topic
+starting with :data:`WELCOME_PREFIX`, the publisher sees the subscription arriving on its XPUB socket and replies on
+that topic. Since subscriptions travel in order, by then the subscription to the actual topic is active as well and
+no message published afterwards is lost. In direct mode the proxy passes the subscriptions on to the producers, and a
+producer of the forwarder itself (see :func:`monitor_forwarder`) replies to them.
+
+Transports
+----------
+The publisher always listens on a TCP port, which is the way for consumers on other computers to connect. Consumers
+on the same computer connect to :attr:`Publisher.address`, which with the ``'ipc'`` transport is a Unix domain socket
+and avoids the cost of going through the TCP loopback. Threads of the process that owns a direct publisher (for
+example the GUI) connect to :attr:`Publisher.local_address`, which uses ``inproc`` and does not touch the network at
+all. The transport is set in the ``bus`` section of the configuration and defaults to ``config.zmq_transport``. If
+the installed ZMQ does not support ``ipc`` (it is the case on older Windows builds), ``tcp`` is used instead.
+
+The publisher buffers at most ``send_hwm`` messages for each subscriber, anything above that is buffered by the
+subscriber itself, according to its delivery class. The memory used by a slow consumer is therefore bounded.
+
+The publisher reports the messages and bytes it forwards on the ``stats`` topic, see
+:mod:`~pynta.model.experiment.telemetry`.
 
 :copyright:  Aquiles Carattino <aquiles@uetke.com>
 :license: GPLv3, see LICENSE for more details
 """
 
 import logging
+import os
+import struct
+import tempfile
+import threading
 from multiprocessing import Queue, Event, Process
-from time import sleep
+from queue import Empty
+from time import perf_counter, sleep
+from uuid import uuid4
 import zmq
+from zmq.utils.garbage import gc as zmq_gc
 
 from pynta import general_stop_event
 from pynta.model.experiment import config
+from pynta.model.experiment.serialization import Sequencer, send_data
+from pynta.model.experiment.telemetry import Telemetry, STATS_TOPIC
 from pynta.util.log import get_logger
 
 
+MODE_DIRECT = 'direct'
+MODE_QUEUE = 'queue'
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_IPC = 'ipc'
+
+STOP_CHECK_INTERVAL = 0.1  # Maximum time (s) loops wait for data before checking whether they have to stop
+BIND_ATTEMPTS = 10  # Pairs of ports tried by the forwarder before giving up
+CLOSE_LINGER = 1000  # Maximum time (ms) to keep delivering pending messages after closing a socket
+WELCOME_PREFIX = '_welcome.'  # Topics used to tell subscribers that they are connected
+
+
+def endpoint(port, transport=TRANSPORT_TCP, host='localhost'):
+    """ Address to which to connect in order to reach a port of the bus.
+
+    :param int port: The port, which also identifies the ``ipc`` endpoints
+    :param str transport: Either ``'tcp'`` or ``'ipc'``
+    :param str host: Computer on which the publisher runs, only for ``tcp``
+    """
+    if transport == TRANSPORT_IPC:
+        return 'ipc://' + os.path.join(tempfile.gettempdir(), 'pynta_bus_{}'.format(port))
+    return 'tcp://{}:{}'.format(host, port)
+
+
+def bind(socket, port, transport):
+    """ Binds a socket to a TCP port on every interface and, if the transport is ``ipc``, to its ``ipc`` endpoint.
+    The TCP port is bound first, therefore it is the one that tells whether the port is already in use.
+    """
+    socket.bind('tcp://*:{}'.format(port))
+    if transport == TRANSPORT_IPC:
+        socket.bind(endpoint(port, TRANSPORT_IPC))
+
+
+def bind_random(socket, transport=TRANSPORT_TCP):
+    """ Binds a socket used only on this computer to a new endpoint, a random TCP port or a unique ``ipc`` path.
+
+    :return: the address to which to connect
+    """
+    if transport == TRANSPORT_IPC:
+        address = 'ipc://' + os.path.join(tempfile.gettempdir(), 'pynta_{}_{}'.format(os.getpid(), uuid4().hex[:8]))
+        socket.bind(address)
+        return address
+    return 'tcp://127.0.0.1:{}'.format(socket.bind_to_random_port('tcp://127.0.0.1'))
+
+
+def check_transport(transport):
+    """ :return: the transport if it is available, ``'tcp'`` otherwise."""
+    if transport not in (TRANSPORT_TCP, TRANSPORT_IPC):
+        raise ValueError('Transport must be either {} or {}'.format(TRANSPORT_TCP, TRANSPORT_IPC))
+    if transport == TRANSPORT_IPC and not zmq.has('ipc'):
+        get_logger(name=__name__).warning('ZMQ does not support ipc on this computer, using tcp instead')
+        return TRANSPORT_TCP
+    return transport
+
+
 class Publisher:
-    """ Publisher class in which the queue for publishing messages is defined and also a separated process is started.
-    It is important to have a new process, since the serialization/deserialization of messages from the QUEUE may be
-    a bottleneck for performance.
+    """ Publisher class in which the way of publishing messages is defined. In ``'queue'`` mode a queue is created and
+    a separated process is started, since the serialization/deserialization of messages from the QUEUE may be a
+    bottleneck for performance. In ``'direct'`` mode a forwarder is started on a thread and producers write directly to
+    it.
+
+    :param int port: Port on which subscribers listen
+    :param str mode: Either ``'direct'`` or ``'queue'``, defaults to ``config.publisher_mode``
+    :param int input_port: Port on which the forwarder listens for producers of other processes (``'direct'`` only)
+    :param int send_hwm: Maximum number of messages buffered for each subscriber, defaults to ``config.zmq_send_hwm``
+    :param str transport: Either ``'ipc'`` or ``'tcp'``, used by consumers and producers on the same computer
+    :param float stats_interval: Seconds between the statistics published on ``stats``, defaults to
+        ``config.stats_interval``
     """
-    def __init__(self, port=None):
+    def __init__(self, port=None, mode=None, input_port=None, send_hwm=None, transport=None, stats_interval=None):
         self.logger = get_logger(name=__name__)
         if not port:
             self._port = config.zmq_port
         else:
             self._port = port
-        self._queue = Queue()  # The publisher will grab and broadcast the messages from this queue
+        self.mode = mode or config.publisher_mode
+        if self.mode not in (MODE_DIRECT, MODE_QUEUE):
+            raise ValueError('Publisher mode must be either {} or {}'.format(MODE_DIRECT, MODE_QUEUE))
+
+        self._input_port = input_port or config.zmq_input_port
+        self.send_hwm = send_hwm or config.zmq_send_hwm
+        self.transport = check_transport(transport or config.zmq_transport)
+        self.stats_interval = config.stats_interval if stats_interval is None else stats_interval
         self._event = Event()   # This event is used to stop the process
         self._process = None
-        self.logger.info('Initialized publisher on port {}'.format(self._port))
+        self._thread = None
+        self._monitor = None
+        self._control = None
+        if self.mode == MODE_QUEUE:
+            self._queue = Queue()  # The publisher will grab and broadcast the messages from this queue
+        else:
+            self._queue = PublisherSocket(self.input_address, send_hwm=self.send_hwm)
+            self._local_queue = PublisherSocket(self.inproc_address, send_hwm=self.send_hwm)
+        self.logger.info('Initialized {} publisher on port {} over {}'.format(self.mode, self._port, self.transport))
 
     def start(self):
-        """ Start a new process that will be responsible for broadcasting the messages.
+        """ Start a new process (or a thread in direct mode) that will be responsible for broadcasting the messages.
+        In direct mode, if the ports are in use the next ones are tried.
 
-            .. TODO:: Find a way to start the publisher on a different port if the one specified is in use.
+            .. TODO:: Find a way to start the queue publisher on a different port if the one specified is in use.
         """
         self._event.clear()
+        # Large messages are sent without copying them, and the first one starts the garbage collector of pyzmq while
+        # holding a lock. A process forked meanwhile inherits the lock held and blocks on its own first large message.
+        # Starting the collector before any process is forked avoids it
+        if not zmq_gc.is_alive():
+            zmq_gc.start()
+        if self.mode == MODE_DIRECT:
+            return self._start_forwarder()
+
         try:
-            self._process = Process(target=publisher, args=[self._queue, self._event, self._port])
+            self._process = Process(target=publisher,
+                                    args=[self._queue, self._event, self._port, self.send_hwm, self.transport,
+                                          self.stats_interval])
             self._process.start()
             return True
         except zmq.ZMQError:
@@ -56,10 +184,72 @@ class Publisher:
             config.zmq_port = self._port
             return self.start()
 
-        # sleep(1)  # This forces the start to block until the publisher is ready
+    def _start_forwarder(self):
+        """ Binds the sockets of the forwarder on this thread, in order to catch errors, and hands them to a new
+        thread. If the ports are in use, the next ones are tried up to :data:`BIND_ATTEMPTS` times.
+        """
+        context = zmq.Context.instance()
+        for attempt in range(BIND_ATTEMPTS):
+            frontend = context.socket(zmq.XSUB)
+            backend = context.socket(zmq.XPUB)
+            backend.setsockopt(zmq.SNDHWM, self.send_hwm)
+            backend.setsockopt(zmq.LINGER, CLOSE_LINGER)
+            try:
+                bind(backend, self._port, self.transport)
+                bind(frontend, self._input_port, self.transport)
+                break
+            except zmq.ZMQError:
+                frontend.close(linger=0)
+                backend.close(linger=0)
+                if attempt == BIND_ATTEMPTS - 1:
+                    raise
+                self.logger.warning('Ports {} or {} in use, trying the next ones'.format(self._port, self._input_port))
+                self._port += 2
+                self._input_port += 2
+        if attempt:
+            config.zmq_port = self._port
+            config.zmq_input_port = self._input_port
+            self._queue = PublisherSocket(self.input_address, send_hwm=self.send_hwm)
+            self._local_queue = PublisherSocket(self.inproc_address, send_hwm=self.send_hwm)
+
+        frontend.bind(self.inproc_address)
+        backend.bind(self.local_address)
+        frontend.send(b'\x01')  # Subscribe to everything, the filtering happens on the backend
+        proxy_control = context.socket(zmq.PAIR)
+        proxy_control.bind('inproc://pynta_publisher_proxy_{}'.format(self._port))
+        self._thread = threading.Thread(target=forwarder, args=[frontend, backend, proxy_control], daemon=True)
+        self._thread.start()
+
+        self._control = context.socket(zmq.PAIR)
+        control = context.socket(zmq.PAIR)
+        control_address = 'inproc://pynta_publisher_control_{}'.format(self._port)
+        control.bind(control_address)
+        self._control.connect(control_address)
+        proxy_control = context.socket(zmq.PAIR)
+        proxy_control.connect('inproc://pynta_publisher_proxy_{}'.format(self._port))
+        telemetry = Telemetry('publisher', interval=self.stats_interval)
+        self._monitor = threading.Thread(target=monitor_forwarder,
+                                         args=[self.inproc_address, control, proxy_control, telemetry, self._thread],
+                                         daemon=True)
+        self._monitor.start()
+        self.logger.info('Started the forwarder on port {}'.format(self._port))
+        return True
 
     def stop(self):
         self._event.set()
+        if self.mode == MODE_DIRECT:
+            if self._control is not None:
+                self._control.send(b'TERMINATE')
+                self._monitor.join()
+                self._thread.join()
+                self._control.close()
+                self._control = None
+                self._local_queue.close_all()
+            return
+        try:
+            self._queue.put(None)  # Wakes up the publisher process
+        except (AssertionError, ValueError):
+            pass  # The queue was closed already
         self.empty_queue()
 
     def empty_queue(self):
@@ -72,19 +262,53 @@ class Publisher:
         self._queue.close()
 
     def publish(self, topic, data):
-        """ Adapts the data to make it faster to broadcast
+        """ Adapts the data to make it faster to broadcast. In direct mode numpy arrays are not copied, therefore they
+        should not be modified after publishing them.
 
         :param str topic: Topic in which to publish the data
         :param data: Data to be published
         :return: None
         """
         self.logger.debug('Adding data of type {} to topic {}'.format(type(data), topic))
+        if self.mode == MODE_DIRECT:
+            self._local_queue.put({'topic': topic, 'data': data})
+            return
         try:
             self._queue.put({'topic': topic, 'data': data})
         except AssertionError:
             # This means the queue has been closed already
             pass
 
+    @property
+    def queue(self):
+        """ Object with a ``put`` method that can be passed to other processes in order for them to publish data. Items
+        should be dictionaries ``{'topic': topic, 'data': data}``. It is either a Queue or a :class:`PublisherSocket`.
+        """
+        return self._queue
+
+    @property
+    def address(self):
+        """ Address to which consumers running on this computer should connect."""
+        return endpoint(self._port, self.transport)
+
+    @property
+    def local_address(self):
+        """ Address to which consumers running on threads of this process should connect. In queue mode the
+        publisher runs on a different process, therefore it is the same as :attr:`address`.
+        """
+        if self.mode == MODE_DIRECT:
+            return 'inproc://pynta_bus_{}'.format(self._port)
+        return self.address
+
+    @property
+    def input_address(self):
+        """ Address to which producers on other processes of this computer connect (direct mode only)."""
+        return endpoint(self._input_port, self.transport)
+
+    @property
+    def inproc_address(self):
+        return 'inproc://pynta_publisher_{}'.format(self._port)
+
     @property
     def port(self):
         return self._port
@@ -92,28 +316,186 @@ class Publisher:
     @port.setter
     def port(self, new_port):
         if new_port != self._port:
-            self._port = new_port
-            self.logger.warning('Changing the port requires restarting the publisher process')
+            self.logger.warning('Changing the port requires restarting the publisher')
             self.logger.debug('Setting the new publisher port to {}'.format(new_port))
             self.stop()
-            self._process.join()
-            self._process = Process(target=publisher, args=[self._queue, self._event, self._port])
+            self.join()
+            self._port = new_port
+            if self.mode == MODE_DIRECT:
+                self._local_queue = PublisherSocket(self.inproc_address, send_hwm=self.send_hwm)
             self.start()
         else:
             self.logger.warning('New port {} is the same as the old port'.format(new_port))
 
-    def join(self, timeout=0):
-        if self._process.is_alive():
+    def join(self, timeout=None):
+        if self._process is not None and self._process.is_alive():
             self.logger.debug('Waiting for Publisher process to finish')
             self._process.join(timeout)
+        for thread in (self._monitor, self._thread):
+            if thread is not None and thread.is_alive():
+                self.logger.debug('Waiting for the forwarder to finish')
+                thread.join(timeout)
+
+
+class PublisherSocket:
+    """ Drop-in replacement of the publisher queue for producers that publish directly to the forwarder of a
+    :class:`Publisher`. Items are dictionaries ``{'topic': topic, 'data': data}``, as with the Queue, but they are sent
+    immediately through a socket instead of going through the publisher process.
+
+    Sockets are created the first time each thread (or process) puts an item, therefore the object can be handed to
+    new processes or shared between threads. Creating the socket blocks until the forwarder is connected, to avoid
+    losing the first messages. The sockets created on a process are closed together with :meth:`close_all`.
+
+    :param str address: Address of the forwarder, for example ``tcp://localhost:5556``
+    :param float timeout: Maximum time to wait for the forwarder, in seconds
+    :param int send_hwm: Maximum number of messages each socket buffers while the forwarder does not take them, by
+        default the one of ZMQ
+    """
+    def __init__(self, address, timeout=5, send_hwm=None):
+        self.address = address
+        self.timeout = timeout
+        self.send_hwm = send_hwm
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sockets = []  # Sockets created by every thread, with the process that created them
+
+    def put(self, item):
+        socket = self.socket
+        sequence = self._local.sequencer.next(item['topic'])
+        send_data(socket, item['topic'], item['data'], sequence=sequence)
+
+    @property
+    def socket(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid() or local.socket.closed:
+            local.socket = self._connect()
+            local.sequencer = Sequencer()
+            local.pid = os.getpid()
+            with self._lock:
+                self._sockets.append((local.pid, local.socket))
+        return local.socket
+
+    def _connect(self):
+        """ Connects a new socket to the forwarder. It is an XPUB, and not a PUB, because it allows to know when the
+        forwarder subscribed to the data, i.e. when it is safe to start sending.
+        """
+        socket = zmq.Context.instance().socket(zmq.XPUB)
+        if self.send_hwm is not None:
+            socket.setsockopt(zmq.SNDHWM, self.send_hwm)
+        socket.connect(self.address)
+        if not socket.poll(self.timeout * 1000):
+            get_logger(name=__name__).warning('Forwarder on {} not ready after {}s'.format(self.address, self.timeout))
+        else:
+            socket.recv()  # The subscription of the forwarder
+        return socket
+
+    def close(self):
+        """ Closes the socket of the calling thread, if any.
+        """
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.socket.close()
+            self._local.pid = None
+
+    def close_all(self):
+        """ Closes the sockets created by every thread of the calling process, for example when the forwarder stops.
+        The threads should not be putting items anymore, a thread that puts one afterwards creates a new socket.
+        """
+        pid = os.getpid()
+        with self._lock:
+            sockets = [socket for owner, socket in self._sockets if owner == pid]
+            self._sockets = [(owner, socket) for owner, socket in self._sockets if owner != pid]
+        for socket in sockets:
+            socket.close()
 
+    def qsize(self):
+        return 0
 
-def publisher(queue, event, port):
-    """ Simple method that starts a publisher on the port 5555.
+    def __getstate__(self):
+        return {'address': self.address, 'timeout': self.timeout, 'send_hwm': self.send_hwm}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def welcome(socket):
+    """ Reads a subscription arriving on an XPUB socket and, if it is a request for a welcome message, replies to it.
+
+    :param zmq.Socket socket: XPUB socket to which subscribers connect
+    """
+    subscription = socket.recv()
+    if subscription[:1] == b'\x01' and subscription[1:].startswith(WELCOME_PREFIX.encode('ascii')):
+        send_data(socket, subscription[1:].decode('ascii'), 'welcome')
+
+
+def forwarder(frontend, backend, control):
+    """ Passes the messages arriving from the producers (``frontend``) to the subscribers (``backend``) without
+    deserializing them, and the subscriptions the other way. It runs the proxy of ZMQ, which does not hold the GIL,
+    until ``TERMINATE`` arrives on the ``control`` socket. The messages that were already sent by the producers are
+    forwarded before closing the sockets.
+
+    :param zmq.Socket frontend: XSUB socket to which producers connect
+    :param zmq.Socket backend: XPUB socket to which subscribers connect
+    :param zmq.Socket control: PAIR socket that steers the proxy, see :func:`monitor_forwarder`
+    """
+    zmq.proxy_steerable(frontend, backend, None, control)
+    while frontend.poll(0):
+        backend.send_multipart(frontend.recv_multipart(copy=False), copy=False)
+    frontend.close(linger=0)
+    backend.close()
+    control.close()
+    get_logger(name=__name__).info('Stopped the forwarder')
+
+
+def monitor_forwarder(address, control, proxy_control, telemetry=None, proxy=None):
+    """ Producer of the forwarder that welcomes the subscribers and publishes the statistics of the proxy on
+    ``stats``, until anything arrives on the ``control`` socket, which stops the proxy as well.
+
+    :param str address: Address of the frontend of the forwarder
+    :param zmq.Socket control: PAIR socket used to stop the forwarder
+    :param zmq.Socket proxy_control: PAIR socket connected to the control of the proxy, see :func:`forwarder`
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` whose reports are sent on ``stats``
+    :param threading.Thread proxy: Thread running :func:`forwarder`, waited for before closing the socket
+    """
+    socket = zmq.Context.instance().socket(zmq.XPUB)
+    socket.connect(address)
+    socket.recv()  # The subscription of the forwarder to everything
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    poller.register(control, zmq.POLLIN)
+    timeout = telemetry.interval * 1000 if telemetry is not None and telemetry.interval > 0 else None
+    forwarded = (0, 0)
+    while True:
+        sockets = dict(poller.poll(timeout))
+        if control in sockets:
+            control.recv()
+            break
+        if socket in sockets:
+            welcome(socket)  # The proxy passes the subscriptions on to the producers
+        if telemetry is not None and telemetry.due():
+            proxy_control.send(b'STATISTICS')
+            statistics = [struct.unpack('=Q', part)[0] for part in proxy_control.recv_multipart()]
+            telemetry.received(statistics[1] - forwarded[1], count=statistics[0] - forwarded[0])
+            forwarded = statistics[:2]
+            send_data(socket, STATS_TOPIC, telemetry.report())
+
+    proxy_control.send(b'TERMINATE')
+    # Closing a socket connected to the proxy while TERMINATE arrives can make the proxy miss it and never return
+    if proxy is not None:
+        proxy.join()
+    socket.close()
+    proxy_control.close()
+    control.close()
+
+
+def publisher(queue, event, port, send_hwm=None, transport=TRANSPORT_TCP, stats_interval=None):
+    """ Simple method that starts a publisher on the port 5555. Messages are sent as soon as they arrive to the queue.
 
     :param multiprocessing.Queue queue: Queue of messages to be broadcasted
     :param multiprocessing.Event event: Event to stop the publisher
     :param int port: port in which to broadcast data
+    :param int send_hwm: Maximum number of messages buffered for each subscriber
+    :param str transport: ``'ipc'`` to listen also on the ``ipc`` endpoint of the port
+    :param float stats_interval: Seconds between the statistics published on ``stats``
     .. TODO:: The publisher's port should be determined in a configuration file.
 
     .. deprecated:: 0.1.0
@@ -122,24 +504,32 @@ def publisher(queue, event, port):
     port_pub = port
     logger.debug(f'Binding publisher on port {port}')
     context = zmq.Context()
-    socket = context.socket(zmq.PUB)
-    print(port_pub)
-    socket.bind("tcp://*:%s" % port_pub)
-    sleep(1)    # It takes a time for subscribers to propagate to the publisher.
-                # Without this sleep the first packages may be lost
+    socket = context.socket(zmq.XPUB)  # Instead of PUB, to be able to welcome the subscribers
+    socket.setsockopt(zmq.SNDHWM, send_hwm or config.zmq_send_hwm)
+    socket.setsockopt(zmq.LINGER, CLOSE_LINGER)
+    sequencer = Sequencer()
+    telemetry = Telemetry('publisher', interval=stats_interval, queue_depth=queue.qsize)
+    bind(socket, port_pub, transport)
     logger.info('Bound socket on {}'.format(port_pub))
-    while not event.is_set():
-        while not queue.empty():
-            data = queue.get()  # Should be a dictionary {'topic': topic, 'data': data}
-            logger.debug('Sending {} on {}'.format(data['data'], data['topic']))
-            socket.send_string(data['topic'], zmq.SNDMORE)
-            socket.send_pyobj(data['data'])
-            if general_stop_event.is_set():
-                break
-        sleep(0.05)  # Sleeps 5 milliseconds to be polite with the CPU
+    while not event.is_set() and not general_stop_event.is_set():
+        while socket.poll(0):
+            welcome(socket)
+        if telemetry.due():
+            send_data(socket, STATS_TOPIC, telemetry.report())
+        try:
+            # Blocks until there is data, the timeout only bounds the time needed to notice the stop events
+            data = queue.get(timeout=STOP_CHECK_INTERVAL)  # Should be a dictionary {'topic': topic, 'data': data}
+        except Empty:
+            continue
+        if data is None:  # Put by Publisher.stop to wake the process up
+            break
+        logger.debug('Sending {} on {}'.format(type(data['data']), data['topic']))
+        t0 = perf_counter()
+        size = send_data(socket, data['topic'], data['data'], sequence=sequencer.next(data['topic']))
+        telemetry.processed(perf_counter() - t0)
+        telemetry.received(size)
 
-    sleep(1)  # Gives enough time to the subscribers to update their status
-    socket.close()
+    socket.close()  # Pending messages are still delivered, for at most CLOSE_LINGER
     logger.info('Stopped the publisher')
 
 
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+    Serialization
+    =============
+    Messages on the ZMQ bus are sent as multipart messages. The first part is the topic, the second part is a small
+    header encoded as JSON and the remaining parts, if any, are the raw buffers of the numpy arrays contained in the
+    data. In this way frames are broadcast without pickling them: the buffer of the array is handed to ZMQ with
+    ``copy=False`` and the receiving end rebuilds the array on top of the received buffer, also without a copy.
+
+    The data can be a numpy array or a list (or tuple) mixing numpy arrays with simple values (numbers, strings,
+    ``None``), such as the ``[timestamp, image, frame_id]`` published on ``free_run``. The header stores the dtype,
+    shape and strides of every array and the simple values themselves. Anything else is pickled, as it was done
+    before with ``send_pyobj``.
+
+    Producers can also add a sequence number to the header, counted per topic and per sender, which allows the
+    subscribers to know how many messages were dropped on the way. Numbered messages are also stamped with the time at
+    which they were sent, which subscribers use to measure how long they took to arrive.
+
+    .. warning:: Arrays rebuilt by :func:`recv_data` share the memory of the received message. Copy them before
+        modifying them in place.
+
+    :copyright:  Aquiles Carattino <aquiles@uetke.com>
+    :license: GPLv3, see LICENSE for more details
+"""
+import itertools
+import json
+import os
+import pickle
+from time import time
+
+import numpy as np
+
+KIND_ARRAY = 'array'
+KIND_SEQUENCE = 'sequence'
+KIND_PICKLE = 'pickle'
+
+_SIMPLE_TYPES = (bool, int, float, str, type(None))
+_sequencers = itertools.count()
+
+
+def _sendable_array(array):
+    """ Returns a version of the array whose memory can be handed to ZMQ as-is, together with its header. Arrays that
+    are neither C nor Fortran contiguous (for example a slice of a larger array) are copied.
+    """
+    if not (array.flags.c_contiguous or array.flags.f_contiguous):
+        array = np.ascontiguousarray(array)
+    header = {
+        'dtype': np.lib.format.dtype_to_descr(array.dtype),
+        'shape': array.shape,
+        'strides': array.strides,
+    }
+    return header, array.ravel(order='A').view(np.uint8)
+
+
+def _rebuild_array(header, buffer):
+    dtype = np.lib.format.descr_to_dtype(header['dtype'])
+    return np.ndarray(shape=header['shape'], dtype=dtype, buffer=buffer, strides=header['strides'])
+
+
+def _is_raw_array(item):
+    return isinstance(item, np.ndarray) and not item.dtype.hasobject
+
+
+def encode(data):
+    """ Splits the data into a header and a list of buffers.
+
+    :param data: The data to encode
+    :return: Tuple with the header (a dictionary) and the list of buffers to send after it.
+    """
+    if _is_raw_array(data):
+        header, buffer = _sendable_array(data)
+        return {'kind': KIND_ARRAY, 'array': header}, [buffer]
+
+    if type(data) in (list, tuple) and any(_is_raw_array(item) for item in data):
+        items = []
+        buffers = []
+        for item in data:
+            if _is_raw_array(item):
+                header, buffer = _sendable_array(item)
+                items.append({'array': header})
+                buffers.append(buffer)
+            elif isinstance(item, np.generic) and not isinstance(item, np.void):
+                items.append({'value': item.item()})
+            elif isinstance(item, _SIMPLE_TYPES):
+                items.append({'value': item})
+            else:
+                break
+        else:
+            return {'kind': KIND_SEQUENCE, 'tuple': isinstance(data, tuple), 'items': items}, buffers
+
+    return {'kind': KIND_PICKLE}, [pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)]
+
+
+def decode(header, buffers):
+    """ Inverse of :func:`encode`.
+
+    :param dict header: The header as returned by :func:`encode`
+    :param list buffers: Objects supporting the buffer protocol, one for each array in the data.
+    """
+    kind = header['kind']
+    if kind == KIND_ARRAY:
+        return _rebuild_array(header['array'], buffers[0])
+
+    if kind == KIND_SEQUENCE:
+        data = []
+        buffers = iter(buffers)
+        for item in header['items']:
+            if 'array' in item:
+                data.append(_rebuild_array(item['array'], next(buffers)))
+            else:
+                data.append(item['value'])
+        if header['tuple']:
+            return tuple(data)
+        return data
+
+    return pickle.loads(buffers[0])
+
+
+def send_data(socket, topic, data, flags=0, sequence=None):
+    """ Sends the data on the given topic through a ZMQ socket. Numpy arrays are sent without copying them, therefore
+    they should not be modified until ZMQ is done with them.
+
+    :param zmq.Socket socket: Socket through which to send the data
+    :param str topic: Topic of the message
+    :param data: Data to send
+    :param int flags: Flags passed to ZMQ, for example ``zmq.NOBLOCK``
+    :param sequence: Optional ``(sender, number)`` pair stored in the header, see :class:`Sequencer`. The time is
+        stored as well.
+    :return: The number of bytes sent
+    """
+    header, buffers = encode(data)
+    if sequence is not None:
+        header['seq'] = sequence
+        header['time'] = time()
+    parts = [topic.encode('utf-8'), json.dumps(header).encode('utf-8')]
+    parts.extend(buffers)
+    socket.send_multipart(parts, flags=flags, copy=False)
+    return sum(len(part) for part in parts)
+
+
+def recv_data(socket, flags=0):
+    """ Receives a message sent with :func:`send_data`.
+
+    :param zmq.Socket socket: Socket from which to receive
+    :param int flags: Flags passed to ZMQ, for example ``zmq.NOBLOCK``
+    :return: Tuple with the topic and the data
+    """
+    topic, header, data = recv_message(socket, flags)
+    return topic, data
+
+
+def recv_message(socket, flags=0):
+    """ Same as :func:`recv_data`, but it also returns the header of the message.
+
+    :return: Tuple with the topic, the header and the data
+    """
+    parts = socket.recv_multipart(flags=flags, copy=False)
+    return decode_parts(parts)
+
+
+def decode_parts(parts):
+    """ Decodes the parts of a multipart message (as ``zmq.Frame`` or bytes) sent with :func:`send_data`.
+
+    :return: Tuple with the topic, the header and the data
+    """
+    topic = _as_bytes(parts[0]).decode('utf-8')
+    header = json.loads(_as_bytes(parts[1]))
+    buffers = [getattr(part, 'buffer', part) for part in parts[2:]]
+    return topic, header, decode(header, buffers)
+
+
+def _as_bytes(part):
+    return getattr(part, 'bytes', part)
+
+
+class Sequencer:
+    """ Numbers the messages sent on each topic. Every instance has a different name, therefore it should be used by a
+    single socket.
+    """
+    def __init__(self):
+        self.sender = '{}-{}'.format(os.getpid(), next(_sequencers))
+        self._numbers = {}
+
+    def next(self, topic):
+        """ :return: the ``(sender, number)`` pair for the next message on the topic."""
+        number = self._numbers.get(topic, 0) + 1
+        self._numbers[topic] = number
+        return self.sender, number
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+    Shared Frames
+    =============
+    Broadcasting frames over the bus means that every subscriber gets its own copy of every frame. When the consumers
+    run on the same computer (saver, localization, GUI), it is much cheaper to write the frames once to a block of
+    shared memory and broadcast only where to find them. :class:`FrameRing` is a ring buffer of frames in shared
+    memory: the acquisition writes the ``n``-th frame to slot ``n % slots`` and publishes a :class:`SharedFrame` with
+    the slot, its generation, the frame number and the timestamp. Consumers use a :class:`FrameReader` to map the
+    slot and read the pixels without any serialization.
+
+    Every slot has a generation counter, which holds the number of frames written to the ring before the one stored in
+    it. The generation keeps increasing while the ring exists, also when the numbers of the frames start again with a
+    new free run. Consumers that are slower than the acquisition eventually find that a slot was already overwritten
+    by a newer frame (they have been lapped). This is detected by comparing the counter with the generation of the
+    message, before and after using the data, and raises :class:`~pynta.exceptions.exceptions.FrameOverwritten`.
+
+    .. warning:: The ring should be large enough to hold the frames that the slowest consumer needs to keep up, the
+        memory used is ``slots * frame.nbytes``.
+
+    :copyright:  Aquiles Carattino <aquiles@uetke.com>
+    :license: GPLv3, see LICENSE for more details
+"""
+import json
+import os
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from pynta.exceptions.exceptions import FrameOverwritten
+from pynta.util.log import get_logger
+
+#: Message published instead of the frame when using a :class:`FrameRing`
+SharedFrame = namedtuple('SharedFrame', ['timestamp', 'slot', 'frame_id', 'name', 'generation'])
+
+_META_SIZE = 256  # Bytes reserved at the beginning of the block to describe the ring
+_WRITING = -1  # Generation of a slot that is being written
+
+
+def _open_shared_memory(name):
+    """ Attaches to an existing block of shared memory. Only the process creating the ring is responsible for releasing
+    it, therefore the block is not tracked by the resource tracker of consumers, which would otherwise destroy it as
+    soon as the consumer finishes.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13 does not accept track
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == 'posix':
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class FrameRing:
+    """ Ring buffer of frames stored in shared memory. Use :meth:`create` on the producer side and :meth:`attach` on
+    the consumer side.
+
+    :param shm: The block of shared memory
+    :param tuple shape: Shape of each frame
+    :param dtype: Data type of the frames
+    :param int slots: Number of frames that fit in the ring
+    :param bool owner: Whether this instance created the block and is therefore responsible for releasing it
+    """
+    def __init__(self, shm, shape, dtype, slots, owner=False):
+        self._shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+        self.owner = owner
+        self.written = 0  # Frames written by this instance, the generation of the next one
+        offset = _META_SIZE + 8 * slots
+        self._generations = np.ndarray((slots, ), dtype=np.int64, buffer=shm.buf, offset=_META_SIZE)
+        self._frames = np.ndarray((slots, ) + self.shape, dtype=self.dtype, buffer=shm.buf, offset=offset)
+
+    @classmethod
+    def create(cls, shape, dtype, slots):
+        """ Allocates a new ring in shared memory.
+
+        :return: FrameRing
+        """
+        dtype = np.dtype(dtype)
+        size = _META_SIZE + 8 * slots + slots * int(np.prod(shape)) * dtype.itemsize
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        meta = json.dumps({'shape': list(shape), 'dtype': dtype.str, 'slots': slots}).encode('ascii')
+        shm.buf[:len(meta)] = meta
+        ring = cls(shm, shape, dtype, slots, owner=True)
+        ring._generations[:] = _WRITING
+        get_logger(name=__name__).info('Allocated {} slots of {} {} for frames in {}'.format(
+            slots, shape, dtype, ring.name))
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """ Maps an existing ring, created with :meth:`create` (probably on a different process).
+
+        :param str name: Name of the block of shared memory
+        :return: FrameRing
+        """
+        shm = _open_shared_memory(name)
+        meta = json.loads(bytes(shm.buf[:_META_SIZE]).rstrip(b'\x00'))
+        return cls(shm, meta['shape'], meta['dtype'], meta['slots'])
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def write(self, frame):
+        """ Copies the frame to the next slot. Only the instance that created the ring should write to it.
+
+        :param np.ndarray frame: The frame, it has to match the shape and the data type of the ring
+        :return: The slot in which the frame was stored and its generation
+        :raises ValueError: if the frame does not match the ring
+        """
+        if not self.fits(frame):
+            raise ValueError('A frame of {} {} does not fit in a ring of {} {}'.format(
+                frame.shape, frame.dtype, self.shape, self.dtype))
+        generation = self.written
+        slot = generation % self.slots
+        self._generations[slot] = _WRITING
+        self._frames[slot] = frame
+        self._generations[slot] = generation
+        self.written += 1
+        return slot, generation
+
+    def fits(self, frame):
+        """ Whether the frame has the shape and the data type of the ring."""
+        return frame.shape == self.shape and frame.dtype == self.dtype
+
+    def read(self, slot, generation, copy=False):
+        """ Returns the frame stored in a slot. Without a copy, the returned array is a view of the shared memory and
+        therefore the caller should check with :meth:`is_current` that the frame was not overwritten while using it.
+
+        :raises FrameOverwritten: if the slot does not hold the given generation anymore.
+        """
+        if self._generations[slot] != generation:
+            raise FrameOverwritten('Generation {} in slot {} was overwritten'.format(generation, slot))
+        frame = self._frames[slot]
+        if copy:
+            frame = frame.copy()
+            if not self.is_current(slot, generation):
+                raise FrameOverwritten('Generation {} in slot {} was overwritten'.format(generation, slot))
+        return frame
+
+    def is_current(self, slot, generation):
+        """ Whether the slot still holds the given generation.
+        """
+        return self._generations[slot] == generation
+
+    def close(self):
+        """ Releases the mapping of the ring. The owner also destroys the block of shared memory.
+        """
+        del self._frames
+        del self._generations
+        try:
+            self._shm.close()
+        except BufferError:
+            get_logger(name=__name__).warning('Frames of {} still in use, the ring remains mapped'.format(self.name))
+        if self.owner:
+            if os.name == 'posix':
+                # Consumers sharing the resource tracker may have unregistered the block when attaching
+                resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
+
+
+class FrameReader:
+    """ Gets the frames out of the messages published on ``free_run``, regardless of whether they are
+    :class:`SharedFrame` or the classic ``[timestamp, image, frame_id]`` lists. It keeps track of the rings it has
+    mapped and of how many frames were lost because they were overwritten before being read.
+    """
+    def __init__(self):
+        self._ring = None
+        self.overwritten = 0
+        self.logger = get_logger(name=__name__)
+
+    def read(self, data, copy=False):
+        """ Returns the timestamp, the image and the frame number of a message.
+
+        :raises FrameOverwritten: if the frame was overwritten before being read.
+        """
+        if not isinstance(data, SharedFrame):
+            frame_id = data[2] if len(data) > 2 else None
+            return data[0], data[1], frame_id
+
+        ring = self._get_ring(data.name)
+        try:
+            image = ring.read(data.slot, data.generation, copy=copy)
+        except FrameOverwritten:
+            self.overwritten += 1
+            raise
+        return data.timestamp, image, data.frame_id
+
+    def is_current(self, data):
+        """ Whether the frame of a message was not overwritten yet. Should be called after using the data returned by
+        :meth:`read` without a copy.
+        """
+        if not isinstance(data, SharedFrame):
+            return True
+        if self._get_ring(data.name).is_current(data.slot, data.generation):
+            return True
+        self.overwritten += 1
+        return False
+
+    def _get_ring(self, name):
+        if self._ring is None or self._ring.name != name:
+            if self._ring is not None:
+                self.close()
+            try:
+                self._ring = FrameRing.attach(name)
+            except FileNotFoundError:
+                self.overwritten += 1
+                raise FrameOverwritten('The ring {} does not exist anymore'.format(name))
+            self.logger.debug('Mapped the ring of frames {}'.format(name))
+        return self._ring
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.close()
+            self._ring = None
@@ -6,40 +6,368 @@
     another process in order to analyse, process, save, etc. It has to be noted that on UNIX systems, getting
     from a queue with ``Queue.get()`` is particularly slow, much slower than serializing a numpy array with
     cPickle.
+
+    Messages are received with :func:`~pynta.model.experiment.serialization.recv_data`, therefore numpy arrays are
+    rebuilt on top of the received buffers, without copies.
+
+    When a :class:`Subscription` is created it waits for the welcome message of the publisher (see
+    :func:`~pynta.model.experiment.publisher.welcome`), therefore it receives every message published after that.
+    Consumers started on other processes get an Event that is set at that moment, and whoever starts them can use
+    :func:`wait_ready` to block until they are actually receiving.
+
+    Quality of service
+    ------------------
+    Not every consumer needs every message. A :class:`Subscription` applies one of the following delivery classes,
+    which are defined per topic (and optionally per consumer) in the ``qos`` entry of the ``bus`` section of the
+    configuration:
+
+    * ``bounded``: messages are delivered in order and none is discarded by the subscription. Up to ``hwm`` messages
+      are buffered for a slow consumer (plus the ``send_hwm`` of the publisher), therefore the memory used is always
+      bounded. There is no backpressure on the producers: beyond that ZMQ discards the new messages, which are counted
+      as lost through the gaps in their sequence numbers. It suits consumers that keep up on average, such as the
+      saver.
+    * ``drop_oldest``: at most ``hwm`` messages are kept, when the consumer falls behind the oldest are discarded and
+      it keeps working on the most recent ones.
+    * ``latest``: only the newest message is delivered, useful for previews and monitors.
+
+    With ``drop_oldest`` and ``latest``, a thread of the subscription takes the messages from the socket as soon as
+    they arrive, also while the consumer is busy, and keeps only the newest ones. Otherwise the messages would wait in
+    the buffers of ZMQ, which discard the new ones once full.
+
+    For example::
+
+        qos:
+          default: {policy: bounded, hwm: 1000}
+          free_run: {policy: drop_oldest, hwm: 10}
+          free_run.saver: {policy: bounded, hwm: 200}
+          histogram: latest
+
+    Consumers that receive many small messages, such as ``locations`` and ``particle_links``, can take them in batches
+    with :meth:`Subscription.recv_batch`: everything available within ``batch_time`` seconds, up to ``batch_size``
+    messages. The overhead of the Python callbacks, queues and file writes is then paid once per batch. Both values are
+    also part of the delivery class, for example ``locations.saver: {batch_size: 100, batch_time: 0.05}``.
+
+    Every subscription counts, per topic, the messages it received and the ones it lost, either discarded by its
+    policy or detected as gaps in the sequence numbers added by the producers. A subscription given a
+    :class:`~pynta.model.experiment.telemetry.Telemetry` also reports the bytes received, the latency of the messages
+    and the time the consumer spends between consecutive calls to :meth:`~Subscription.recv`, i.e. handling each
+    message, and publishes them on ``stats``.
+
+    .. note:: ZMQ offers ``ZMQ_CONFLATE`` to keep only the last message, but it does not support multipart messages,
+        which is how data is sent over the bus. ``latest`` is therefore implemented by draining the socket and keeping
+        only the newest message.
 """
-from time import sleep
+import threading
+from collections import Counter, deque
+from time import time
+from uuid import uuid4
 
 import zmq
+
+from pynta.model.experiment.publisher import endpoint, STOP_CHECK_INTERVAL, WELCOME_PREFIX
+from pynta.model.experiment.serialization import decode_parts
 from pynta.util import get_logger
 
+BOUNDED = 'bounded'
+DROP_OLDEST = 'drop_oldest'
+LATEST = 'latest'
+POLICIES = (BOUNDED, DROP_OLDEST, LATEST)
+
+DEFAULT_QOS = {'policy': BOUNDED, 'hwm': 1000, 'batch_size': 1, 'batch_time': 0}
+DRAIN_HWM = 1000  # Messages ZMQ buffers at least for the thread that drains drop_oldest and latest subscriptions
+
+READY_TIMEOUT = 10  # Maximum time (s) a subscription waits for the welcome of the publisher
+START_TIMEOUT = 30  # Maximum time (s) to wait for a consumer to start, including importing its modules
+STOP_TIMEOUT = 5  # Maximum time (s) to wait for a consumer to finish after asking it to stop
+
+
+def get_qos(qos_config, topic, consumer=None):
+    """ Resolves the delivery class of a consumer of a topic. Entries of the configuration are looked up from the most
+    generic to the most specific: ``default``, ``topic`` and ``topic.consumer``. Each entry can be either a dictionary
+    with ``policy``, ``hwm``, ``batch_size`` and ``batch_time`` or just the name of the policy.
+
+    :param dict qos_config: The ``qos`` entry of the ``bus`` section of the configuration, it can be ``None``
+    :param str topic: The topic to which the consumer subscribes
+    :param str consumer: The name of the consumer
+    :return: dictionary with ``policy``, ``hwm``, ``batch_size`` and ``batch_time``
+    """
+    qos_config = qos_config or {}
+    qos = dict(DEFAULT_QOS)
+    keys = ['default', topic]
+    if consumer:
+        keys.append('{}.{}'.format(topic, consumer))
+    for key in keys:
+        entry = qos_config.get(key)
+        if isinstance(entry, str):
+            entry = {'policy': entry}
+        qos.update(entry or {})
+    if qos['policy'] not in POLICIES:
+        raise ValueError('Unknown QoS policy {} for {}, it must be one of {}'.format(qos['policy'], topic, POLICIES))
+    return qos
+
+
+class Subscription:
+    """ Socket subscribed to a topic of the bus, which delivers the messages according to a delivery class.
+
+    :param address: Address of the publisher (see :attr:`~pynta.model.experiment.publisher.Publisher.address`) or just
+        the port, in which case it connects through TCP to this computer
+    :param str topic: Topic to subscribe to, it works as a prefix
+    :param qos: Dictionary as returned by :func:`get_qos`, or just the name of the policy. Defaults to ``bounded``.
+    :param str name: Name of the consumer, used for logging
+    :param ready: Event set once the subscription is receiving, or once it gave up waiting for the publisher
+    :param float timeout: Maximum time to wait for the welcome of the publisher, in seconds
+    :param telemetry: :class:`~pynta.model.experiment.telemetry.Telemetry` fed with the statistics of the subscription
+    """
+    def __init__(self, address, topic, qos=None, name=None, ready=None, timeout=READY_TIMEOUT, telemetry=None):
+        if isinstance(qos, str):
+            qos = {'policy': qos}
+        qos = dict(DEFAULT_QOS, **(qos or {}))
+        if qos['policy'] not in POLICIES:
+            raise ValueError('Unknown QoS policy {}, it must be one of {}'.format(qos['policy'], POLICIES))
+        if isinstance(address, int):
+            address = endpoint(address)
+        self.address = address
+        self.topic = topic
+        self.name = name or topic
+        self.policy = qos['policy']
+        self.hwm = qos['hwm']
+        self.batch_size = qos['batch_size']
+        self.batch_time = qos['batch_time']
+        self.telemetry = telemetry
+        self.logger = get_logger(name=__name__)
+
+        self.received = Counter()  # Messages received per topic
+        self.dropped = Counter()  # Messages lost per topic
+        self._last_sequence = {}
+        self._pending = deque()
+        self._arrived = threading.Condition()  # Guards _pending while the drainer runs
+        self._closing = threading.Event()
+        self._drainer = None
+        self._handed_at = None  # When the last message was handed to the consumer, to measure the processing time
+
+        self.socket = zmq.Context.instance().socket(zmq.SUB)
+        self.socket.setsockopt(zmq.RCVHWM, self.hwm if self.policy == BOUNDED else max(self.hwm, DRAIN_HWM))
+        self.socket.connect(address)
+        self.socket.setsockopt(zmq.SUBSCRIBE, topic.encode('ascii'))
+        self.ready = self._handshake(timeout)
+        if self.policy != BOUNDED:
+            # From now on the socket is only used by the drainer
+            self._drainer = threading.Thread(target=self._drain, name='drain {}'.format(self.name), daemon=True)
+            self._drainer.start()
+        if ready is not None:
+            ready.set()
+        self.logger.debug('Subscribed {} to {} as {}'.format(self.name, topic, self.policy))
+
+    def _handshake(self, timeout):
+        """ Waits for the publisher to reply to a subscription to a unique welcome topic. Messages of the actual topic
+        that arrive in the meantime are kept.
+
+        :return: Whether the welcome arrived before the timeout
+        """
+        token = WELCOME_PREFIX + uuid4().hex
+        self.socket.setsockopt(zmq.SUBSCRIBE, token.encode('ascii'))
+        deadline = time() + timeout
+        welcomed = False
+        while not welcomed and self.socket.poll(int(max(deadline - time(), 0) * 1000)):
+            topic, header, data, size = self._recv_parts()
+            if topic == token:
+                welcomed = True
+            elif not topic.startswith(WELCOME_PREFIX):
+                self._pending.append(self._accept(topic, header, data, size))
+        self.socket.setsockopt(zmq.UNSUBSCRIBE, token.encode('ascii'))
+        if not welcomed:
+            self.logger.warning('{} got no welcome from the publisher on {} after {}s'.format(
+                self.name, self.address, timeout))
+        return welcomed
+
+    def recv(self, timeout=None):
+        """ Returns the next message according to the policy of the subscription.
 
-def subscribe(port, topic):
-    context = zmq.Context()
-    socket = context.socket(zmq.SUB)
-    socket.connect("tcp://localhost:%s" % port)
-    sleep(1)  # Takes a while for TCP connections to propagate
-    topic_filter = topic.encode('ascii')
-    socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
-    return socket
+        :param float timeout: Maximum time to wait for a message, in seconds. ``None`` waits forever.
+        :return: Tuple with the topic and the data, or ``None`` if nothing arrived before the timeout
+        """
+        self._processed()
+        message = self._next(timeout)
+        self._handed(message is not None)
+        return message
+
+    def _next(self, timeout):
+        if self._drainer is not None:
+            with self._arrived:
+                if not self._pending:
+                    self._arrived.wait_for(lambda: self._pending, timeout)
+                return self._pending.popleft() if self._pending else None
+        if not self._pending:
+            if timeout is not None and not self.socket.poll(int(timeout * 1000)):
+                return None
+            return self._recv()
+        return self._pending.popleft()
+
+    def recv_batch(self, batch_size=None, batch_time=None, timeout=None):
+        """ Returns the messages that arrive within a time budget, counted from the first one.
+
+        :param int batch_size: Maximum number of messages, defaults to the one of the delivery class
+        :param float batch_time: Maximum time to wait for more messages after the first one, in seconds. Defaults to
+            the one of the delivery class
+        :param float timeout: Maximum time to wait for the first message, in seconds. ``None`` waits forever.
+        :return: List of tuples with the topic and the data, empty if nothing arrived before the timeout
+        """
+        batch_size = batch_size or self.batch_size
+        batch_time = self.batch_time if batch_time is None else batch_time
+        batch = []
+        self._processed()
+        message = self._next(timeout)
+        deadline = time() + batch_time
+        while message is not None:
+            batch.append(message)
+            if len(batch) >= batch_size:
+                break
+            message = self._next(max(deadline - time(), 0))
+        self._handed(bool(batch))
+        return batch
+
+    def _processed(self):
+        """ Called when the consumer asks for more messages, i.e. when it finished handling the previous ones."""
+        if self.telemetry is None:
+            return
+        if self._handed_at is not None:
+            self.telemetry.processed(time() - self._handed_at)
+            self._handed_at = None
+        self.telemetry.tick()
+
+    def _handed(self, received):
+        if self.telemetry is not None and received:
+            self._handed_at = time()
+
+    def _drain(self):
+        """ Runs on a thread, taking the messages from the socket as they arrive and keeping only the newest ones,
+        until the subscription is closed.
+        """
+        size = 1 if self.policy == LATEST else self.hwm
+        while not self._closing.is_set():
+            if not self.socket.poll(int(STOP_CHECK_INTERVAL * 1000)):
+                continue
+            with self._arrived:
+                for _ in range(size + self.hwm):  # Bounded, to hand over messages while the producer keeps sending
+                    try:
+                        message = self._recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    if len(self._pending) >= size:
+                        self._drop(self._pending.popleft()[0])
+                    self._pending.append(message)
+                self._arrived.notify()
+
+    def _recv(self, flags=0):
+        while True:
+            topic, header, data, size = self._recv_parts(flags)
+            if not topic.startswith(WELCOME_PREFIX):  # Replies to other subscribers of a broad topic
+                return self._accept(topic, header, data, size)
+
+    def _recv_parts(self, flags=0):
+        """ :return: the topic, header and data of the next message, and its size in bytes."""
+        parts = self.socket.recv_multipart(flags=flags, copy=False)
+        return decode_parts(parts) + (sum(len(part) for part in parts), )
+
+    def _accept(self, topic, header, data, size):
+        self.received[topic] += 1
+        if 'seq' in header:
+            sender, number = header['seq']
+            last = self._last_sequence.get((topic, sender))
+            if last is not None and number > last + 1:
+                self._drop(topic, number - last - 1)
+            self._last_sequence[topic, sender] = number
+        if self.telemetry is not None:
+            self.telemetry.received(size, time() - header['time'] if 'time' in header else None)
+        return topic, data
+
+    def _drop(self, topic, count=1):
+        self.dropped[topic] += count
+        if self.telemetry is not None:
+            self.telemetry.dropped(count)
+
+    def stats(self):
+        """ :return: dictionary with the number of messages received and dropped for every topic."""
+        with self._arrived:
+            return {topic: {'received': self.received[topic], 'dropped': self.dropped[topic]}
+                    for topic in self.received}
+
+    def close(self):
+        self._closing.set()
+        if self._drainer is not None:
+            self._drainer.join()
+        for topic, counts in self.stats().items():
+            if counts['dropped']:
+                self.logger.warning('{} dropped {dropped} of {received} messages on {}'.format(
+                    self.name, topic, **counts))
+        self.socket.close()
+
+
+def subscribe(address, topic, qos=None, name=None, ready=None, telemetry=None):
+    """ :return: a :class:`Subscription` to the topic, already receiving."""
+    return Subscription(address, topic, qos=qos, name=name, ready=ready, telemetry=telemetry)
+
+
+def wait_ready(ready, process=None, timeout=START_TIMEOUT):
+    """ Blocks until a consumer started on another process (or thread) sets its ready event, i.e. until its
+    subscription is receiving.
+
+    :param ready: The Event handed to the consumer
+    :param process: The process (or thread) of the consumer, to stop waiting if it dies
+    :param float timeout: Maximum time to wait, in seconds
+    :return: Whether the consumer is ready
+    """
+    logger = get_logger(name=__name__)
+    deadline = time() + timeout
+    while not ready.wait(STOP_CHECK_INTERVAL):
+        if process is not None and not process.is_alive():
+            logger.error('The consumer finished before being ready')
+            return False
+        if time() > deadline:
+            logger.warning('The consumer is not ready after {}s'.format(timeout))
+            return False
+    return True
 
 
 def subscriber(func, topic, event, *args, **kwargs):
-    port = 5555
-    if 'port' in kwargs:
-        port = kwargs['port']
-        del kwargs['port']
+    """ Calls ``func`` with the data of every message received on a topic, until the event is set or the string
+    ``'stop'`` arrives. The keyword arguments ``address`` (or ``port``), ``qos``, ``ready`` and ``telemetry`` are used
+    for the subscription, the rest are passed to ``func``.
+
+    With the keyword argument ``batch_size`` (and optionally ``batch_time``), ``func`` is called with a list of the
+    data of the messages received together, see :meth:`Subscription.recv_batch`.
+    """
+    port = kwargs.pop('port', 5555)
+    address = kwargs.pop('address', port)
+    qos = kwargs.pop('qos', None)
+    ready = kwargs.pop('ready', None)
+    telemetry = kwargs.pop('telemetry', None)
+    batch_size = kwargs.pop('batch_size', None)
+    batch_time = kwargs.pop('batch_time', None)
 
     logger = get_logger(name=__name__)
-    context = zmq.Context()
-    socket = context.socket(zmq.SUB)
-    socket.connect("tcp://localhost:%s" % port)
-    sleep(1)  # Takes a while for TCP connections to propagate
-    topic_filter = topic.encode('ascii')
-    socket.setsockopt(zmq.SUBSCRIBE, topic_filter)
+    subscription = Subscription(address, topic, qos=qos, name=func.__name__, ready=ready, telemetry=telemetry)
     logger.info('Subscribing {} to {}'.format(func.__name__, topic))
     while not event.is_set():
-        topic = socket.recv_string()
-        data = socket.recv_pyobj()  # flags=0, copy=True, track=False)
+        if batch_size:
+            batch = subscription.recv_batch(batch_size, batch_time, timeout=STOP_CHECK_INTERVAL)
+            if not batch:
+                continue
+            data = [message[1] for message in batch]
+            stop = next((i for i, item in enumerate(data) if isinstance(item, str) and item == 'stop'), None)
+            if stop is not None:
+                data = data[:stop]
+            if data:
+                func(data, *args, **kwargs)
+            if stop is not None:
+                logger.debug('Stopping subscriber on method {}'.format(func.__name__))
+                break
+            continue
+
+        message = subscription.recv(timeout=STOP_CHECK_INTERVAL)
+        if message is None:
+            continue
+        topic, data = message
         logger.debug('Got data of type {} on topic: {}'.format(type(data), topic))
         if isinstance(data, str):
             logger.debug('Data: {}'.format(data))
@@ -48,6 +376,5 @@ def subscriber(func, topic, event, *args, **kwargs):
                 break
 
         func(data, *args, **kwargs)
-    sleep(1)  # Gives enough time for the publishers to finish sending data before closing the socket
-    socket.close()
+    subscription.close()
     logger.debug('Stopped subscriber {}'.format(func.__name__))
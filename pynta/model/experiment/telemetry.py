@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    Telemetry
+    =========
+    Every participant of the bus (the publisher, the localization, the linker, the savers and the GUI) can report how
+    it is keeping up by publishing a summary on the ``stats`` topic every ``stats_interval`` seconds. Each summary is
+    a dictionary with:
+
+    * ``name`` and ``pid`` of the participant and the ``interval`` it covers, in seconds.
+    * ``messages_per_s`` and ``bytes_per_s`` received (forwarded, in the case of the publisher).
+    * ``latency``: percentiles of the time between sending a message and receiving it, in seconds. A growing latency is
+      the sign of a consumer piling up messages in its buffers.
+    * ``processing``: percentiles of the time spent handling each message (or each batch), in seconds.
+    * ``queue_depth``: messages waiting to be handled by the participant, for example in the queue of the saver.
+    * ``dropped``: messages lost in the interval, discarded by the delivery class, missing in the sequence numbers or,
+      for the localization, frames overwritten in shared memory.
+    * ``skipped``: frames left out on purpose in the interval, by the load shedding of the localization (see
+      :mod:`~pynta.model.experiment.nanoparticle_tracking.load_shedding`).
+    * ``state``: dictionary with the current state of the participant, for example the policy of the load shedding.
+
+    A :class:`Telemetry` handed to a :class:`~pynta.model.experiment.subscriber.Subscription` is fed automatically and
+    publishes when its interval elapses. It only holds its name, the queue of the publisher and the interval, therefore
+    it can be passed to new processes. Run ``pynta-stats`` (or ``python -m pynta.model.experiment.telemetry``) to
+    follow a running experiment.
+
+    :copyright:  Aquiles Carattino <aquiles@uetke.com>
+    :license: GPLv3, see LICENSE for more details
+"""
+import os
+from argparse import ArgumentParser
+from time import time
+
+import numpy as np
+
+from pynta.model.experiment import config
+
+STATS_TOPIC = 'stats'
+PERCENTILES = (50, 90, 99)
+
+
+def percentiles(values):
+    """ :return: dictionary with the percentiles of the values (``p50``, ``p90``, ``p99``) and the maximum, or
+        ``None`` if there are no values.
+    """
+    if not values:
+        return None
+    summary = {'p{}'.format(p): value for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES).tolist())}
+    summary['max'] = max(values)
+    return summary
+
+
+class Telemetry:
+    """ Accumulates the statistics of a participant of the bus and publishes them periodically on ``stats``.
+
+    :param str name: Name of the participant
+    :param queue: Object with a ``put`` method to publish the statistics, usually the queue of the publisher. If it is
+        ``None``, the statistics are only available through :meth:`report`.
+    :param float interval: Time between reports, in seconds. Defaults to ``config.stats_interval``, ``0`` disables them
+    :param queue_depth: Callable returning the number of messages waiting to be handled
+    """
+    def __init__(self, name, queue=None, interval=None, queue_depth=None):
+        self.name = name
+        self.queue = queue
+        self.interval = config.stats_interval if interval is None else interval
+        self.queue_depth = queue_depth
+        self.state = {}
+        self._reset(time())
+
+    def _reset(self, start):
+        self._start = start
+        self._messages = 0
+        self._bytes = 0
+        self._dropped = 0
+        self._skipped = 0
+        self._latencies = []
+        self._processing = []
+
+    def received(self, nbytes, latency=None, count=1):
+        """ Counts a message of ``nbytes`` bytes that took ``latency`` seconds to arrive, or ``count`` messages with
+        ``nbytes`` bytes in total.
+        """
+        self._messages += count
+        self._bytes += nbytes
+        if latency is not None:
+            self._latencies.append(latency)
+
+    def processed(self, duration):
+        """ Records the time it took to handle a message or a batch, in seconds."""
+        self._processing.append(duration)
+
+    def dropped(self, count=1):
+        self._dropped += count
+
+    def skipped(self, count=1):
+        self._skipped += count
+
+    def due(self):
+        """ :return: whether the interval elapsed since the last report."""
+        return self.interval > 0 and time() - self._start >= self.interval
+
+    def report(self):
+        """ Summarizes the statistics accumulated since the last report and starts accumulating again.
+
+        :return: dictionary as described in :mod:`~pynta.model.experiment.telemetry`
+        """
+        now = time()
+        elapsed = max(now - self._start, 1e-9)
+        depth = None
+        if self.queue_depth is not None:
+            try:
+                depth = self.queue_depth()
+            except NotImplementedError:  # Queue.qsize is not available on macOS
+                pass
+        stats = {
+            'name': self.name,
+            'pid': os.getpid(),
+            'time': now,
+            'interval': elapsed,
+            'messages_per_s': self._messages / elapsed,
+            'bytes_per_s': self._bytes / elapsed,
+            'latency': percentiles(self._latencies),
+            'processing': percentiles(self._processing),
+            'queue_depth': depth,
+            'dropped': self._dropped,
+            'skipped': self._skipped,
+            'state': dict(self.state),
+        }
+        self._reset(now)
+        return stats
+
+    def tick(self):
+        """ Publishes a report if the interval elapsed. It should be called regularly, also when idle."""
+        if self.due() and self.queue is not None:
+            self.queue.put({'topic': STATS_TOPIC, 'data': self.report()})
+
+    def __getstate__(self):
+        return {'name': self.name, 'queue': self.queue, 'interval': self.interval, 'queue_depth': self.queue_depth}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+def format_stats(stats):
+    """ :return: one line summarizing a report, as printed by :func:`monitor`."""
+    def milliseconds(summary, key):
+        return '{:8.1f}'.format(summary[key] * 1000) if summary else '{:>8}'.format('-')
+
+    return '{:<24} {:>8.1f} {:>9.2f} {} {} {} {} {:>6} {:>6} {:>6} {}'.format(
+        '{}[{}]'.format(stats['name'], stats['pid'])[:24], stats['messages_per_s'], stats['bytes_per_s'] / 2**20,
+        milliseconds(stats['latency'], 'p50'), milliseconds(stats['latency'], 'p99'),
+        milliseconds(stats['processing'], 'p50'), milliseconds(stats['processing'], 'p99'),
+        '-' if stats['queue_depth'] is None else stats['queue_depth'], stats['dropped'], stats.get('skipped', 0),
+        stats.get('state', {}).get('policy', ''))
+
+
+HEADER = '{:<24} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8} {:>6} {:>6} {:>6} {}'.format(
+    'participant', 'msg/s', 'MB/s', 'lat p50', 'lat p99', 'proc p50', 'proc p99', 'queue', 'drops', 'skips', 'policy')
+
+
+def monitor(address, duration=None):
+    """ Prints the reports published on ``stats`` as they arrive. Latencies and processing times are in milliseconds.
+
+    :param address: Address (or port) of the publisher of the experiment
+    :param float duration: Time to keep printing, in seconds. ``None`` runs until interrupted
+    """
+    from pynta.model.experiment.subscriber import subscribe
+
+    subscription = subscribe(address, STATS_TOPIC, name='monitor')
+    deadline = None if duration is None else time() + duration
+    print(HEADER)
+    try:
+        while deadline is None or time() < deadline:
+            message = subscription.recv(timeout=0.5)
+            if message is not None:
+                print(format_stats(message[1]), flush=True)
+    except KeyboardInterrupt:
+        pass
+    subscription.close()
+
+
+def main():
+    from pynta.model.experiment.publisher import endpoint
+
+    parser = ArgumentParser(description='Print the statistics of a running experiment')
+    parser.add_argument('--port', type=int, default=config.zmq_port, help='Port of the publisher')
+    parser.add_argument('--host', default='localhost', help='Computer running the experiment')
+    parser.add_argument('--duration', type=float, default=None, help='Seconds to run, by default until Ctrl+C')
+    args = parser.parse_args()
+    monitor(endpoint(args.port, host=args.host), args.duration)
+
+
+if __name__ == '__main__':
+    main()
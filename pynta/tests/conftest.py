@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures shared by the tests of the localization engines: frames simulated with
+:class:`~pynta.model.cameras.simulate_brownian.SimBrownian` and the comparison of the particles found on them.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+
+from pynta.model.cameras.simulate_brownian import SimBrownian
+
+
+@pytest.fixture(scope='session')
+def simulate():
+    """ :return: function that simulates consecutive frames of diffusing particles over a Poisson background, as
+        acquired by a camera
+    """
+    def frames(shape, num_particles, seed, background, count=1):
+        np.random.seed(seed)
+        sim = SimBrownian(shape, num_particles)
+        return [(sim.gen_image() + np.random.poisson(background, shape)).astype(np.uint16) for i in range(count)]
+    return frames
+
+
+@pytest.fixture(scope='session')
+def assert_same_locations():
+    """ :return: function that checks that every particle found is one of the expected, at the same position"""
+    def check(records, expected):
+        distance, index = cKDTree(np.column_stack((expected['y'], expected['x']))).query(
+            np.column_stack((records['y'], records['x'])))
+        assert np.percentile(distance, 90) < 0.01
+        assert len(np.unique(index)) == len(index)  # No particle is found twice
+    return check
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the benchmark of the localization knows where the simulated particles are and scores the backends.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+from pynta.tools.benchmark import benchmark, match, simulate
+
+
+def test_simulate():
+    np.random.seed(1)
+    images, positions = simulate((200, 300), 20, 20, 1.5, 2)
+    assert len(images) == len(positions) == 2
+    assert images[0].shape == (200, 300)
+    assert positions[0].shape == (20, 2)
+    records = locate(images[:1], engine='pynta', diameter=9, minmass=200)[0]
+    matched, distances = match(positions[0], records, 2)
+    assert matched >= 16
+    assert np.median(distances) < 0.3
+
+
+def test_match():
+    records = np.zeros(3, dtype=[('y', float), ('x', float)])
+    records['y'], records['x'] = [10, 10.5, 50], [10, 10, 50]
+    matched, distances = match(np.array([[10.4, 10.], [30., 30.]]), records, 2)
+    assert matched == 1
+    np.testing.assert_allclose(distances, [0.1])
+
+
+def test_benchmark():
+    results = benchmark(['pynta', 'multires'], densities=[10], snrs=[10], psf_widths=[1.5], frames=2,
+                        shape=(128, 128))
+    assert [result['backend'] for result in results] == ['pynta', 'multires']
+    for result in results:
+        assert result['frames_per_s'] > 0
+        assert result['recall'] > 0.8
+        assert result['precision'] > 0.8
+        assert result['rms_error'] < 0.5
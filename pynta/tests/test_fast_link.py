@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the in-tree linker links as trackpy does, solving the ambiguous cases and splitting the subnetworks that
+are too large.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.fast_link import KDTreeLinker
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import StreamingLinker
+
+
+def diffuse(frames, particles, size, step, missing=0.):
+    """ :return: list of record arrays with particles diffusing, some of them not found on every frame"""
+    positions = np.random.uniform(0, size, (particles, 2))
+    located = []
+    for i in range(frames):
+        positions += np.random.normal(0, step, positions.shape)
+        found = positions[np.random.random(particles) >= missing]
+        records = empty(len(found))
+        records['x'], records['y'] = found.T
+        records['frame'] = i
+        located.append(records)
+    return located
+
+
+def link(frames, **kwargs):
+    linker = StreamingLinker(**kwargs)
+    return np.concatenate([linker.link(records, i)[0] for i, records in enumerate(frames)])
+
+
+def test_same_as_trackpy():
+    np.random.seed(2)
+    frames = diffuse(30, 200, 200, 1, missing=0.05)
+    linked = link(frames, search_range=5, memory=2, engine='pynta')
+    expected = link(frames, search_range=5, memory=2)
+    pairs = set(zip(linked['particle'], expected['particle']))
+    assert len(pairs) == len(set(linked['particle'])) == len(set(expected['particle']))
+
+
+def test_assign():
+    linker = KDTreeLinker(3)
+    linker.init_level(np.array([[0., 0.], [2., 0.]]), 0)
+    # Linking the closest pair, the second particle to the first position, would leave the first particle unlinked
+    linker.next_level(np.array([[1.1, 0.], [4.4, 0.]]), 1)
+    np.testing.assert_array_equal(linker.particle_ids, [0, 1])
+    linker.next_level(np.array([[1.1, 0.], [50., 50.]]), 2)
+    np.testing.assert_array_equal(linker.particle_ids, [0, 2])
+
+
+def test_memory():
+    linker = KDTreeLinker(3, memory=1)
+    linker.init_level(np.array([[0., 0.], [20., 20.]]), 0)
+    linker.next_level(np.array([[0., 1.]]), 1)
+    linker.next_level(np.array([[0., 2.], [20., 21.]]), 2)
+    np.testing.assert_array_equal(linker.particle_ids, [0, 1])
+    linker.next_level(np.array([[0., 3.]]), 3)
+    linker.next_level(np.array([[0., 4.]]), 4)
+    linker.next_level(np.array([[0., 5.], [20., 22.]]), 5)  # Missing for two frames, a new particle
+    np.testing.assert_array_equal(linker.particle_ids, [0, 2])
+
+
+def test_split_subnets():
+    np.random.seed(3)
+    linker = KDTreeLinker(10, max_subnet_size=20)
+    positions = np.random.uniform(0, 30, (60, 2))
+    linker.init_level(positions, 0)
+    linker.next_level(positions + np.random.normal(0, 0.2, positions.shape), 1)
+    assert linker.capped > 0
+    assert len(set(linker.particle_ids)) == len(positions)
+    assert (linker.particle_ids == np.arange(len(positions))).mean() > 0.9
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the in-tree localization engine finds the same particles as trackpy, with the same columns.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+import trackpy as tp
+from scipy import ndimage
+
+from pynta.model.cameras.simulate_brownian import SimBrownian
+from pynta.model.experiment.nanoparticle_tracking import fast_locate
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+from pynta.model.experiment.nanoparticle_tracking.schema import to_records, LOCATIONS_DTYPE
+
+COLUMNS = ['x', 'y', 'mass', 'size', 'ecc', 'signal', 'raw_mass', 'ep']
+
+
+@pytest.fixture(scope='module')
+def frames():
+    """ Simulated frames: as generated (float), as acquired by a camera and with a noisy background."""
+    np.random.seed(1)
+    sim = SimBrownian((300, 400))
+    image = sim.gen_image()
+    noisy = (sim.gen_image() + np.random.poisson(20, image.shape)).astype(np.uint16)
+    return {'float': image, 'uint16': image.astype(np.uint16), 'noisy': noisy}
+
+
+@pytest.mark.parametrize('frame', ['float', 'uint16', 'noisy'])
+@pytest.mark.parametrize('kwargs', [
+    {'diameter': 11, 'minmass': 100},
+    {'diameter': 11, 'minmass': 100, 'preprocess': False, 'max_iterations': 3},
+    {'diameter': 7, 'minmass': 50, 'topn': 20, 'separation': 9},
+    {'diameter': 9, 'invert': True, 'percentile': 90},
+])
+def test_parity(frames, frame, kwargs):
+    expected = to_records(tp.locate(frames[frame], **kwargs))
+    records = fast_locate.locate(frames[frame], **kwargs)
+    assert records.dtype == LOCATIONS_DTYPE
+    assert len(records) == len(expected)
+    for column in COLUMNS:
+        np.testing.assert_allclose(records[column], expected[column], rtol=1e-9, err_msg=column)
+
+
+def test_engine(frames):
+    images = [frames['float'], frames['noisy']]
+    trackpy_records = locate(images, diameter=11, minmass=100)
+    records = locate(images, diameter=11, minmass=100, engine=fast_locate.ENGINE)
+    for expected, located in zip(trackpy_records, records):
+        np.testing.assert_allclose(located['x'], expected['x'])
+    assert len(fast_locate.locate(np.zeros((50, 50)), diameter=5)) == 0
+
+
+@pytest.mark.parametrize('size', [1, 2, 5, 16])
+def test_running_max(size):
+    image = np.random.randint(0, 1000, (40, 60)).astype(np.uint16)
+    before, after = (size - 1) // 2, size // 2
+    dilation = fast_locate.running_max(fast_locate.running_max(image, before, after, 0), before, after, 1)
+    np.testing.assert_array_equal(dilation, ndimage.grey_dilation(image, (size, size), mode='constant'))
+
+    mask = image > 950
+    points = np.arange(-size, size + 1)
+    expected = ndimage.binary_dilation(mask, structure=points[:, np.newaxis] ** 2 + points ** 2 <= size ** 2)
+    np.testing.assert_array_equal(fast_locate.dilate(mask, size), expected)
+
+
+def test_percentile_threshold():
+    image = np.random.randint(0, 300, (40, 60)).astype(np.uint16)
+    for percentile in (0, 50, 64, 100):
+        expected = np.percentile(image[image > 0], percentile)
+        assert fast_locate.percentile_threshold(image, percentile) == pytest.approx(expected)
+    assert np.isnan(fast_locate.percentile_threshold(np.zeros((5, 5), dtype=np.uint8), 64))
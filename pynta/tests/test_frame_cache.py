@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the GUI gets the locations published by the tracking, matched to the frames, without locating them again.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import os
+from time import sleep, time
+
+import numpy as np
+
+from pynta import BASE_DIR, general_stop_event
+from pynta.model.experiment.nanoparticle_tracking import np_tracking
+from pynta.model.experiment.nanoparticle_tracking.frame_cache import FrameCache, newest_common
+from pynta.model.experiment.nanoparticle_tracking.np_tracking import NPTracking
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+
+
+def test_frame_cache():
+    cache = FrameCache(3)
+    for i in range(5):
+        cache.put(i, str(i))
+    assert cache.frame_ids() == [2, 3, 4]
+    assert cache.get(1) is None and cache.get(4) == '4'
+    other = FrameCache(10)
+    for i in (1, 3, 5):
+        other.put(i, i)
+    assert newest_common(other, cache) == 3
+    cache.clear()
+    assert newest_common(other, cache) is None
+
+
+def test_tracked_frame(monkeypatch):
+    experiment = NPTracking(os.path.join(BASE_DIR, 'util', 'example_config.yml'))
+    experiment.config['tracking']['locate']['engine'] = 'pynta'  # Keeps up with the camera on a single core
+    try:
+        experiment.initialize_camera()
+        experiment.start_free_run()
+        experiment.start_tracking()
+
+        def locate(*args, **kwargs):
+            raise AssertionError('The GUI must not locate particles while tracking')
+
+        monkeypatch.setattr(np_tracking, 'locate', locate)
+        deadline = time() + 20
+        image, locations = experiment.tracked_frame()
+        while image is None and time() < deadline:
+            sleep(0.05)
+            image, locations = experiment.tracked_frame()
+        assert image is not None and len(locations)
+        frame_id = locations['frame'].iloc[0]
+        assert np.all(locations['frame'] == frame_id)
+        assert experiment.recent_frames.get(frame_id) is image
+        experiment.temp_locations  # The frame displayed may not be located yet, but it is not located by the GUI
+    finally:
+        experiment.stop_tracking()
+        experiment.stop_free_run()
+        experiment.finalize()
+        general_stop_event.clear()
+
+
+def test_snap_locations(monkeypatch):
+    experiment = NPTracking(os.path.join(BASE_DIR, 'util', 'example_config.yml'))
+    calls = []
+
+    def locate(images, **kwargs):
+        calls.append(len(images))
+        return [empty()]
+
+    monkeypatch.setattr(np_tracking, 'locate', locate)
+    try:
+        experiment.temp_image = np.zeros((50, 50), dtype=np.uint16)
+        experiment.temp_frame_id = ('snap', 1)
+        for i in range(3):  # Every refresh of the GUI
+            assert len(experiment.temp_locations) == 0
+        assert calls == [1]
+        experiment.temp_frame_id = ('snap', 2)
+        experiment.temp_locations
+        assert calls == [1, 1]
+    finally:
+        experiment.finalize()
+        general_stop_event.clear()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the Gaussian refinement recovers the positions of simulated particles.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+
+from pynta.model.experiment.nanoparticle_tracking import fast_locate
+from pynta.model.experiment.nanoparticle_tracking.gaussian_fit import fit_gaussians, refine_gaussian, REFINEMENT
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+
+
+def spots(shape, positions, size=1.5, signal=60, background=20):
+    y, x = np.indices(shape)
+    image = np.full(shape, float(background))
+    for y0, x0 in positions:
+        image += signal * np.exp(-((y - y0) ** 2 + (x - x0) ** 2) / (2 * size ** 2))
+    return image
+
+
+def test_fit_gaussians():
+    rng = np.random.default_rng(0)
+    truth = np.column_stack((rng.uniform(20, 100, 50), rng.uniform(3, 5, (50, 2)), rng.uniform(1, 2, 50),
+                             rng.uniform(0, 30, 50)))
+    rois = np.array([spots((9, 9), [parameters[1:3]], parameters[3], parameters[0], parameters[4])
+                     for parameters in truth])
+    initial = np.column_stack((rois.max(axis=(1, 2)), np.full((50, 2), 4.), np.full(50, 1.5), rois.min(axis=(1, 2))))
+    parameters, covariance, converged = fit_gaussians(rois, initial)
+    assert converged.all()
+    np.testing.assert_allclose(parameters, truth, atol=1e-5)
+    assert covariance.shape == (50, 5, 5)
+
+
+def test_refine_gaussian():
+    rng = np.random.default_rng(1)
+    positions = rng.uniform(10, 290, (40, 2))
+    image = rng.poisson(spots((300, 300), positions)).astype(np.uint16)
+    records = fast_locate.locate(image, diameter=7, minmass=100)
+    refined = refine_gaussian(image, records, 7)
+    np.testing.assert_array_equal(refined['mass'], records['mass'])
+
+    distance, index = cKDTree(positions).query(np.column_stack((refined['y'], refined['x'])))
+    assert len(refined) > 30 and np.all(distance < 1)
+    assert np.median(refined['size']) == pytest.approx(1.5, rel=0.1)
+    # The uncertainty describes the error of the positions
+    assert 0.5 < np.sqrt(np.mean(distance ** 2)) / np.median(refined['ep']) < 2
+    assert len(refine_gaussian(image, records[:0], 7)) == 0
+
+
+def test_refinement():
+    positions = [(20.3, 30.7), (50.5, 12.2)]
+    image = spots((70, 60), positions)
+    records = locate([image], diameter=7, engine=fast_locate.ENGINE, refinement=REFINEMENT)[0]
+    np.testing.assert_allclose(np.sort(records['y']), [20.3, 50.5], atol=1e-4)
+    with pytest.raises(ValueError):
+        locate([image], diameter=7, refinement='unknown')
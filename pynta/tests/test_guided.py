@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the localization guided by the linked positions finds the particles that were already there.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+
+from pynta.model.experiment.nanoparticle_tracking.fast_locate import ENGINE
+from pynta.model.experiment.nanoparticle_tracking.guided import window_bounds, Guide
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate, locate_guided
+
+KWARGS = {'diameter': 7, 'minmass': 50, 'engine': ENGINE}
+
+
+@pytest.fixture(scope='module')
+def frames(simulate):
+    """ Two consecutive frames of a sparse sample."""
+    return simulate((512, 512), 15, seed=3, background=5, count=2)
+
+
+def test_window_bounds():
+    positions = np.array([[10., 10.], [14., 30.], [200., 300.], [511., 0.]])
+    bounds = window_bounds((512, 512), positions, 10, 3)
+    assert len(bounds) == 3  # The first two windows touch
+    for (top, left), (bottom, right) in zip(np.clip(positions - 10, 0, 511), np.clip(positions + 10, 0, 511)):
+        # Every window is inside an area
+        assert any(y0 <= top and bottom < y1 and x0 <= left and right < x1 for window, (y0, y1, x0, x1) in bounds)
+    covered = sum((y1 - y0) * (x1 - x0) for window, (y0, y1, x0, x1) in bounds)
+    assert covered < 0.1 * 512 ** 2
+    assert window_bounds((512, 512), np.empty((0, 2)), 10, 3) == []
+
+
+def test_bounds():
+    guide = Guide(window=10, full_frame=5, max_lag=3)
+    assert guide.bounds((100, 100), 1, 3) is None  # Nothing linked yet
+    guide.linked({'y': np.array([50.]), 'x': np.array([50.])}, 1)
+    assert len(guide.bounds((100, 100), 2, 3)) == 1
+    assert guide.bounds((100, 100), 5, 3) is None  # Full frame
+    assert guide.bounds((100, 100), 9, 3) is None  # Too old
+
+
+def test_locate_guided(frames, assert_same_locations):
+    first = locate([frames[0]], **KWARGS)[0]
+    guide = Guide(window=10)
+    guide.linked(first, 0)
+    expected = locate([frames[1]], **KWARGS)[0]
+    records = locate_guided(frames[1], 1, guide, **KWARGS)
+    assert len(records) == len(expected) > 0
+    assert_same_locations(records, expected)
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the localization skips frames when it falls behind, and that the gaps are taken into account when linking.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+from time import time
+
+import numpy as np
+import pytest
+from trackpy.linking import Linker
+
+from pynta.model.experiment.nanoparticle_tracking.load_shedding import (ALL, EVERY_K, LATEST, LoadShedder,
+                                                                        SKIPPED_TOPIC)
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import frame_gap, link_level
+from pynta.model.experiment.shared_frames import SharedFrame
+from pynta.model.experiment.telemetry import Telemetry
+
+
+class ListQueue(list):
+    put = list.append
+
+
+def frames(start, count):
+    return [[time(), None, i] for i in range(start, start + count)]
+
+
+def test_policies():
+    published = ListQueue()
+    telemetry = Telemetry('localization', interval=0)
+    shedder = LoadShedder(max_lag=1, max_backlog=10, k=3, hold=0, publisher_queue=published, telemetry=telemetry)
+    assert [data[2] for data in shedder.select(frames(0, 4))] == [0, 1, 2, 3]
+    shedder.started(4)
+    shedder.done(time() - 5, count=4)  # Locations published 5 seconds after acquiring the frames
+    assert shedder.backlog == 0
+    assert [data[2] for data in shedder.select(frames(4, 4))] == [4, 7]
+    assert shedder.policy == EVERY_K
+    shedder.lag = 0.8  # Between half and the maximum, the policy does not change
+    assert [data[2] for data in shedder.select(frames(8, 4))] == [10]  # Every third frame, across batches
+    assert [data[2] for data in shedder.select(frames(12, 4))] == [13]
+    shedder.lag = 5
+    assert [data[2] for data in shedder.select(frames(16, 4))] == [19]
+    assert shedder.policy == LATEST
+    assert published[0]['topic'] == SKIPPED_TOPIC
+    skipped = np.concatenate([message['data'][1] for message in published]).tolist()
+    assert skipped == [5, 6, 8, 9, 11, 12, 14, 15, 16, 17, 18]
+
+    shedder.done(time())
+    shedder.started(30)  # The lag dropped, but many frames are still being located
+    assert shedder.update() == LATEST
+    shedder.done(count=30)
+    assert shedder.update() == EVERY_K
+    assert shedder.update() == ALL
+    assert shedder.skipped == 11
+
+    stats = telemetry.report()
+    assert stats['skipped'] == 11
+    assert stats['state']['policy'] == ALL
+
+
+def test_hold():
+    shedder = LoadShedder(max_lag=1, hold=60, policies=[ALL, LATEST])
+    shedder.done(time() - 5)
+    assert shedder.update() == ALL  # The hold time also applies after starting
+    shedder.hold = 0
+    assert shedder.update() == LATEST
+    shared = [SharedFrame(time(), i % 4, i, 'ring', i) for i in range(3)]
+    assert shedder.select(shared) == shared[-1:]
+    with pytest.raises(ValueError):
+        LoadShedder(policies=[ALL, 'none'])
+
+
+def test_link_gap():
+    linker = Linker(4)
+    link_level(linker, np.array([[10., 10.], [50., 50.]]), 0, 4)
+    link_level(linker, np.array([[16., 10.], [50., 44.]]), 1, 4, frame_gap(0, 4))  # Moved 6 pixels in 4 frames
+    assert linker.particle_ids == [0, 1]
+    link_level(linker, np.array([[22., 10.], [50., 38.]]), 2, 4, frame_gap(4, 5))
+    assert linker.particle_ids == [2, 3]  # Too far for a single frame
+    assert frame_gap(None, 3) == 1
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the pool of localization workers publishes the locations in the order of the frames.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import threading
+from multiprocessing import Event, Process, Queue
+from time import sleep
+
+import numpy as np
+import pytest
+import zmq
+
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import (distribute_frames, locate, locate_frames,
+                                                                            reorder_locations)
+from pynta.model.experiment.nanoparticle_tracking.schema import empty
+from pynta.model.experiment.publisher import Publisher
+from pynta.model.experiment.serialization import send_data
+from pynta.model.experiment.subscriber import subscribe, wait_ready, BOUNDED
+from pynta.tests.test_publisher import free_port
+
+
+class ListQueue(list):
+    put = list.append
+
+
+def spots(frame_id, shape=(64, 64)):
+    """ Frame with a gaussian spot moving one pixel per frame."""
+    y, x = np.indices(shape)
+    image = 1000 * np.exp(-((x - 10 - frame_id % 40) ** 2 + (y - 30) ** 2) / 4)
+    return image.astype(np.uint16)
+
+
+def test_reorder():
+    context = zmq.Context.instance()
+    results = context.socket(zmq.PULL)
+    port = results.bind_to_random_port('tcp://127.0.0.1')
+    workers = context.socket(zmq.PUSH)
+    workers.connect('tcp://127.0.0.1:{}'.format(port))
+    published = ListQueue()
+    event = threading.Event()
+    collector = threading.Thread(target=reorder_locations, args=[results, event, published, 0.5])
+    collector.start()
+    for job in [2, 0, 3, 1, 5]:  # 4 never arrives
+        send_data(workers, 'locations', [job, 0., empty(1), 10 + job])
+    send_data(workers, 'locations', [6, 0., empty(2), 16, None, None, None, 0., empty(1), 18])  # A batch, 17 was lost
+    sleep(1)
+    event.set()
+    collector.join()
+    workers.close(linger=0)
+    assert [message['data'][2] for message in published] == [10, 11, 12, 13, 15, 16, 18]
+
+
+def test_locate_blank():
+    images = [np.zeros((64, 64), np.uint16)] * 3
+    located = locate(images, diameter=7)
+    assert len(located) == 3
+    assert all(len(records) == 0 and records.dtype == empty().dtype for records in located)
+    located = locate([np.zeros((64, 64), np.uint16), spots(0)], diameter=7)
+    assert [len(records) for records in located] == [0, 1]
+
+
+@pytest.mark.parametrize('transport, batch_size', [('tcp', 1), ('ipc', 4)])
+def test_pool(transport, batch_size):
+    if transport == 'ipc' and not zmq.has('ipc'):
+        pytest.skip('ZMQ does not support ipc')
+    publisher = Publisher(port=free_port(), mode='direct', input_port=free_port(), transport=transport)
+    publisher.start()
+    event = Event()
+    ready = Event()
+    addresses = Queue()
+    processes = [Process(target=distribute_frames,
+                         args=[publisher.address, 'free_run', event, publisher.queue, addresses, transport],
+                         kwargs={'qos': BOUNDED, 'ready': ready, 'batch_size': batch_size, 'batch_time': 0.05})]
+    processes[0].start()
+    frames_address, results_address = addresses.get(timeout=10)
+    for i in range(3):
+        processes.append(Process(target=locate_frames, args=[frames_address, results_address, event],
+                                 kwargs={'diameter': 5}))
+        processes[-1].start()
+    assert wait_ready(ready, processes[0])
+    subscription = subscribe(publisher.port, 'locations')
+    for i in range(30):
+        publisher.publish('free_run', [0., spots(i), i])
+        sleep(0.005)
+    frames = []
+    while len(frames) < 30:
+        message = subscription.recv(timeout=10)
+        assert message is not None
+        frames.append(message[1][2])
+        assert message[1][1]['frame'].tolist() == [frames[-1]]
+    assert frames == list(range(30))
+    event.set()
+    for process in processes:
+        process.join(5)
+        assert not process.is_alive()
+    subscription.close()
+    publisher.stop()
+    publisher.join(5)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the mean squared displacements accumulated link by link, and their fits, are the same that trackpy gives
+for the whole measurement, and that the particles that can not grow anymore are released.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import trackpy as tp
+from scipy.stats import linregress
+
+from pynta.model.experiment.nanoparticle_tracking.msd import IncrementalMSD
+from pynta.model.experiment.nanoparticle_tracking.schema import LOCATIONS_DTYPE, to_dataframe
+
+
+def random_walks(particles=30, seed=0):
+    """ :return: record array with the links of particles that start at random frames and miss some frames, sorted
+        by frame
+    """
+    np.random.seed(seed)
+    walks = []
+    for particle in range(particles):
+        length = np.random.randint(1, 150)
+        frames = np.random.randint(0, 200) + np.sort(np.random.choice(2 * length, length, replace=False))
+        records = np.zeros(length, dtype=LOCATIONS_DTYPE)
+        records['x'], records['y'] = (50 + np.cumsum(np.random.normal(0, 1, (length, 2)), axis=0)).T
+        records['frame'] = frames
+        records['particle'] = particle
+        records['mass'] = np.random.uniform(0, 1, length)
+        records['size'] = 1
+        walks.append(records)
+    links = np.concatenate(walks)
+    return links[np.argsort(links['frame'], kind='stable')]
+
+
+def feed(msd, links, **filters):
+    for frame in np.unique(links['frame']):
+        msd.update(links[links['frame'] == frame], **filters)
+
+
+def test_msd():
+    links = random_walks()
+    msd = IncrementalMSD(max_lagtime=20)
+    feed(msd, links[links['frame'] < 150])
+    particle = msd._particle[msd._particle >= 0][0]
+    lagt, values = msd.msd(particle, um_pixel=0.1, fps=30)
+    expected = tp.imsd(to_dataframe(links[links['frame'] < 150]), 0.1, 30, max_lagtime=20)[particle].dropna()
+    np.testing.assert_allclose(lagt, expected.index)
+    np.testing.assert_allclose(values, expected.values)
+
+
+def test_fits():
+    links = random_walks()
+    msd = IncrementalMSD(capacity=4)
+    feed(msd, links, min_mass=0.2, max_size=50, max_ecc=1)
+    fits = msd.fits(um_pixel=0.1, fps=30, min_length=10)
+
+    locations = tp.filter_stubs(to_dataframe(links), 10)
+    locations = locations[(locations['mass'] > 0.2) & (locations['size'] < 50) & (locations['ecc'] < 1)]
+    im = tp.imsd(locations, 0.1, 30)
+    expected = []
+    for particle in im:
+        values = im[particle].dropna()
+        if len(values) > 1:
+            expected.append(linregress(np.log(values.index), np.log(values.values))[:2])
+    expected = np.array(expected)
+    assert len(fits) == len(expected)
+    np.testing.assert_allclose(np.sort(fits[:, 0]), np.sort(expected[:, 0]))
+    np.testing.assert_allclose(np.sort(fits[:, 1]), np.sort(expected[:, 1]))
+
+
+def test_retire():
+    links = random_walks()
+    msd = IncrementalMSD(max_lagtime=10)
+    feed(msd, links)
+    last = {particle: links['frame'][links['particle'] == particle].max() for particle in np.unique(links['particle'])}
+    assert msd.tracked == sum(frame >= links['frame'].max() - 10 for frame in last.values())
+    assert msd.tracked + msd.retired == len(last)
+    fits = msd.fits()
+    assert len(msd.fits()) == len(fits)  # Nothing changed, nothing to fit again
+    assert not msd._dirty.any()
+
+
+def test_empty():
+    msd = IncrementalMSD()
+    msd.update(np.zeros(0, dtype=LOCATIONS_DTYPE))
+    assert msd.fits().shape == (0, 2)
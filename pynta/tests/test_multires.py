@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the coarse-to-fine engine finds the particles found on the whole frame, at the same positions.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+
+from pynta.model.experiment.nanoparticle_tracking import fast_locate, multires
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+
+
+@pytest.fixture(scope='module')
+def image(simulate):
+    return simulate((600, 800), 40, seed=4, background=20)[0]
+
+
+def test_bin_image():
+    image = np.arange(35, dtype=np.uint16).reshape(5, 7)
+    binned = multires.bin_image(image, 2)
+    assert binned.shape == (2, 3)
+    assert binned[1, 2] == image[2:4, 4:6].sum()
+
+
+@pytest.mark.parametrize('binning', [2, 4])
+def test_locate(image, assert_same_locations, binning):
+    expected = fast_locate.locate(image, diameter=11, minmass=400)
+    records = locate([image], engine=multires.ENGINE, binning=binning, diameter=11, minmass=400)[0]
+    assert len(records) == len(expected) > 0
+    assert_same_locations(records, expected)
+    np.testing.assert_allclose(np.sort(records['raw_mass']), np.sort(expected['raw_mass']))
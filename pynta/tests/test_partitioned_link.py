@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Check that linking in strips gives the same trajectories as linking the whole field, and that the particles keep their
+number when they cross from one strip to another.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+
+from pynta.model.experiment.nanoparticle_tracking.fast_link import KDTreeLinker
+from pynta.model.experiment.nanoparticle_tracking.partitioned_link import PartitionedLinker
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import StreamingLinker
+
+
+def run(linker, frames):
+    linker.init_level(frames[0], 0)
+    ids = [linker.particle_ids.copy()]
+    for t, coords in enumerate(frames[1:], 1):
+        linker.next_level(coords, t)
+        ids.append(linker.particle_ids.copy())
+    return np.concatenate(ids)
+
+
+@pytest.mark.parametrize('threads', [1, 2])
+def test_same_as_whole_field(threads):
+    np.random.seed(4)
+    positions = np.random.uniform(0, 400, (300, 2))
+    frames = []
+    for i in range(30):
+        positions = positions + np.random.normal(0, 1.5, positions.shape)
+        frames.append(positions[np.random.random(len(positions)) > 0.05])
+    expected = run(KDTreeLinker(5, memory=2), frames)
+    linker = PartitionedLinker(5, 60, memory=2, threads=threads)
+    ids = run(linker, frames)
+    linker.close()
+    pairs = set(zip(ids, expected))
+    assert len(pairs) == len(set(ids)) == len(set(expected))
+
+
+@pytest.mark.parametrize('memory', [0, 2])
+def test_unique_ids(memory):
+    np.random.seed(1)
+    positions = np.random.uniform(0, 400, (400, 2))
+    linker = PartitionedLinker(5, 40, memory=memory)
+    for t in range(30):
+        positions = positions + np.random.normal(0, 1.5, positions.shape)
+        coords = positions[np.random.random(len(positions)) > 0.05]
+        if t == 0:
+            linker.init_level(coords, t)
+        else:
+            linker.next_level(coords, t)
+        assert len(np.unique(linker.particle_ids)) == len(coords)
+
+
+def test_crossing():
+    linker = PartitionedLinker(4, 20)
+    linker.init_level(np.array([[2., 10.], [15., 50.]]), 0)
+    np.testing.assert_array_equal(linker.particle_ids, [0, 1])
+    for t in range(1, 30):  # The first particle crosses every strip, the second one stays
+        linker.next_level(np.array([[2. + 3 * t, 10.], [15., 50.]]), t)
+        np.testing.assert_array_equal(linker.particle_ids, [0, 1])
+    assert linker.strips <= 3  # The strips left behind are discarded
+
+
+def test_streaming_strips():
+    with pytest.raises(ValueError):
+        StreamingLinker(4, strip_width=100)
+    linker = StreamingLinker(4, engine='pynta', strip_width=100, strip_threads=2)
+    assert isinstance(linker.linker, PartitionedLinker)
+    linker.close()
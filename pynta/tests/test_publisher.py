@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the publisher delivers the messages of producers on the same process and on other processes.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import pickle
+import socket
+import threading
+from multiprocessing import Process
+from time import perf_counter
+
+import numpy as np
+import pytest
+import zmq
+from zmq.utils.garbage import gc as zmq_gc
+
+from pynta.model.experiment import config
+from pynta.model.experiment.publisher import Publisher
+from pynta.model.experiment.serialization import recv_data
+from pynta.model.experiment.subscriber import subscribe as subscribe_topic
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def receive(sub, timeout=5):
+    assert sub.poll(timeout * 1000), 'Nothing received'
+    return recv_data(sub)
+
+
+def put_from_process(queue):
+    queue.put({'topic': 'locations', 'data': [0.5, np.arange(10), 3]})
+
+
+@pytest.fixture(params=['direct', 'queue'])
+def publisher(request):
+    pub = Publisher(port=free_port(), mode=request.param, input_port=free_port())
+    pub.start()
+    yield pub
+    pub.stop()
+    pub.join(5)
+
+
+def subscribe(publisher, topic):
+    sub = zmq.Context.instance().socket(zmq.SUB)
+    sub.connect('tcp://localhost:{}'.format(publisher.port))
+    sub.setsockopt(zmq.SUBSCRIBE, topic.encode('ascii'))
+    return sub
+
+
+def test_publish(publisher):
+    sub = subscribe(publisher, 'free_run')
+    image = np.ones((20, 30), dtype=np.uint16)
+    for i in range(50):  # Until the subscription propagates
+        publisher.publish('free_run', [0.1, image, i])
+        if sub.poll(100):
+            break
+    topic, data = receive(sub)
+    assert topic == 'free_run'
+    np.testing.assert_array_equal(data[1], image)
+    sub.close(linger=0)
+
+
+def test_publish_from_process(publisher):
+    sub = subscribe(publisher, 'locations')
+    for i in range(50):
+        process = Process(target=put_from_process, args=[publisher.queue])
+        process.start()
+        process.join()
+        if sub.poll(100):
+            break
+    topic, data = receive(sub)
+    assert topic == 'locations'
+    np.testing.assert_array_equal(data[1], np.arange(10))
+    sub.close(linger=0)
+
+
+def test_garbage_collector_started(publisher):
+    assert zmq_gc.is_alive()  # Before forking any consumer, see Publisher.start
+
+
+def test_stop_closes_producer_sockets():
+    publisher = Publisher(port=free_port(), mode='direct', input_port=free_port())
+    publisher.start()
+    producers = [threading.Thread(target=publisher.publish, args=['free_run', [0., np.arange(3), i]])
+                 for i in range(3)]
+    for producer in producers:
+        producer.start()
+        producer.join()
+    publisher.publish('free_run', [0., np.arange(3), 3])
+    sockets = [socket for pid, socket in publisher._local_queue._sockets]
+    assert len(sockets) == 4
+    publisher.stop()
+    publisher.join(5)
+    assert all(socket.closed for socket in sockets)
+    assert publisher._local_queue._sockets == []
+
+
+def test_producer_send_hwm():
+    publisher = Publisher(port=free_port(), mode='direct', input_port=free_port(), send_hwm=7)
+    publisher.start()
+    publisher.publish('free_run', [0., np.arange(3), 0])
+    queue = pickle.loads(pickle.dumps(publisher._queue))  # As handed to the producers of other processes
+    assert queue.send_hwm == 7
+    assert publisher._local_queue.socket.getsockopt(zmq.SNDHWM) == 7
+    publisher.stop()
+    publisher.join(5)
+
+
+def test_ports_in_use(monkeypatch):
+    port = free_port()
+    busy = zmq.Context.instance().socket(zmq.REP)
+    busy.bind('tcp://*:{}'.format(port))
+    for name in ('zmq_port', 'zmq_input_port'):  # Updated with the ports finally used
+        monkeypatch.setattr(config, name, getattr(config, name))
+    publisher = Publisher(port=port, mode='direct', input_port=free_port())
+    try:
+        assert publisher.start()
+        assert publisher.port == port + 2
+    finally:
+        publisher.stop()
+        publisher.join(5)
+    monkeypatch.setattr('pynta.model.experiment.publisher.BIND_ATTEMPTS', 1)
+    with pytest.raises(zmq.ZMQError):
+        Publisher(port=port, mode='direct', input_port=free_port()).start()
+    busy.close()
+
+
+def test_latency(publisher):
+    sub = subscribe(publisher, 'latency')
+    for i in range(100):
+        publisher.publish('latency', 'ready')
+        if sub.poll(100):
+            break
+    while sub.poll(100):
+        recv_data(sub)
+
+    latencies = []
+    for i in range(200):
+        t0 = perf_counter()
+        publisher.publish('latency', i)
+        assert sub.poll(1000)
+        recv_data(sub)
+        latencies.append(perf_counter() - t0)
+    assert np.median(latencies) < 1e-3
+    sub.close(linger=0)
+
+
+def test_first_message_after_subscribing(publisher):
+    t0 = perf_counter()
+    subscription = subscribe_topic(publisher.port, 'snap')
+    assert subscription.ready
+    assert perf_counter() - t0 < 1
+    publisher.publish('snap', np.arange(3))
+    topic, data = subscription.recv(timeout=5)
+    np.testing.assert_array_equal(data, np.arange(3))
+    subscription.close()
+
+
+@pytest.mark.parametrize('transport', ['tcp', 'ipc'])
+def test_transport(transport):
+    if transport == 'ipc' and not zmq.has('ipc'):
+        pytest.skip('ZMQ does not support ipc')
+    publisher = Publisher(port=free_port(), mode='direct', input_port=free_port(), transport=transport)
+    publisher.start()
+    assert publisher.address.startswith(transport)
+    assert publisher.local_address.startswith('inproc')
+    subscriptions = [subscribe_topic(address, 'snap') for address in (publisher.address, publisher.local_address)]
+    publisher.publish('snap', np.arange(3))
+    for subscription in subscriptions:
+        topic, data = subscription.recv(timeout=5)
+        np.testing.assert_array_equal(data, np.arange(3))
+        subscription.close()
+    publisher.stop()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Check that locations are converted to record arrays with the columns of the schema and sent without pickling them.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import numpy as np
+import pytest
+from pandas import DataFrame
+
+from pynta.model.experiment.nanoparticle_tracking.schema import (schema_version, to_dataframe, to_records,
+                                                                  LOCATIONS_DTYPE, NO_PARTICLE, SCHEMA_VERSION)
+from pynta.model.experiment.serialization import encode, KIND_SEQUENCE
+
+
+@pytest.fixture
+def locations():
+    """ Locations as returned by trackpy, with the columns in its order and without ``ep``."""
+    return DataFrame({
+        'y': [10., 20.5],
+        'x': [30., 40.5],
+        'mass': [100., 200.],
+        'size': [1.5, 1.6],
+        'ecc': [0.1, 0.2],
+        'signal': [5., 6.],
+        'raw_mass': [300., 400.],
+        'extra': [1, 2],
+    })
+
+
+def test_to_records(locations):
+    records = to_records(locations, frame=7)
+    assert records.dtype == LOCATIONS_DTYPE
+    assert schema_version(records) == SCHEMA_VERSION
+    np.testing.assert_array_equal(records['x'], locations['x'])
+    np.testing.assert_array_equal(records['frame'], [7, 7])
+    np.testing.assert_array_equal(records['particle'], [NO_PARTICLE, NO_PARTICLE])
+    assert np.isnan(records['ep']).all()
+
+
+def test_to_dataframe(locations):
+    df = to_dataframe(to_records(locations, frame=7))
+    assert list(df.columns) == list(LOCATIONS_DTYPE.names)
+    np.testing.assert_array_equal(df['y'], locations['y'])
+
+
+def test_not_pickled(locations):
+    header, buffers = encode([0.5, to_records(locations, frame=7), 7])
+    assert header['kind'] == KIND_SEQUENCE
+
+
+def test_unknown_schema():
+    with pytest.raises(ValueError):
+        schema_version(np.zeros(3, dtype=[('x', '<f8'), ('y', '<f8')]))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Check that data survives the trip through a ZMQ socket and that numpy arrays are not pickled on the way.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import itertools
+
+import numpy as np
+import pytest
+import zmq
+
+from pynta.model.experiment.serialization import encode, recv_data, send_data, KIND_ARRAY, KIND_PICKLE, KIND_SEQUENCE
+
+
+_addresses = itertools.count()
+
+
+@pytest.fixture
+def sockets():
+    context = zmq.Context.instance()
+    sender = context.socket(zmq.PAIR)
+    receiver = context.socket(zmq.PAIR)
+    address = 'inproc://test_serialization_{}'.format(next(_addresses))
+    sender.bind(address)
+    receiver.connect(address)
+    yield sender, receiver
+    sender.close(linger=0)
+    receiver.close(linger=0)
+
+
+def roundtrip(sockets, topic, data):
+    sender, receiver = sockets
+    send_data(sender, topic, data)
+    return recv_data(receiver)
+
+
+def test_frame(sockets):
+    image = np.random.randint(0, 2**16, size=(120, 190), dtype=np.uint16)
+    topic, data = roundtrip(sockets, 'free_run', [1.5, image, 7])
+    assert topic == 'free_run'
+    assert data[0] == 1.5
+    assert data[2] == 7
+    np.testing.assert_array_equal(data[1], image)
+    assert data[1].dtype == np.uint16
+
+
+def test_non_contiguous_and_fortran_arrays(sockets):
+    base = np.arange(200, dtype=np.float32).reshape(10, 20)
+    for array in (base[:, ::3], np.asfortranarray(base)):
+        topic, data = roundtrip(sockets, 'snap', array)
+        np.testing.assert_array_equal(data, array)
+
+
+def test_structured_array(sockets):
+    records = np.zeros(5, dtype=[('x', '<f8'), ('y', '<f8'), ('frame', '<i8')])
+    records['x'] = np.arange(5)
+    topic, data = roundtrip(sockets, 'locations', (0.1, records))
+    assert isinstance(data, tuple)
+    assert data[1].dtype == records.dtype
+    np.testing.assert_array_equal(data[1]['x'], records['x'])
+
+
+def test_pickle_fallback(sockets):
+    for payload in ('stop', [[1, 2], [3, 4]], {'a': np.zeros(3)}, [np.zeros(3), object()]):
+        header, buffers = encode(payload)
+        assert header['kind'] == KIND_PICKLE
+    topic, data = roundtrip(sockets, 'histogram', [[1., 2.], [3., 4.]])
+    assert data == [[1., 2.], [3., 4.]]
+
+
+def test_kinds():
+    assert encode(np.zeros(3))[0]['kind'] == KIND_ARRAY
+    assert encode([np.float64(1.), np.zeros(3), None])[0]['kind'] == KIND_SEQUENCE
+    assert encode(np.zeros(3, dtype=object))[0]['kind'] == KIND_PICKLE
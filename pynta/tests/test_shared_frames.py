@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Check that frames written to shared memory can be read from other processes and that lapped readers notice it.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+from multiprocessing import Process, Queue
+
+import numpy as np
+import pytest
+
+from pynta.exceptions.exceptions import FrameOverwritten
+from pynta.model.experiment.shared_frames import FrameReader, FrameRing, SharedFrame
+
+
+@pytest.fixture
+def ring():
+    ring = FrameRing.create((30, 40), np.uint16, 4)
+    yield ring
+    ring.close()
+
+
+def read_in_process(message, queue):
+    reader = FrameReader()
+    timestamp, image, frame_id = reader.read(message, copy=True)
+    reader.close()
+    queue.put([frame_id, image.sum()])
+
+
+def test_read_from_process(ring):
+    image = np.full((30, 40), 7, dtype=np.uint16)
+    slot, generation = ring.write(image)
+    queue = Queue()
+    process = Process(target=read_in_process, args=[SharedFrame(0.5, slot, 5, ring.name, generation), queue])
+    process.start()
+    frame_id, total = queue.get(timeout=10)
+    process.join()
+    assert frame_id == 5
+    assert total == image.sum()
+
+
+def test_lapped_reader(ring):
+    reader = FrameReader()
+    slot, generation = ring.write(np.zeros((30, 40), np.uint16))
+    message = SharedFrame(0., slot, 1, ring.name, generation)
+    image = reader.read(message)[1]
+    assert reader.is_current(message)
+    for frame_id in range(2, 2 + ring.slots):
+        ring.write(np.ones((30, 40), np.uint16))
+    assert not reader.is_current(message)
+    with pytest.raises(FrameOverwritten):
+        reader.read(message)
+    assert reader.overwritten == 2
+    del image
+    reader.close()
+
+
+def test_new_run(ring):
+    reader = FrameReader()
+    slot, generation = ring.write(np.zeros((30, 40), np.uint16))
+    old = SharedFrame(0., slot, 1, ring.name, generation)
+    for frame_id in range(1, 1 + ring.slots):  # A new free run numbers the frames from 1 again, on the same ring
+        slot, generation = ring.write(np.full((30, 40), frame_id, np.uint16))
+    assert not reader.is_current(old)
+    with pytest.raises(FrameOverwritten):
+        reader.read(old)
+    assert reader.read(SharedFrame(0., slot, frame_id, ring.name, generation))[1][0, 0] == frame_id
+    reader.close()
+
+
+def test_mismatch(ring):
+    assert not ring.fits(np.zeros((30, 40), np.uint8))
+    with pytest.raises(ValueError):
+        ring.write(np.zeros((30, 40), np.uint8))
+    with pytest.raises(ValueError):
+        ring.write(np.zeros((40, 30), np.uint16))
+
+
+def test_plain_messages():
+    image = np.zeros((3, 3))
+    assert FrameReader().read([1., image, 3])[2] == 3
+    assert FrameReader().read([1., image])[2] is None
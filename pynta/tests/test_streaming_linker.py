@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the streaming linker links as trackpy does, and that it retires the trajectories that can not grow anymore
+so that its memory does not grow with the number of frames.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import tracemalloc
+
+import numpy as np
+import trackpy as tp
+
+from pynta.model.experiment.nanoparticle_tracking.schema import empty, to_dataframe
+from pynta.model.experiment.nanoparticle_tracking.streaming_linker import StreamingLinker
+
+
+def frame(positions, frame_id):
+    records = empty(len(positions))
+    records['x'], records['y'] = np.asarray(positions, dtype=float).reshape(-1, 2).T
+    records['frame'] = frame_id
+    return records
+
+
+def stream(frames, particles, lifetime):
+    positions = np.random.uniform(0, 300, (particles, 2))
+    for i in range(frames):
+        leaving = np.random.random(particles) < 1 / lifetime
+        positions[leaving] = np.random.uniform(0, 300, (leaving.sum(), 2))
+        positions += np.random.normal(0, 0.5, positions.shape)
+        yield frame(positions, i)
+
+
+def test_same_links_as_trackpy():
+    np.random.seed(0)
+    frames = list(stream(50, 20, 15))
+    linker = StreamingLinker(4, memory=2)
+    linked = np.concatenate([linker.link(records, i)[0] for i, records in enumerate(frames)])
+    expected = tp.link(to_dataframe(np.concatenate(frames)), 4, memory=2)
+    assert (linked['particle'] >= 0).all()
+    # The same locations are grouped in the same trajectories, regardless of the numbers given to them
+    pairs = set(zip(linked['particle'], expected['particle']))
+    assert len(pairs) == len(set(linked['particle'])) == len(set(expected['particle']))
+
+
+def test_retire():
+    linker = StreamingLinker(4, memory=1, min_length=2)
+    linker.link(frame([[10, 10], [50, 50], [90, 90]], 0), 0)
+    linker.link(frame([[11, 10], [51, 50]], 1), 1)  # The particle at 90 leaves
+    locations, retired = linker.link(frame([[12, 10]], 2), 2)  # The one at 50 leaves
+    assert not len(retired)  # The one at 90 can not come back, but it was seen only once
+    assert linker.live == 2 and linker.retired == 1
+    locations, retired = linker.link(frame([[13, 10]], 3), 3)
+    np.testing.assert_array_equal(retired['x'], [50, 51])
+    np.testing.assert_array_equal(retired['frame'], [0, 1])
+    assert len(set(retired['particle'])) == 1
+    assert linker.live == 1
+    retired = linker.finish()
+    np.testing.assert_array_equal(retired['x'], [10, 11, 12, 13])
+    assert linker.live == 0 and linker.retired == 3
+
+
+def test_bounded_memory():
+    np.random.seed(1)
+    linker = StreamingLinker(4, memory=3)
+    tracemalloc.start()
+    try:
+        memory = []
+        live = []
+        for i, records in enumerate(stream(2000, 20, 20)):
+            linker.link(records, i)
+            if i % 500 == 499:
+                memory.append(tracemalloc.get_traced_memory()[0])
+                live.append(linker.live)
+    finally:
+        tracemalloc.stop()
+    assert linker.retired > 1500
+    assert max(live) < 40
+    assert max(memory[2:]) < 1.5 * memory[1]
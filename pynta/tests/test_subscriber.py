@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Check the delivery classes of the subscriptions and that they account for every message they lose.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import threading
+from time import sleep
+
+import numpy as np
+import pytest
+
+from pynta.model.experiment.publisher import Publisher
+from pynta.model.experiment.subscriber import (get_qos, subscribe, subscriber, wait_ready, DEFAULT_QOS, DROP_OLDEST,
+                                               LATEST, BOUNDED)
+from pynta.tests.test_publisher import free_port
+
+
+@pytest.fixture
+def publisher():
+    pub = Publisher(port=free_port(), mode='direct', input_port=free_port())
+    pub.start()
+    yield pub
+    pub.stop()
+    pub.join(5)
+
+
+def acquire(publisher, frames):
+    """ Publishes frames at about the pace of a fast camera."""
+    image = np.zeros((10, 10), dtype=np.uint16)
+    for i in range(frames):
+        publisher.publish('free_run', [0., image, i])
+        sleep(0.001)
+
+
+def receive_all(subscription):
+    messages = []
+    while True:
+        message = subscription.recv(timeout=0.5)
+        if message is None:
+            return messages
+        messages.append(message[1])
+
+
+def test_get_qos():
+    qos_config = {
+        'default': {'policy': BOUNDED, 'hwm': 50},
+        'free_run': {'policy': DROP_OLDEST, 'hwm': 10},
+        'free_run.saver': {'policy': BOUNDED},
+        'histogram': LATEST,
+    }
+    assert get_qos(None, 'locations') == DEFAULT_QOS
+    assert get_qos(qos_config, 'locations') == dict(DEFAULT_QOS, policy=BOUNDED, hwm=50)
+    assert get_qos(qos_config, 'free_run', 'localization') == dict(DEFAULT_QOS, policy=DROP_OLDEST, hwm=10)
+    assert get_qos(qos_config, 'free_run', 'saver') == dict(DEFAULT_QOS, policy=BOUNDED, hwm=10)
+    assert get_qos(qos_config, 'histogram', 'gui')['policy'] == LATEST
+    with pytest.raises(ValueError):
+        get_qos({'snap': 'sometimes'}, 'snap')
+
+
+def test_bounded(publisher):
+    subscription = subscribe(publisher.port, 'free_run', qos=BOUNDED)
+    acquire(publisher, 100)
+    assert [data[2] for data in receive_all(subscription)] == list(range(100))
+    assert subscription.stats() == {'free_run': {'received': 100, 'dropped': 0}}
+    subscription.close()
+
+
+@pytest.mark.parametrize('qos', [{'policy': DROP_OLDEST, 'hwm': 5}, {'policy': LATEST}])
+def test_slow_consumer(publisher, qos):
+    subscription = subscribe(publisher.port, 'free_run', qos=qos)
+    acquire(publisher, 200)  # While the consumer is busy
+    frames = [data[2] for data in receive_all(subscription)]
+    assert frames[-1] == 199
+    assert len(frames) < 200
+    assert frames == sorted(frames)
+    assert len(frames) + subscription.dropped['free_run'] == 200
+    subscription.close()
+
+
+def test_drop_oldest(publisher):
+    subscription = subscribe(publisher.port, 'free_run', qos={'policy': DROP_OLDEST, 'hwm': 5})
+    acquire(publisher, 200)  # While the consumer is busy
+    sleep(0.5)
+    assert [data[2] for data in receive_all(subscription)] == list(range(195, 200))
+    assert subscription.dropped['free_run'] == 195
+    subscription.close()
+
+
+def test_recv_batch(publisher):
+    subscription = subscribe(publisher.port, 'locations', qos={'batch_size': 25, 'batch_time': 0.5})
+    for i in range(60):
+        publisher.publish('locations', np.arange(i, i + 3))
+    batches = []
+    while True:
+        batch = subscription.recv_batch(timeout=0.5)
+        if not batch:
+            break
+        batches.append([data[0] for topic, data in batch])
+    assert [len(batch) for batch in batches] == [25, 25, 10]
+    assert sum(batches, []) == list(range(60))
+    assert subscription.recv_batch(batch_size=5, timeout=0.1) == []
+    subscription.close()
+
+
+def test_batched_subscriber(publisher):
+    batches = []
+    ready = threading.Event()
+    thread = threading.Thread(target=subscriber, args=[batches.append, 'links', threading.Event()],
+                              kwargs={'address': publisher.local_address, 'ready': ready, 'batch_size': 10,
+                                      'batch_time': 0.5})
+    thread.start()
+    assert wait_ready(ready, thread)
+    for i in range(25):
+        publisher.publish('links', [i, np.zeros(2)])
+    publisher.publish('links', 'stop')
+    thread.join(5)
+    assert not thread.is_alive()
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [data[0] for batch in batches for data in batch] == list(range(25))
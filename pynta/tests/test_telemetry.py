@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the participants of the bus report their statistics on the ``stats`` topic.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+from time import sleep
+
+import numpy as np
+import pytest
+
+from pynta.model.experiment.publisher import Publisher
+from pynta.model.experiment.subscriber import subscribe
+from pynta.model.experiment.telemetry import format_stats, Telemetry, STATS_TOPIC
+from pynta.tests.test_publisher import free_port
+
+
+@pytest.fixture(params=['direct', 'queue'])
+def publisher(request):
+    pub = Publisher(port=free_port(), mode=request.param, input_port=free_port(), stats_interval=0.2)
+    pub.start()
+    yield pub
+    pub.stop()
+    pub.join(5)
+
+
+def test_report():
+    telemetry = Telemetry('consumer', interval=0)
+    for i in range(10):
+        telemetry.received(100, latency=0.001 * i)
+        telemetry.processed(0.01)
+    telemetry.dropped(3)
+    stats = telemetry.report()
+    assert stats['name'] == 'consumer'
+    assert stats['bytes_per_s'] == pytest.approx(1000 / stats['interval'])
+    assert stats['latency']['max'] == pytest.approx(0.009)
+    assert stats['processing']['p50'] == pytest.approx(0.01)
+    assert stats['dropped'] == 3
+    assert not telemetry.due()
+    assert telemetry.report()['latency'] is None  # Everything is reset after reporting
+    assert format_stats(stats).startswith('consumer[')
+
+
+def test_stats_topic(publisher):
+    monitor = subscribe(publisher.port, STATS_TOPIC)
+    telemetry = Telemetry('consumer', publisher.queue, interval=0.2)
+    subscription = subscribe(publisher.port, 'free_run', telemetry=telemetry)
+    image = np.zeros((10, 10), dtype=np.uint16)
+    reports = {}
+    for i in range(100):
+        publisher.publish('free_run', [0., image, i])
+        subscription.recv(timeout=0.01)
+        sleep(0.01)
+        while True:
+            message = monitor.recv(timeout=0)
+            if message is None:
+                break
+            if message[1]['messages_per_s'] > 0:  # The first reports may arrive before any frame
+                reports[message[1]['name']] = message[1]
+        if len(reports) == 2:
+            break
+    assert reports['consumer']['latency']['p50'] < 1
+    assert reports['consumer']['processing'] is not None
+    assert reports['publisher']['bytes_per_s'] > image.nbytes
+    subscription.close()
+    monitor.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Check that localizing a frame in tiles finds the same particles as localizing the whole frame.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from pynta.model.experiment.nanoparticle_tracking.fast_locate import ENGINE
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+from pynta.model.experiment.nanoparticle_tracking.tiling import tile_bounds
+
+
+@pytest.fixture(scope='module')
+def image(simulate):
+    return simulate((400, 500), 300, seed=2, background=5)[0]
+
+
+def test_tile_bounds():
+    bounds = tile_bounds((100, 90), (2, 3), 5)
+    assert len(bounds) == 6
+    covered = np.zeros((100, 90), dtype=int)
+    for (y0, y1, x0, x1), (ay0, ay1, ax0, ax1) in bounds:
+        covered[ay0:ay1, ax0:ax1] += 1
+        assert y0 == max(ay0 - 5, 0) and x1 == min(ax1 + 5, 90)
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize('tiles', [2, (3, 4)])
+def test_locate_tiled(image, tiles):
+    kwargs = {'diameter': 11, 'minmass': 100, 'engine': ENGINE}
+    expected = locate([image], **kwargs)[0]
+    records = locate([image], tiles=tiles, **kwargs)[0]
+    # The tiles share the levels of the whole image: the same particles, with the same columns up to the rounding of
+    # the sums done on each window
+    assert len(records) == len(expected)
+    ordered, expected = (located[np.lexsort((located['x'].round(6), located['y'].round(6)))]
+                         for located in (records, expected))
+    for column in expected.dtype.names:
+        np.testing.assert_allclose(ordered[column], expected[column], rtol=1e-12, err_msg=column)
+
+    with ThreadPoolExecutor(4) as executor:
+        threaded = locate([image], tiles=tiles, executor=executor, **kwargs)[0]
+    np.testing.assert_array_equal(threaded, records)
+
+
+@pytest.mark.parametrize('tiles', [2, (3, 4)])
+def test_locate_tiled_trackpy(image, assert_same_locations, tiles):
+    kwargs = {'diameter': 11, 'minmass': 100}
+    expected = locate([image], **kwargs)[0]
+    records = locate([image], tiles=tiles, **kwargs)[0]
+    # Tiles compute their own thresholds, only the particles close to the minimum mass may differ
+    assert abs(len(records) - len(expected)) <= 0.02 * len(expected)
+    assert_same_locations(records, expected)  # Tiles are scaled to integers with their own maximum
+
+    with ThreadPoolExecutor(4) as executor:
+        threaded = locate([image], tiles=tiles, executor=executor, **kwargs)[0]
+    np.testing.assert_array_equal(threaded, records)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Check that the track store keeps the links as they were received, across the boundaries of its chunks, and that the
+trajectory of a particle read from its index is the same as filtering all the links.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: AGPLv3, see LICENSE for more details
+"""
+import threading
+
+import numpy as np
+
+from pynta.model.experiment.nanoparticle_tracking.schema import LOCATIONS_DTYPE, to_dataframe
+from pynta.model.experiment.nanoparticle_tracking.track_store import TrackStore
+
+
+def batches(frames=20, particles=7):
+    """ :return: list with the links of each frame, some particles missing on some frames"""
+    np.random.seed(0)
+    links = []
+    for frame in range(frames):
+        found = np.flatnonzero(np.random.random(particles) > 0.3)
+        records = np.zeros(len(found), dtype=LOCATIONS_DTYPE)
+        records['x'] = np.random.uniform(0, 100, len(found))
+        records['y'] = np.random.uniform(0, 100, len(found))
+        records['frame'] = frame
+        records['particle'] = found[::-1]
+        links.append(records)
+    return links
+
+
+def test_append_across_chunks():
+    links = batches()
+    store = TrackStore(chunk_size=8)
+    for records in links:
+        store.append(records)
+    expected = np.concatenate(links)
+    assert len(store) == len(expected)
+    np.testing.assert_array_equal(store.records(), expected)
+    assert store.to_dataframe().equals(to_dataframe(expected))
+
+
+def test_track():
+    links = batches()
+    store = TrackStore(chunk_size=8)
+    for records in links:
+        store.append(records)
+    expected = np.concatenate(links)
+    np.testing.assert_array_equal(store.particles(), np.unique(expected['particle']))
+    for particle in store.particles():
+        np.testing.assert_array_equal(store.track(particle), expected[expected['particle'] == particle])
+    store.append(links[0])  # The index keeps growing after a particle was read
+    particle = links[0]['particle'][0]
+    assert store.track(particle)[-1] == links[0][0]
+    assert len(store.track(-5)) == 0
+
+
+def test_empty_and_clear():
+    store = TrackStore()
+    assert len(store.records()) == 0
+    assert len(store.to_dataframe()) == 0
+    store.append(np.zeros(0, dtype=LOCATIONS_DTYPE))
+    store.append(batches()[0])
+    store.clear()
+    assert len(store) == 0
+    assert len(store.particles()) == 0
+
+
+def test_threads():
+    links = batches(frames=200)
+    store = TrackStore(chunk_size=16)
+    reads = []
+
+    def read():
+        for _ in range(50):
+            reads.append(len(store.records()))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for records in links:
+        store.append(records)
+    reader.join()
+    np.testing.assert_array_equal(store.records(), np.concatenate(links))
+    assert reads == sorted(reads)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Localization Benchmark
+======================
+Measures the speed and the accuracy of the localization backends on movies simulated with
+:class:`~pynta.model.cameras.simulate_brownian.SimBrownian`, whose positions are known. Every combination of the
+densities (particles per frame), signal to noise ratios and PSF widths given is a scenario, and every backend of
+:data:`BACKENDS` locates the same frames of each scenario. For each of them it reports:
+
+* ``frames_per_s`` and ``us_per_particle``: the time spent locating, per frame and per simulated particle. The first
+  frame is located once before timing, trackpy compiles its functions with numba on the first call.
+* ``recall``, ``precision`` and ``rms_error``: locations are matched one to one to the closest simulated particle
+  within ``match_radius`` pixels. The RMS error, in pixels, is computed over the matched locations.
+
+The signal to noise ratio is the peak of a particle over the standard deviation of the Poisson background. The
+diameter given to the backends is ``2 * round(2.5 * psf_width) + 1``. The mass of the particles, computed after the
+bandpass filter, is well below their total intensity and depends on their width, therefore the minimum mass is
+calibrated on the first frame of each scenario, as the one that best separates the particles from the noise.
+
+The results are printed as a table and, with ``--output``, written to a JSON file together with the versions of
+PyNTA, numpy and trackpy and the arguments of the run, to compare them between releases. Run it as::
+
+    pynta-benchmark --frames 10 --densities 10 100 500 --snr 3 10 --psf-widths 1 1.5 --output results.json
+
+or ``python -m pynta.tools.benchmark``.
+
+:copyright:  Aquiles Carattino <aquiles@uetke.com>
+:license: GPLv3, see LICENSE for more details
+"""
+import itertools
+import json
+import platform
+import warnings
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+import trackpy as tp
+from scipy.spatial import cKDTree
+
+import pynta
+from pynta.model.cameras.simulate_brownian import SimBrownian
+from pynta.model.experiment.nanoparticle_tracking.localization_pool import locate
+
+#: Arguments of :func:`~pynta.model.experiment.nanoparticle_tracking.localization_pool.locate` for each backend.
+#: Backends with ``batch`` locate all the frames with a single call
+BACKENDS = {
+    'trackpy': {},
+    'trackpy_batch': {'batch': True},
+    'pynta': {'engine': 'pynta'},
+    'pynta_tiled': {'engine': 'pynta', 'tiles': 2},
+    'multires': {'engine': 'multires', 'binning': 2},
+    'pynta_gaussian': {'engine': 'pynta', 'refinement': 'gaussian'},
+}
+
+
+def simulate(shape, num_particles, snr, psf_width, frames, background=20):
+    """ Simulates a movie of particles diffusing, with a Poisson background.
+
+    :param tuple shape: Shape of the frames
+    :param int num_particles: Particles on every frame
+    :param float snr: Peak intensity of the particles over the standard deviation of the background
+    :param float psf_width: Standard deviation of the PSF, in pixels
+    :param int frames: Number of frames
+    :param float background: Mean of the background, in counts
+    :return: list with the frames and list with the positions ``(y, x)`` of the particles on each of them
+    """
+    sim = SimBrownian(shape, num_particles, kernel_size=max(SimBrownian.kernel_size, int(np.ceil(4 * psf_width))))
+    sim.signal = snr * np.sqrt(background) * np.sqrt(2 * np.pi) * psf_width  # The PSF is normalized in 1D
+    sim.psf_width = psf_width
+    images, positions = [], []
+    for i in range(frames):
+        image = sim.gen_image()
+        images.append(np.random.poisson(image + background).astype(np.uint16))
+        positions.append(true_positions(sim))
+    return images, positions
+
+
+def true_positions(sim):
+    """ :return: the positions ``(y, x)``, in pixels, of the particles of the last frame generated by a
+        :class:`~pynta.model.cameras.simulate_brownian.SimBrownian`. Each particle is drawn on the pixel given by the
+        integer part of its position and shifted by the fractional part of the position along the other axis.
+    """
+    position = sim.localization * sim.magnification / sim.pixel_size
+    pixel, fraction = np.floor(position), position % 1
+    return np.column_stack((pixel[:, 0] + fraction[:, 1], pixel[:, 1] + fraction[:, 0]))
+
+
+def match(positions, records, radius):
+    """ Matches the locations to the closest true positions, one to one, the closest pairs first.
+
+    :return: the number of locations matched and the distances of the matched pairs
+    """
+    if not len(positions) or not len(records):
+        return 0, np.zeros(0)
+    pairs = cKDTree(np.column_stack((records['y'], records['x']))).sparse_distance_matrix(
+        cKDTree(positions), radius, output_type='ndarray')
+    pairs = pairs[np.argsort(pairs['v'], kind='stable')]
+    used_locations, used_positions, distances = set(), set(), []
+    for i, j, distance in pairs:
+        if i not in used_locations and j not in used_positions:
+            used_locations.add(i)
+            used_positions.add(j)
+            distances.append(distance)
+    return len(distances), np.array(distances)
+
+
+def calibrate_minmass(image, positions, diameter, radius):
+    """ :return: the minimum mass that gives the best F1 score (the harmonic mean of recall and precision) on the
+        image, as located by the ``pynta`` engine
+    """
+    records = locate([image], engine='pynta', diameter=diameter, minmass=0)[0]
+    if not len(records) or not len(positions):
+        return 0.
+    distances, _ = cKDTree(positions).query(np.column_stack((records['y'], records['x'])),
+                                            distance_upper_bound=radius)
+    order = np.argsort(records['mass'])[::-1]
+    masses, matched = records['mass'][order], np.isfinite(distances[order])
+    # Keeping the i + 1 most massive locations
+    f1 = 2 * np.cumsum(matched) / (len(positions) + np.arange(1, len(masses) + 1))
+    best = int(np.argmax(f1))
+    return float(masses[best] + masses[best + 1]) / 2 if best + 1 < len(masses) else 0.
+
+
+def run_backend(images, batch=False, **kwargs):
+    """ Locates the particles on the frames with the arguments of a backend, see :data:`BACKENDS`.
+
+    :return: list with the locations of each frame and the time it took, in seconds
+    """
+    locate(images[:1], **kwargs)
+    t0 = perf_counter()
+    if batch:
+        located = locate(images, **kwargs)
+    else:
+        located = [locate([image], **kwargs)[0] for image in images]
+    return located, perf_counter() - t0
+
+
+def benchmark(backends=None, densities=(10, 100, 500), snrs=(3, 10), psf_widths=(1., 1.5), frames=10,
+              shape=(512, 512), match_radius=None, seed=0):
+    """ Runs every backend on every scenario.
+
+    :param list backends: Names of the backends, by default all of :data:`BACKENDS`
+    :param float match_radius: Maximum distance between a location and a true position to match them, in pixels. By
+        default half the diameter
+    :return: list with a dictionary of results for every scenario and backend
+    """
+    backends = list(BACKENDS) if backends is None else backends
+    results = []
+    for num_particles, snr, psf_width in itertools.product(densities, snrs, psf_widths):
+        np.random.seed(seed)
+        images, positions = simulate(shape, num_particles, snr, psf_width, frames)
+        diameter = 2 * int(round(2.5 * psf_width)) + 1
+        radius = diameter / 2 if match_radius is None else match_radius
+        minmass = calibrate_minmass(images[0], positions[0], diameter, radius)
+        for name in backends:
+            located, elapsed = run_backend(images, diameter=diameter, minmass=minmass, **BACKENDS[name])
+            matched, distances = zip(*[match(truth, records, radius) for truth, records in zip(positions, located)])
+            distances = np.concatenate(distances)
+            total_located = sum(len(records) for records in located)
+            total_true = sum(len(truth) for truth in positions)
+            results.append({
+                'backend': name,
+                'particles': num_particles,
+                'snr': snr,
+                'psf_width': psf_width,
+                'diameter': diameter,
+                'minmass': minmass,
+                'frames': frames,
+                'frames_per_s': frames / elapsed,
+                'us_per_particle': elapsed / total_true * 1e6,
+                'recall': sum(matched) / total_true,
+                'precision': sum(matched) / total_located if total_located else 1.,
+                'rms_error': float(np.sqrt(np.mean(distances ** 2))) if len(distances) else None,
+            })
+    return results
+
+
+def format_result(result):
+    """ :return: one line summarizing a result, as printed by :func:`main`."""
+    return '{backend:<16} {particles:>9} {snr:>5} {psf_width:>5} {frames_per_s:>9.1f} {us_per_particle:>9.1f} ' \
+           '{recall:>7.3f} {precision:>9.3f} {rms:>7}'.format(
+               rms='-' if result['rms_error'] is None else '{:.3f}'.format(result['rms_error']), **result)
+
+
+HEADER = '{:<16} {:>9} {:>5} {:>5} {:>9} {:>9} {:>7} {:>9} {:>7}'.format(
+    'backend', 'particles', 'snr', 'psf', 'frames/s', 'us/part', 'recall', 'precision', 'rms px')
+
+
+def main():
+    parser = ArgumentParser(description='Speed and accuracy of the localization backends on simulated movies')
+    parser.add_argument('--backends', nargs='*', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--densities', type=int, nargs='*', default=[10, 100, 500], help='Particles per frame')
+    parser.add_argument('--snr', type=float, nargs='*', default=[3, 10], help='Peak over background noise')
+    parser.add_argument('--psf-widths', type=float, nargs='*', default=[1., 1.5], help='Sigma of the PSF, in pixels')
+    parser.add_argument('--frames', type=int, default=10)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--height', type=int, default=512)
+    parser.add_argument('--match-radius', type=float, default=None, help='In pixels, by default half the diameter')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')  # trackpy warns about frames without particles
+    tp.quiet()
+    print(HEADER)
+    results = []
+    for num_particles in args.densities:  # One density at a time, to print the results as they come
+        results += benchmark(args.backends, [num_particles], args.snr, args.psf_widths, args.frames,
+                             (args.height, args.width), args.match_radius, args.seed)
+        for result in results[-len(args.backends) * len(args.snr) * len(args.psf_widths):]:
+            print(format_result(result), flush=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.now().isoformat(),
+                'versions': {'pynta': pynta.__version__, 'numpy': np.__version__, 'trackpy': tp.__version__,
+                             'python': platform.python_version()},
+                'platform': platform.platform(),
+                'arguments': vars(args),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,3 @@
-from time import sleep
-
 import numpy as np
 
 from pynta.view.GUI.main_window import MainWindowGUI
@@ -20,7 +18,9 @@ class MainWindow(MainWindowGUI):
         self.config_widget.update_config(self.experiment.config)
         self.tracking = False
 
-        self.update_histogram_worker = SubscriberThread(self.experiment.publisher.port, 'histogram')
+        self.update_histogram_worker = SubscriberThread(self.experiment.publisher.local_address, 'histogram',
+                                                        self.experiment.qos('histogram', 'gui'),
+                                                        self.experiment.telemetry('gui'))
         self.update_histogram_worker.data_received.connect(self.update_histogram)
         self.update_histogram_worker.start()
 
@@ -31,11 +31,18 @@ class MainWindow(MainWindowGUI):
         self.experiment.snap()
 
     def update_gui(self):
-        if self.experiment.temp_image is not None:
-            self.camera_viewer_widget.update_image(self.experiment.temp_image)
-            if self.experiment.tracking:
-                locations = self.experiment.temp_locations
+        if self.experiment.temp_image is None:
+            return
+        if self.experiment.tracking and self.experiment.free_run_running:
+            # The newest frame already located by the tracking, the GUI does not locate particles itself
+            image, locations = self.experiment.tracked_frame()
+            if image is not None:
+                self.camera_viewer_widget.update_image(image)
                 self.camera_viewer_widget.draw_target_pointer(locations)
+                return
+        self.camera_viewer_widget.update_image(self.experiment.temp_image)
+        if self.experiment.tracking:
+            self.camera_viewer_widget.draw_target_pointer(self.experiment.temp_locations)
 
     def start_movie(self):
         if self.experiment.free_run_running:
@@ -125,6 +132,6 @@ class MainWindow(MainWindowGUI):
 
     def closeEvent(self, *args, **kwargs):
         self.experiment.finalize()
-        sleep(1)
+        self.update_histogram_worker.stop()
         super().closeEvent(*args, **kwargs)
 
@@ -11,25 +11,33 @@
 import numpy as np
 from PyQt5.QtCore import QThread, pyqtSignal
 
+from pynta.model.experiment.publisher import STOP_CHECK_INTERVAL
 from pynta.model.experiment.subscriber import subscribe
 
 
 class SubscriberThread(QThread):
     data_received = pyqtSignal(list)
 
-    def __init__(self, port, topic):
+    def __init__(self, address, topic, qos=None, telemetry=None):
         super().__init__()
         self.topic = topic
-        self.port = port
+        self.address = address
+        self.qos = qos
+        self.telemetry = telemetry
         self.keep_receiving = True
 
     def __del__(self):
+        self.stop()
+
+    def stop(self):
+        """ Stops receiving and waits for the thread to finish."""
         self.keep_receiving = False
         self.wait()
 
     def run(self):
-        socket = subscribe(self.port, self.topic)
+        subscription = subscribe(self.address, self.topic, qos=self.qos, name='gui', telemetry=self.telemetry)
         while self.keep_receiving:
-            socket.recv_string()
-            data = socket.recv_pyobj()  # flags=0, copy=True, track=False)
-            self.data_received.emit(data)
+            message = subscription.recv(timeout=STOP_CHECK_INTERVAL)
+            if message is not None:
+                self.data_received.emit(message[1])
+        subscription.close()
@@ -31,7 +31,9 @@ setup(
     long_description_content_type="text/markdown",
     entry_points={
         "console_scripts": [
-            "pynta=pynta.__main__:main"
+            "pynta=pynta.__main__:main",
+            "pynta-stats=pynta.model.experiment.telemetry:main",
+            "pynta-benchmark=pynta.tools.benchmark:main",
         ]
     }
 )